@@ -5,6 +5,8 @@ These do data conversion and persistence. Functions from libs and processing_com
 
 import ast
 import collections
+import concurrent.futures
+import logging
 
 import astropy.units as u
 import h5py
@@ -19,6 +21,290 @@ from data_models.memory_data_models import Visibility, BlockVisibility, Configur
     GainTable, SkyModel, Skycomponent, Image
 from data_models.polarisation import PolarisationFrame, ReceptorFrame
 
+log = logging.getLogger(__name__)
+
+# HDF5 cannot store a chunk of 4GB or more
+HDF_MAX_CHUNK_BYTES = 2 ** 32 - 1
+
+
+def convert_to_native_byteorder(data):
+    """ Convert an array read from file to native byte order
+    
+    The in-memory data models use native byte order. Files written by earlier versions hold big-endian data.
+
+    :param data: numpy array, possibly structured
+    :return: array in native byte order, not copied if already native
+    """
+    native = data.dtype.newbyteorder('=')
+    if data.dtype == native:
+        return data
+    return data.astype(native)
+
+
+def hdf_chunk_rows(data, rows_per_chunk=None, chunk_bytes=1024 * 1024):
+    """ Number of rows of a structured array to hold in each HDF5 chunk
+
+    The rows of Visibility and BlockVisibility are in time order, so a chunk of rows is a range of times and a
+    read of a range of times touches only the chunks holding those times. By default the number of rows is chosen
+    to give chunks of about chunk_bytes, with at least one row per chunk. The number of rows is limited so that a
+    chunk does not exceed the HDF5 limit of 4GB, unless a single row is larger than that (see create_hdf_dataset).
+
+    :param data: numpy structured array
+    :param rows_per_chunk: Number of rows per chunk (None for automatic)
+    :param chunk_bytes: Target size of chunk in bytes, used if rows_per_chunk is None
+    :return: number of rows per chunk
+    """
+    if rows_per_chunk is None:
+        rows_per_chunk = chunk_bytes // data.dtype.itemsize
+    rows_per_chunk = min(rows_per_chunk, HDF_MAX_CHUNK_BYTES // data.dtype.itemsize)
+    return int(max(1, min(rows_per_chunk, len(data))))
+
+
+def create_hdf_dataset(f, name, data, chunks=None, compression=None):
+    """ Write an array as a chunked and optionally compressed HDF5 dataset
+
+    Compression is lossless. The shuffle filter is applied before compression since it groups the bytes of the
+    floating point values, which compresses much better.
+    
+    HDF5 chunks must be smaller than 4GB. If a chunk would be larger (e.g. a single time of a BlockVisibility of a
+    large array), the dataset is written contiguous, and so uncompressed, instead.
+
+    :param f: HDF group
+    :param name: Name of dataset
+    :param data: numpy array
+    :param chunks: Chunk shape, None for contiguous storage
+    :param compression: None, 'gzip' or 'lzf'
+    :return: HDF dataset
+    """
+    if data.size == 0:
+        chunks = None
+    if chunks is not None and numpy.prod(chunks) * data.dtype.itemsize > HDF_MAX_CHUNK_BYTES:
+        log.warning("create_hdf_dataset: chunk of %s exceeds the HDF5 limit of 4GB, writing contiguous and "
+                    "uncompressed" % name)
+        chunks = None
+        compression = None
+    if chunks is None and compression is None:
+        return f.create_dataset(name, data=data)
+    return f.create_dataset(name, data=data, chunks=chunks, compression=compression,
+                            shuffle=compression is not None)
+
+
+def read_hdf_column(dataset, name):
+    """ Read one column of a Visibility or BlockVisibility dataset, for selecting rows
+
+    The time column (and for a Visibility, the frequency column) is also written as a small dataset of its own
+    beside the data, so that it can be read without reading the whole data. Reading a column of the compound data
+    reads (and decompresses) all of it, so that is only done for files written without these datasets.
+
+    :param dataset: HDF dataset of the data of a Visibility or BlockVisibility
+    :param name: Name of column
+    :return: numpy array in native byte order
+    """
+    group = dataset.parent
+    if name in group and group[name].shape == (len(dataset),):
+        return convert_to_native_byteorder(group[name][...])
+    return convert_to_native_byteorder(dataset[name])
+
+
+def select_hdf_rows(dataset, time_range=None, rows=None, channel_range=None, frequency=None):
+    """ Find the rows of a Visibility or BlockVisibility dataset to be read
+
+    Only the time (and for channel selection of a Visibility, the frequency) columns are read, using
+    read_hdf_column.
+
+    :param dataset: HDF dataset of the data of a Visibility or BlockVisibility
+    :param time_range: [start, stop] times (s) to be read, inclusive
+    :param rows: Row numbers or boolean array of rows to be read
+    :param channel_range: [start, stop] channels to be read, as for range(start, stop). Only used if frequency is given
+    :param frequency: Frequencies of the channels if the rows are to be selected by frequency (Visibility)
+    :return: Sorted array of row numbers, or None for all rows
+    """
+    if time_range is None and rows is None and (channel_range is None or frequency is None):
+        return None
+    
+    nrows = len(dataset)
+    selected = numpy.ones([nrows], dtype='bool')
+    if rows is not None:
+        rows = numpy.asarray(rows)
+        if rows.dtype == bool:
+            assert len(rows) == nrows, "Length of rows does not agree with length of data"
+            selected &= rows
+        else:
+            mask = numpy.zeros([nrows], dtype='bool')
+            mask[rows] = True
+            selected &= mask
+    if time_range is not None:
+        time = read_hdf_column(dataset, 'time')
+        selected &= (time >= time_range[0]) & (time <= time_range[1])
+    if channel_range is not None and frequency is not None:
+        selected &= numpy.isin(read_hdf_column(dataset, 'frequency'), frequency[channel_range[0]:channel_range[1]])
+    return numpy.flatnonzero(selected)
+
+
+def hdf_data_dtype(dataset, channel_range=None):
+    """ Native dtype of the data read from a Visibility or BlockVisibility dataset
+
+    :param dataset: HDF dataset
+    :param channel_range: [start, stop] channels of vis and weight (BlockVisibility)
+    :return: numpy dtype
+    """
+    dtype = dataset.dtype.newbyteorder('=')
+    if channel_range is None:
+        return dtype
+    desc = []
+    for name in dtype.names:
+        shape = dtype[name].shape
+        if name in ['vis', 'weight']:
+            shape = shape[:-2] + (len(range(*channel_range)[:shape[-2]]),) + shape[-1:]
+        desc.append((name, dtype[name].base, shape))
+    return numpy.dtype(desc)
+
+
+def read_hdf_rows(dataset, rows=None, channel_range=None, field=None):
+    """ Read selected rows of a Visibility or BlockVisibility dataset
+
+    The rows are read a block at a time, one HDF5 chunk per block if the dataset is chunked, so that only the
+    blocks holding selected rows are read, and at most one block of unselected data is in memory at once.
+
+    :param dataset: HDF dataset
+    :param rows: Sorted array of row numbers, or None for all rows
+    :param channel_range: [start, stop] channels of vis and weight to keep (BlockVisibility)
+    :param field: Read only this column
+    :return: numpy array in native byte order
+    """
+    nrows = len(dataset)
+    if rows is None:
+        rows = numpy.arange(nrows)
+    if dataset.chunks is not None:
+        block = dataset.chunks[0]
+    else:
+        block = hdf_chunk_rows(dataset)
+    
+    dtype = hdf_data_dtype(dataset, channel_range)
+    if field is None:
+        data = numpy.zeros([len(rows)], dtype=dtype)
+    else:
+        data = numpy.zeros([len(rows)] + list(dtype[field].shape), dtype=dtype[field].base)
+    
+    def select_channels(column, name):
+        if channel_range is not None and name in ['vis', 'weight']:
+            return column[..., channel_range[0]:channel_range[1], :]
+        return column
+    
+    blocks = rows // block
+    starts = numpy.flatnonzero(numpy.diff(blocks, prepend=-1))
+    stops = numpy.append(starts[1:], len(rows))
+    for start, stop in zip(starts, stops):
+        first = blocks[start] * block
+        last = min(first + block, nrows)
+        index = rows[start:stop] - first
+        if field is None:
+            part = dataset[first:last]
+            for name in dtype.names:
+                data[name][start:stop] = select_channels(part[name][index], name)
+        else:
+            data[start:stop] = select_channels(dataset[first:last, field][index], field)
+    return data
+
+
+class LazyHDFData:
+    """ Data of a Visibility or BlockVisibility held in an HDF5 file, read when accessed
+
+    The data are accessed as for the numpy structured array. A column, e.g. data['vis'], is read from the file when
+    first accessed, and then held in memory. Any other access (e.g. data[rows], numpy.asarray(data), data.copy())
+    reads all remaining columns, after which the data are an ordinary structured array. The file is opened on the
+    first read, and reopened after pickling, so a LazyHDFData may be sent to another process that can see the file.
+    """
+    
+    def __init__(self, dataset, rows=None, channel_range=None):
+        """ Lazy data
+
+        :param dataset: HDF dataset, used only to find the file, path, and dtype
+        :param rows: Sorted array of row numbers, or None for all rows
+        :param channel_range: [start, stop] channels of vis and weight (BlockVisibility)
+        """
+        self.filename = dataset.file.filename
+        self.path = dataset.name
+        self.rows = rows
+        self.channel_range = channel_range
+        self.nrows = len(dataset) if rows is None else len(rows)
+        self.dtype = hdf_data_dtype(dataset, channel_range)
+        self.file = None
+        self.columns = collections.OrderedDict()
+        self.array = None
+    
+    def dataset(self):
+        if self.file is None:
+            self.file = h5py.File(self.filename, 'r')
+        return self.file[self.path]
+    
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+    
+    def materialise(self):
+        """ Read all the data, and close the file
+
+        The file is read in one pass, since reading a single column still reads (and decompresses) whole HDF5
+        chunks. Columns already read are copied in, keeping any changes made to them, and then released.
+
+        :return: numpy structured array
+        """
+        if self.array is None:
+            array = read_hdf_rows(self.dataset(), self.rows, self.channel_range)
+            while self.columns:
+                name, column = self.columns.popitem(last=False)
+                array[name] = column
+            self.array = array
+            self.columns = None
+            self.close()
+        return self.array
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['file'] = None
+        return state
+    
+    def __len__(self):
+        return self.nrows
+    
+    def __getitem__(self, key):
+        if self.array is not None:
+            return self.array[key]
+        if isinstance(key, str):
+            if key not in self.columns:
+                self.columns[key] = read_hdf_rows(self.dataset(), self.rows, self.channel_range, field=key)
+            return self.columns[key]
+        return self.materialise()[key]
+    
+    def __setitem__(self, key, value):
+        if self.array is None and isinstance(key, str):
+            self[key][...] = value
+        else:
+            self.materialise()[key] = value
+    
+    def __array__(self, dtype=None):
+        return self.materialise()
+    
+    @property
+    def shape(self):
+        return (self.nrows,)
+    
+    @property
+    def size(self):
+        return self.nrows
+    
+    @property
+    def nbytes(self):
+        return self.nrows * self.dtype.itemsize
+    
+    def copy(self):
+        return self.materialise().copy()
+    
+    def setflags(self, write=None):
+        self.materialise().setflags(write=write)
+
 
 def convert_earthlocation_to_string(el: EarthLocation):
     """Convert Earth Location to string
@@ -110,11 +396,13 @@ def convert_configuration_from_hdf(f):
                          diameter=diameter, names=names, mount=mount)
 
 
-def convert_visibility_to_hdf(vis, f):
+def convert_visibility_to_hdf(vis, f, rows_per_chunk=None, compression=None):
     """ Convert visibility to HDF
 
     :param vis:
     :param f: HDF root
+    :param rows_per_chunk: Number of rows per HDF5 chunk (None for about 1MB)
+    :param compression: Lossless compression: None, 'gzip' or 'lzf'
     :return:
     """
     assert isinstance(vis, Visibility)
@@ -125,15 +413,23 @@ def convert_visibility_to_hdf(vis, f):
     f.attrs['phasecentre_coords'] = vis.phasecentre.to_string()
     f.attrs['phasecentre_frame'] = vis.phasecentre.frame.name
     f.attrs['polarisation_frame'] = vis.polarisation_frame.type
-    f['data'] = vis.data
+    data = numpy.asarray(vis.data)
+    create_hdf_dataset(f, 'data', data, chunks=(hdf_chunk_rows(data, rows_per_chunk),), compression=compression)
+    # Written separately so that rows can be selected without reading the data
+    f['time'] = data['time']
+    f['frequency'] = data['frequency']
     f = convert_configuration_to_hdf(vis.configuration, f)
     return f
 
 
-def convert_hdf_to_visibility(f):
+def convert_hdf_to_visibility(f, time_range=None, channel_range=None, rows=None, lazy=False):
     """ Convert HDF root to visibility
 
     :param f:
+    :param time_range: [start, stop] times (s) to be read, inclusive
+    :param channel_range: [start, stop] channels to be read. The channels are the distinct frequencies.
+    :param rows: Row numbers or boolean array of rows to be read
+    :param lazy: Read the data when accessed (see LazyHDFData)
     :return:
     """
     assert f.attrs['ARL_data_model'] == "Visibility", "Not a Visibility"
@@ -141,18 +437,30 @@ def convert_hdf_to_visibility(f):
     ss = [float(s[0]), float(s[1])] * u.deg
     phasecentre = SkyCoord(ra=ss[0], dec=ss[1], frame=f.attrs['phasecentre_frame'])
     polarisation_frame = PolarisationFrame(f.attrs['polarisation_frame'])
-    data = numpy.array(f['data'])
+    frequency = None
+    if channel_range is not None:
+        frequency = numpy.unique(read_hdf_column(f['data'], 'frequency'))
+    selected = select_hdf_rows(f['data'], time_range=time_range, rows=rows, channel_range=channel_range,
+                               frequency=frequency)
+    if lazy:
+        data = LazyHDFData(f['data'], rows=selected)
+    elif selected is None:
+        data = convert_to_native_byteorder(numpy.array(f['data']))
+    else:
+        data = read_hdf_rows(f['data'], selected)
     vis = Visibility(data=data, polarisation_frame=polarisation_frame,
                      phasecentre=phasecentre)
     vis.configuration = convert_configuration_from_hdf(f)
     return vis
 
 
-def convert_blockvisibility_to_hdf(vis: BlockVisibility, f):
+def convert_blockvisibility_to_hdf(vis: BlockVisibility, f, times_per_chunk=None, compression=None):
     """ Convert blockvisibility to HDF
 
     :param vis:
     :param f: HDF root
+    :param times_per_chunk: Number of times per HDF5 chunk (None for about 1MB)
+    :param compression: Lossless compression: None, 'gzip' or 'lzf'
     :return:
     """
     assert isinstance(vis, BlockVisibility)
@@ -165,15 +473,24 @@ def convert_blockvisibility_to_hdf(vis: BlockVisibility, f):
     f.attrs['polarisation_frame'] = vis.polarisation_frame.type
     f.attrs['frequency'] = vis.frequency
     f.attrs['channel_bandwidth'] = vis.channel_bandwidth
-    f['data'] = vis.data
+    create_hdf_dataset(f, 'data', vis.data, chunks=(hdf_chunk_rows(vis.data, times_per_chunk),),
+                       compression=compression)
+    # Written separately so that times can be selected without reading the data
+    f['time'] = vis.time
     f = convert_configuration_to_hdf(vis.configuration, f)
     return f
 
 
-def convert_hdf_to_blockvisibility(f):
+def convert_hdf_to_blockvisibility(f, time_range=None, channel_range=None, rows=None, lazy=False,
+                                   configuration=None):
     """ Convert HDF root to blockvisibility
 
     :param f:
+    :param time_range: [start, stop] times (s) to be read, inclusive
+    :param channel_range: [start, stop] channels to be read, as for range(start, stop)
+    :param rows: Row numbers or boolean array of rows (i.e. times) to be read
+    :param lazy: Read the data when accessed (see LazyHDFData)
+    :param configuration: Configuration to use instead of reading it from HDF
     :return:
     """
     assert f.attrs['ARL_data_model'] == "BlockVisibility", "Not a BlockVisibility"
@@ -183,19 +500,34 @@ def convert_hdf_to_blockvisibility(f):
     polarisation_frame = PolarisationFrame(f.attrs['polarisation_frame'])
     frequency = f.attrs['frequency']
     channel_bandwidth = f.attrs['channel_bandwidth']
-    data = numpy.array(f['data'])
+    if channel_range is not None:
+        frequency = frequency[channel_range[0]:channel_range[1]]
+        channel_bandwidth = channel_bandwidth[channel_range[0]:channel_range[1]]
+    selected = select_hdf_rows(f['data'], time_range=time_range, rows=rows)
+    if lazy:
+        data = LazyHDFData(f['data'], rows=selected, channel_range=channel_range)
+    elif selected is None and channel_range is None:
+        data = convert_to_native_byteorder(numpy.array(f['data']))
+    else:
+        data = read_hdf_rows(f['data'], selected, channel_range=channel_range)
     vis = BlockVisibility(data=data, polarisation_frame=polarisation_frame,
                           phasecentre=phasecentre, frequency=frequency,
                           channel_bandwidth=channel_bandwidth)
-    vis.configuration = convert_configuration_from_hdf(f)
+    if configuration is None:
+        configuration = convert_configuration_from_hdf(f)
+    vis.configuration = configuration
     return vis
 
 
-def export_visibility_to_hdf5(vis, filename):
+def export_visibility_to_hdf5(vis, filename, rows_per_chunk=None, compression=None):
     """ Export a Visibility to HDF5 format
 
+    The data are chunked by rows, i.e. by time. By default each chunk is about 1MB.
+
     :param vis:
     :param filename:
+    :param rows_per_chunk: Number of rows per HDF5 chunk (None for about 1MB)
+    :param compression: Lossless compression with shuffle: None, 'gzip' or 'lzf'
     :return:
     """
     
@@ -205,31 +537,46 @@ def export_visibility_to_hdf5(vis, filename):
         f.attrs['number_data_models'] = len(vis)
         for i, v in enumerate(vis):
             vf = f.create_group('Visibility%d' % i)
-            convert_visibility_to_hdf(v, vf)
+            convert_visibility_to_hdf(v, vf, rows_per_chunk=rows_per_chunk, compression=compression)
         f.flush()
 
 
-def import_visibility_from_hdf5(filename):
+def import_visibility_from_hdf5(filename, time_range=None, channel_range=None, rows=None, lazy=False):
     """Import a Visibility from HDF5 format
 
+    Part of the data may be selected by time, channel, and row. Only the parts of the file holding the selected
+    rows are read. For example, to read the first hour of the first two channels::
+
+        vis = import_visibility_from_hdf5(filename, time_range=[t0, t0 + 3600.0], channel_range=[0, 2])
+
     :param filename:
+    :param time_range: [start, stop] times (s) to be read, inclusive
+    :param channel_range: [start, stop] channels to be read. The channels are the distinct frequencies.
+    :param rows: Row numbers or boolean array of rows to be read
+    :param lazy: Keep the file open and read the data when accessed (see LazyHDFData)
     :return: If only one then a Visibility, otherwise a list of Visibilitys
     """
     
     with h5py.File(filename, 'r') as f:
         nvislist = f.attrs['number_data_models']
-        vislist = [convert_hdf_to_visibility(f['Visibility%d' % i]) for i in range(nvislist)]
+        vislist = [convert_hdf_to_visibility(f['Visibility%d' % i], time_range=time_range,
+                                             channel_range=channel_range, rows=rows, lazy=lazy)
+                   for i in range(nvislist)]
         if nvislist == 1:
             return vislist[0]
         else:
             return vislist
 
 
-def export_blockvisibility_to_hdf5(vis, filename):
+def export_blockvisibility_to_hdf5(vis, filename, times_per_chunk=None, compression=None):
     """ Export a BlockVisibility to HDF5 format
 
+    The data are chunked by time. By default each chunk holds as many times as fit in about 1MB, and at least one.
+
     :param vis:
     :param filename:
+    :param times_per_chunk: Number of times per HDF5 chunk (None for about 1MB)
+    :param compression: Lossless compression with shuffle: None, 'gzip' or 'lzf'
     :return:
     """
     
@@ -240,26 +587,86 @@ def export_blockvisibility_to_hdf5(vis, filename):
         for i, v in enumerate(vis):
             assert isinstance(v, BlockVisibility)
             vf = f.create_group('BlockVisibility%d' % i)
-            convert_blockvisibility_to_hdf(v, vf)
+            convert_blockvisibility_to_hdf(v, vf, times_per_chunk=times_per_chunk, compression=compression)
         f.flush()
 
 
-def import_blockvisibility_from_hdf5(filename):
+def import_blockvisibility_from_hdf5(filename, time_range=None, channel_range=None, rows=None, lazy=False):
     """Import a Visibility from HDF5 format
 
+    Part of the data may be selected by time, channel, and row. Only the parts of the file holding the selected
+    times are read, and only the selected channels are kept in memory.
+
     :param filename:
+    :param time_range: [start, stop] times (s) to be read, inclusive
+    :param channel_range: [start, stop] channels to be read, as for range(start, stop)
+    :param rows: Row numbers or boolean array of rows (i.e. times) to be read
+    :param lazy: Keep the file open and read the data when accessed (see LazyHDFData)
     :return: If only one then a BlockVisibility, otherwise a list of BlockVisibility's
     """
     
     with h5py.File(filename, 'r') as f:
         nvislist = f.attrs['number_data_models']
-        vislist = [convert_hdf_to_blockvisibility(f['BlockVisibility%d' % i]) for i in range(nvislist)]
+        vislist = [convert_hdf_to_blockvisibility(f['BlockVisibility%d' % i], time_range=time_range,
+                                                  channel_range=channel_range, rows=rows, lazy=lazy)
+                   for i in range(nvislist)]
         if nvislist == 1:
             return vislist[0]
         else:
             return vislist
 
 
+def import_blockvisibility_from_hdf5_iter(filename, times_per_chunk=1, channel_range=None, prefetch=False, index=0):
+    """Iterate through a BlockVisibility in HDF5 format in chunks of time
+
+    Each chunk is a BlockVisibility holding times_per_chunk times (fewer for the last chunk), so only one chunk
+    (two, if prefetching) is in memory at once. This allows e.g. calibration of observations larger than memory::
+
+        for bvis in import_blockvisibility_from_hdf5_iter(filename, times_per_chunk=10):
+            gt = solve_gaintable(bvis, model)
+            ...
+
+    If prefetch is True, the next chunk is read in a separate thread while the current chunk is processed. h5py
+    serialises all its calls behind a global lock, so the reading and decompression of the next chunk only overlap
+    with processing that does not itself call h5py, and any gain is usually small. Hence prefetch is off by default.
+
+    :param filename:
+    :param times_per_chunk: Number of times in each chunk
+    :param channel_range: [start, stop] channels to be read, as for range(start, stop)
+    :param prefetch: Read the next chunk while the current chunk is processed (False)
+    :param index: Which BlockVisibility in the file
+    :return: Generator of BlockVisibility's
+    """
+    assert times_per_chunk > 0, "times_per_chunk must be positive"
+    
+    with h5py.File(filename, 'r') as f:
+        vf = f['BlockVisibility%d' % index]
+        configuration = convert_configuration_from_hdf(vf)
+        ntimes = len(vf['data'])
+        starts = list(range(0, ntimes, times_per_chunk))
+        
+        def read_chunk(start):
+            rows = numpy.arange(start, min(start + times_per_chunk, ntimes))
+            return convert_hdf_to_blockvisibility(vf, rows=rows, channel_range=channel_range,
+                                                  configuration=configuration)
+        
+        if not prefetch:
+            for start in starts:
+                yield read_chunk(start)
+            return
+        
+        # Only the reading thread uses the file while the chunks are yielded
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            future = None
+            for start in starts:
+                if future is None:
+                    future = executor.submit(read_chunk, start)
+                chunk = future.result()
+                future = executor.submit(read_chunk, start + times_per_chunk) \
+                    if start + times_per_chunk < ntimes else None
+                yield chunk
+
+
 def convert_gaintable_to_hdf(gt: GainTable, f):
     """ Convert GainTable to HDF
 
@@ -285,7 +692,7 @@ def convert_hdf_to_gaintable(f):
     assert f.attrs['ARL_data_model'] == "GainTable", "Not a GainTable"
     receptor_frame = ReceptorFrame(f.attrs['receptor_frame'])
     frequency = numpy.array(f.attrs['frequency'])
-    data = numpy.array(f['data'])
+    data = convert_to_native_byteorder(numpy.array(f['data']))
     gt = GainTable(data=data, receptor_frame=receptor_frame, frequency=frequency)
     return gt
 
@@ -399,17 +806,23 @@ def import_skycomponent_from_hdf5(filename):
             return sclist
 
 
-def convert_image_to_hdf(im: Image, f):
+def convert_image_to_hdf(im: Image, f, facets=1, compression=None):
     """ Convert Image to HDF
 
+    The image is chunked by channel and polarisation plane, and within a plane by facets as for image_raster_iter.
+
     :param im: Image
     :param f: HDF root
+    :param facets: Number of facets per axis in each chunk
+    :param compression: Lossless compression: None, 'gzip' or 'lzf'
     :return:
     """
     assert isinstance(im, Image)
     
     f.attrs['ARL_data_model'] = 'Image'
-    f['data'] = im.data
+    ny, nx = im.data.shape[-2:]
+    chunks = (1,) * (im.data.ndim - 2) + (max(1, ny // facets), max(1, nx // facets))
+    create_hdf_dataset(f, 'data', im.data, chunks=chunks, compression=compression)
     f.attrs['wcs'] = numpy.string_(im.wcs.to_header_string())
     f.attrs['polarisation_frame'] = im.polarisation_frame.type
     return f
@@ -422,7 +835,7 @@ def convert_hdf_to_image(f):
     :return:
     """
     assert f.attrs['ARL_data_model'] == "Image", "Not an Image"
-    data = numpy.array(f['data'])
+    data = convert_to_native_byteorder(numpy.array(f['data']))
     polarisation_frame = PolarisationFrame(f.attrs['polarisation_frame'])
     wcs = WCS(f.attrs['wcs'])
     im = create_image_from_array(data, wcs=wcs,
@@ -430,11 +843,15 @@ def convert_hdf_to_image(f):
     return im
 
 
-def export_image_to_hdf5(im, filename):
+def export_image_to_hdf5(im, filename, facets=1, compression=None):
     """ Export an Image to HDF5 format
 
+    The data are chunked by channel and polarisation plane, and optionally by facet within a plane.
+
     :param im:
     :param filename:
+    :param facets: Number of facets per axis in each chunk
+    :param compression: Lossless compression with shuffle: None, 'gzip' or 'lzf'
     :return:
     """
     
@@ -445,7 +862,7 @@ def export_image_to_hdf5(im, filename):
         for i, m in enumerate(im):
             assert isinstance(m, Image)
             mf = f.create_group('Image%d' % i)
-            convert_image_to_hdf(m, mf)
+            convert_image_to_hdf(m, mf, facets=facets, compression=compression)
         f.flush()
         f.close()
 
@@ -24,6 +24,7 @@ The principle transitions between the data models:
 
 """
 
+import collections
 import logging
 import sys
 from copy import deepcopy
@@ -61,10 +62,10 @@ class Configuration:
         :param diameter:
         """
         if data is None and xyz is not None:
-            desc = [('names', '>U6'),
-                    ('xyz', '>f8', (3,)),
-                    ('diameter', '>f8'),
-                    ('mount', '>U5')]
+            desc = [('names', 'U6'),
+                    ('xyz', 'f8', (3,)),
+                    ('diameter', 'f8'),
+                    ('mount', 'U5')]
             nants = xyz.shape[0]
             if isinstance(names, str):
                 names = [names % ant for ant in range(nants)]
@@ -159,11 +160,11 @@ class GainTable:
             nants = gain.shape[1]
             nchan = gain.shape[2]
             assert len(frequency) == nchan, "Discrepancy in frequency channels"
-            desc = [('gain', '>c16', (nants, nchan, nrec, nrec)),
-                    ('weight', '>f8', (nants, nchan, nrec, nrec)),
-                    ('residual', '>f8', (nchan, nrec, nrec)),
-                    ('time', '>f8'),
-                    ('interval', '>f8')]
+            desc = [('gain', 'c16', (nants, nchan, nrec, nrec)),
+                    ('weight', 'f8', (nants, nchan, nrec, nrec)),
+                    ('residual', 'f8', (nchan, nrec, nrec)),
+                    ('time', 'f8'),
+                    ('interval', 'f8')]
             data = numpy.zeros(shape=[nrows], dtype=desc)
             data['gain'] = gain
             data['weight'] = weight
@@ -426,6 +427,75 @@ class SkyModel:
         return s
 
 
+class VisibilityColumns:
+    """ Columnar data for a Visibility
+
+    Each column of the Visibility is held as its own contiguous array instead of as a field of one numpy structured
+    array, so that e.g. uvw and vis are read with unit stride in gridding. The columns are accessed as for the
+    structured array: data['uvw'] is the uvw column, data[rows] selects rows, and data.dtype is the dtype of the
+    equivalent structured array. numpy.asarray(data) gives the structured array, as used for persistence.
+    """
+    
+    def __init__(self, data):
+        """ Columnar data
+
+        :param data: numpy structured array, VisibilityColumns, or dictionary of columns
+        """
+        if isinstance(data, VisibilityColumns):
+            data = data.columns
+        if isinstance(data, dict):
+            self.columns = collections.OrderedDict(data)
+        else:
+            self.columns = collections.OrderedDict((name, numpy.ascontiguousarray(data[name]))
+                                                   for name in data.dtype.names)
+    
+    def __len__(self):
+        return len(next(iter(self.columns.values())))
+    
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.columns[key]
+        return VisibilityColumns(collections.OrderedDict((name, column[key])
+                                                         for name, column in self.columns.items()))
+    
+    def __setitem__(self, key, value):
+        if isinstance(key, str):
+            self.columns[key][...] = value
+        else:
+            for name, column in self.columns.items():
+                column[key] = value[name]
+    
+    def __array__(self, dtype=None):
+        records = numpy.zeros([len(self)], dtype=self.dtype)
+        for name, column in self.columns.items():
+            records[name] = column
+        return records
+    
+    @property
+    def dtype(self):
+        return numpy.dtype([(name, column.dtype, column.shape[1:]) for name, column in self.columns.items()])
+    
+    @property
+    def shape(self):
+        return (len(self),)
+    
+    @property
+    def size(self):
+        return len(self)
+    
+    @property
+    def nbytes(self):
+        return sum([column.nbytes for column in self.columns.values()])
+    
+    def copy(self):
+        return VisibilityColumns(collections.OrderedDict((name, numpy.copy(column))
+                                                         for name, column in self.columns.items()))
+    
+    def setflags(self, write=None):
+        for column in self.columns.values():
+            column.setflags(write=write)
+
+
 class Visibility:
     """ Visibility table class
 
@@ -444,6 +514,9 @@ class Visibility:
     row in the original block visibility that this row has a value for. The original blockvisibility
     is also preserves as n attribute so that decoalescence is expedited. If you don't need that then
     the storage can be released by setting self.blockvis to None
+
+    If columnar is True, the columns are held as separate contiguous arrays in a VisibilityColumns, instead of
+    a numpy structured array. The properties uvw, vis, etc. are the same for both.
     """
     
     def __init__(self,
@@ -452,7 +525,7 @@ class Visibility:
                  time=None, antenna1=None, antenna2=None, vis=None,
                  weight=None, imaging_weight=None, integration_time=None,
                  polarisation_frame=PolarisationFrame('stokesI'), cindex=None,
-                 blockvis=None):
+                 blockvis=None, columnar=False):
         """Visibility
 
         :param data:
@@ -471,6 +544,7 @@ class Visibility:
         :param polarisation_frame:
         :param cindex:
         :param blockvis:
+        :param columnar: Hold the columns as separate arrays (False)
         """
         if data is None and vis is not None:
             if imaging_weight is None:
@@ -483,17 +557,17 @@ class Visibility:
             assert len(antenna2) == nvis
             
             npol = polarisation_frame.npol
-            desc = [('index', '>i8'),
-                    ('uvw', '>f8', (3,)),
-                    ('time', '>f8'),
-                    ('frequency', '>f8'),
-                    ('channel_bandwidth', '>f8'),
-                    ('integration_time', '>f8'),
-                    ('antenna1', '>i8'),
-                    ('antenna2', '>i8'),
-                    ('vis', '>c16', (npol,)),
-                    ('weight', '>f8', (npol,)),
-                    ('imaging_weight', '>f8', (npol,))]
+            desc = [('index', 'i8'),
+                    ('uvw', 'f8', (3,)),
+                    ('time', 'f8'),
+                    ('frequency', 'f8'),
+                    ('channel_bandwidth', 'f8'),
+                    ('integration_time', 'f8'),
+                    ('antenna1', 'i8'),
+                    ('antenna2', 'i8'),
+                    ('vis', 'c16', (npol,)),
+                    ('weight', 'f8', (npol,)),
+                    ('imaging_weight', 'f8', (npol,))]
             data = numpy.zeros(shape=[nvis], dtype=desc)
             data['index'] = list(range(nvis))
             data['uvw'] = uvw
@@ -507,7 +581,10 @@ class Visibility:
             data['weight'] = weight
             data['imaging_weight'] = imaging_weight
         
-        self.data = data  # numpy structured array
+        if columnar and data is not None:
+            data = VisibilityColumns(data)
+        
+        self.data = data  # numpy structured array or VisibilityColumns
         self.cindex = cindex
         self.blockvis = blockvis
         self.phasecentre = phasecentre  # Phase centre of observation
@@ -617,6 +694,10 @@ class BlockVisibility:
     Polarisation frame is the same for the entire data set and can be stokesI, circular, linear
     
     The configuration is also an attribute
+
+    The vis and weight are usually a dense block [ntimes, nants, nants, nchan, npol], with uvw [ntimes, nants,
+    nants, 3]. If vis has shape [ntimes, nbaselines, nchan, npol] then the BlockVisibility is compact: only the
+    baselines a1 < a2 are kept, in the order of numpy.triu_indices(nants, 1), with uvw [ntimes, nbaselines, 3].
     """
     
     def __init__(self,
@@ -639,16 +720,17 @@ class BlockVisibility:
         :param polarisation_frame:
         """
         if data is None and vis is not None:
-            ntimes, nants, _, nchan, npol = vis.shape
+            ntimes, nchan, npol = vis.shape[0], vis.shape[-2], vis.shape[-1]
+            baselines = vis.shape[1:-2]
             assert vis.shape == weight.shape
             assert len(frequency) == nchan
             assert len(channel_bandwidth) == nchan
-            desc = [('index', '>i8'),
-                    ('uvw', '>f8', (nants, nants, 3)),
-                    ('time', '>f8'),
-                    ('integration_time', '>f8'),
-                    ('vis', '>c16', (nants, nants, nchan, npol)),
-                    ('weight', '>f8', (nants, nants, nchan, npol))]
+            desc = [('index', 'i8'),
+                    ('uvw', 'f8', baselines + (3,)),
+                    ('time', 'f8'),
+                    ('integration_time', 'f8'),
+                    ('vis', 'c16', baselines + (nchan, npol)),
+                    ('weight', 'f8', baselines + (nchan, npol))]
             data = numpy.zeros(shape=[ntimes], dtype=desc)
             data['index'] = list(range(ntimes))
             data['uvw'] = uvw
@@ -688,18 +770,30 @@ class BlockVisibility:
             size += self.data[col].nbytes
         return size / 1024.0 / 1024.0 / 1024.0
     
+    @property
+    def compact(self):
+        return self.data['vis'].ndim == 4
+    
     @property
     def nchan(self):
-        return self.data['vis'].shape[3]
+        return self.data['vis'].shape[-2]
     
     @property
     def npol(self):
-        return self.data['vis'].shape[4]
+        return self.data['vis'].shape[-1]
     
     @property
     def nants(self):
+        if self.compact:
+            return int(round(0.5 + numpy.sqrt(0.25 + 2 * self.nbaselines)))
         return self.data['vis'].shape[1]
     
+    @property
+    def nbaselines(self):
+        if self.compact:
+            return self.data['vis'].shape[1]
+        return self.nants * (self.nants - 1) // 2
+    
     @property
     def uvw(self):  # In wavelengths meters
         return self.data['uvw']
@@ -21,21 +21,37 @@ from data_models.memory_data_models import GainTable
 log = logging.getLogger(__name__)
 
 
-def solve_from_X(gt: GainTable, x: numpy.ndarray, xwt: numpy.ndarray, chunk, crosspol, niter, phase_only, tol, npol) \
-        -> GainTable:
+def solve_from_X(gt: GainTable, x: numpy.ndarray, xwt: numpy.ndarray, chunk, crosspol, niter, phase_only, tol, npol,
+                 solver='antsol') -> GainTable:
     """ Solve for gains from the point source equivalents
 
+    Several solution intervals may be solved at once by giving a sequence of chunks, in which case
+    x and xwt have a leading axis of the same length.
+
+    The solver may be 'antsol' (iterative substitution) or 'stefcal'. StefCal solves only for scalar
+    or diagonal gains i.e. not with crosspol.
+
     :param gt:
-    :param x: point source visibility
+    :param x: point source visibility [nants, nants, nchan, npol] or [nchunks, nants, nants, nchan, npol]
     :param xwt: point source weight
-    :param chunk: which chunk of the gaintable?
+    :param chunk: which chunk of the gaintable? An int or a sequence of ints
     :param crosspol:
     :param niter:
     :param phase_only:
     :param tol:
     :param npol:
+    :param solver: 'antsol' or 'stefcal'
     :return:
     """
+    if solver == 'stefcal':
+        assert not crosspol, "StefCal cannot solve for cross polarisation gains"
+        gt.data['gain'][chunk, ...], gt.data['weight'][chunk, ...], gt.data['residual'][chunk, ...] = \
+            solve_antenna_gains_stefcal(gt.data['gain'][chunk, ...], gt.data['weight'][chunk, ...],
+                                        x, xwt, phase_only=phase_only, niter=niter, tol=tol)
+        return gt
+    elif solver != 'antsol':
+        raise ValueError("Unknown gain solver %s" % solver)
+    
     if npol > 1:
         if crosspol:
             gt.data['gain'][chunk, ...], gt.data['weight'][chunk, ...], gt.data['residual'][chunk, ...] = \
@@ -65,10 +81,13 @@ def solve_antenna_gains_itsubs_scalar(gain, gwt, x, xwt, niter=30, tol=1e-8, pha
     D'Addario c 1980'ish (see ThompsonDaddario1982 Appendix 1). Used
     in the original VLA Dec-10 Antsol.
 
-    :param gain: gains
+    All the arrays may have a leading axis of solution intervals, in which case the intervals are
+    iterated together, each until its own solution has converged.
+
+    :param gain: gains [nants, ...] or [ntimes, nants, ...]
     :param gwt: gain weight
-    :param x: Equivalent point source visibility[nants, nants, ...]
-    :param xwt: Equivalent point source weight [nants, nants, ...]
+    :param x: Equivalent point source visibility[nants, nants, ...] or [ntimes, nants, nants, ...]
+    :param xwt: Equivalent point source weight [nants, nants, ...] or [ntimes, nants, nants, ...]
     :param niter: Number of iterations
     :param tol: tolerance on solution change
     :param phase_only: Do solution for only the phase? (default True)
@@ -77,49 +96,108 @@ def solve_antenna_gains_itsubs_scalar(gain, gwt, x, xwt, niter=30, tol=1e-8, pha
 
     """
     
-    nants = x.shape[0]
-    for ant1 in range(nants):
-        x[ant1, ant1, ...] = 0.0
-        xwt[ant1, ant1, ...] = 0.0
-        for ant2 in range(ant1 + 1, nants):
-            x[ant1, ant2, ...] = numpy.conjugate(x[ant2, ant1, ...])
-            xwt[ant1, ant2, ...] = xwt[ant2, ant1, ...]
+    batched = gain.ndim == 5
+    if not batched:
+        gain, gwt, x, xwt = gain[numpy.newaxis], gwt[numpy.newaxis], x[numpy.newaxis], xwt[numpy.newaxis]
+    gain, gwt = gain.copy(), gwt.copy()
     
+    ntimes = x.shape[0]
+    symmetrise_point_source(x, xwt)
+    
+    # The solution intervals that have not yet converged
+    active = numpy.arange(ntimes)
     for iter in range(niter):
-        gainLast = gain
-        gain, gwt = gain_substitution_scalar(gain, x, xwt)
-        mask = numpy.abs(gain) > 0.0
+        gainLast = gain[active]
+        newgain, newgwt = gain_substitution_scalar(gainLast, *select_intervals(active, ntimes, x, xwt))
+        mask = numpy.abs(newgain) > 0.0
         if phase_only:
-            gain[mask] = gain[mask] / numpy.abs(gain[mask])
-        angles = numpy.angle(gain)
-        gain *= numpy.exp(-1j * angles)[refant, ...]
-        gain = 0.5 * (gain + gainLast)
-        change = numpy.max(numpy.abs(gain - gainLast))
-        if change < tol:
-            return gain, gwt, solution_residual_scalar(gain, x, xwt)
+            newgain[mask] = newgain[mask] / numpy.abs(newgain[mask])
+        angles = numpy.angle(newgain)
+        newgain *= numpy.exp(-1j * angles)[:, refant, numpy.newaxis, ...]
+        newgain = 0.5 * (newgain + gainLast)
+        change = interval_change(newgain, gainLast)
+        gain[active], gwt[active] = newgain, newgwt
+        active = active[~(change < tol)]
+        if len(active) == 0:
+            break
     
-    return gain, gwt, solution_residual_scalar(gain, x, xwt)
+    residual = solution_residual_scalar(gain, x, xwt)
+    if not batched:
+        return gain[0], gwt[0], residual[0]
+    return gain, gwt, residual
+
+
+def symmetrise_point_source(x, xwt):
+    """ Fill in the point source visibility for the reversed baselines, in place
+
+    The autocorrelations are zeroed and x[:, ant1, ant2] = conj(x[:, ant2, ant1]) for ant1 < ant2.
+
+    :param x: Equivalent point source visibility [ntimes, nants, nants, ...]
+    :param xwt: Equivalent point source weight [ntimes, nants, nants, ...]
+    """
+    nants = x.shape[1]
+    ant = numpy.arange(nants)
+    x[:, ant, ant, ...] = 0.0
+    xwt[:, ant, ant, ...] = 0.0
+    ant1, ant2 = numpy.triu_indices(nants, 1)
+    x[:, ant1, ant2, ...] = numpy.conjugate(x[:, ant2, ant1, ...])
+    xwt[:, ant1, ant2, ...] = xwt[:, ant2, ant1, ...]
+
+
+def select_intervals(active, ntimes, *arrays):
+    """ Select the active solution intervals from arrays with a leading interval axis
+
+    The arrays are returned unchanged (and uncopied) if all intervals are active.
+
+    :param active: Indices of the active intervals
+    :param ntimes: Total number of intervals
+    :param arrays: Arrays [ntimes, ...]
+    :return: list of arrays [len(active), ...]
+    """
+    if len(active) == ntimes:
+        return list(arrays)
+    return [array[active] for array in arrays]
+
+
+def interval_change(gain, gainLast, relative=False):
+    """ Change in gain for each solution interval
+
+    The change is the maximum absolute change or, if relative, the norm of the change divided
+    by the norm of the gain.
+
+    :param gain: gain [ntimes, ...]
+    :param gainLast: previous gain [ntimes, ...]
+    :param relative: Return the fractional change in the norm of the gains
+    :return: change [ntimes]
+    """
+    diff = numpy.abs(gain - gainLast).reshape(gain.shape[0], -1)
+    if not relative:
+        return numpy.max(diff, axis=1)
+    norm = numpy.sqrt(numpy.sum(numpy.abs(gain.reshape(gain.shape[0], -1)) ** 2, axis=1))
+    change = numpy.sqrt(numpy.sum(diff ** 2, axis=1))
+    change[norm > 0.0] /= norm[norm > 0.0]
+    return change
 
 
 def gain_substitution_scalar(gain, x, xwt):
-    nants, nchan, nrec, _ = gain.shape
+    ntimes, nants, nchan, nrec, _ = gain.shape
     newgain = numpy.ones_like(gain, dtype='complex')
     gwt = numpy.zeros_like(gain, dtype='float')
     
-    x = x.reshape(nants, nants, nchan, nrec, nrec)
-    xwt = xwt.reshape(nants, nants, nchan, nrec, nrec)
-    
-    for ant1 in range(nants):
-        top = numpy.sum(x[:, ant1, :, 0, 0] * gain[:, :, 0, 0] * xwt[:, ant1, :, 0, 0], axis=0)
-        bot = numpy.sum((gain[:, :, 0, 0] * numpy.conjugate(gain[:, :, 0, 0]) *
-                         xwt[:, ant1, :, 0, 0]).real, axis=0)
-        
-        if bot.all() > 0.0:
-            newgain[ant1, :, 0, 0] = top / bot
-            gwt[ant1, :, 0, 0] = bot
-        else:
-            newgain[ant1, :, 0, 0] = 0.0
-            gwt[ant1, :, 0, 0] = 0.0
+    x = x.reshape(ntimes, nants, nants, nchan, nrec, nrec)
+    xwt = xwt.reshape(ntimes, nants, nants, nchan, nrec, nrec)
+    
+    # Sum over antenna2 for all antenna1 at once: x and xwt are indexed [time, ant2, ant1, chan]
+    g = gain[..., 0, 0]
+    top = numpy.einsum('tbac,tbc->tac', x[..., 0, 0] * xwt[..., 0, 0], g)
+    bot = numpy.einsum('tbac,tbc->tac', xwt[..., 0, 0], (g * numpy.conjugate(g)).real)
+    
+    # An antenna is only solved if it has weight in every channel
+    valid = numpy.all(bot > 0.0, axis=-1)
+    newgain[valid, :, 0, 0] = top[valid] / bot[valid]
+    gwt[valid, :, 0, 0] = bot[valid]
+    newgain[~valid, :, 0, 0] = 0.0
+    gwt[~valid, :, 0, 0] = 0.0
     return newgain, gwt
 
 
@@ -134,10 +212,13 @@ def solve_antenna_gains_itsubs_vector(gain, gwt, x, xwt, niter=30, tol=1e-8, pha
     scalar self-calibration: Self-alignment, dynamic range and polarimetric fidelity,” Astronomy
     and Astrophysics Supplement Series, vol. 143, no. 3, pp. 515–534, May 2000.
 
-    :param gain: gains
+    All the arrays may have a leading axis of solution intervals, in which case the intervals are
+    iterated together, each until its own solution has converged.
+
+    :param gain: gains [nants, ...] or [ntimes, nants, ...]
     :param gwt: gain weight
-    :param x: Equivalent point source visibility[nants, nants, ...]
-    :param xwt: Equivalent point source weight [nants, nants, ...]
+    :param x: Equivalent point source visibility[nants, nants, ...] or [ntimes, nants, nants, ...]
+    :param xwt: Equivalent point source weight [nants, nants, ...] or [ntimes, nants, nants, ...]
     :param niter: Number of iterations
     :param tol: tolerance on solution change
     :param phase_only: Do solution for only the phase? (default True)
@@ -145,40 +226,48 @@ def solve_antenna_gains_itsubs_vector(gain, gwt, x, xwt, niter=30, tol=1e-8, pha
     :return: gain [nants, ...], weight [nants, ...]
     """
     
-    nants, _, nchan, npol = x.shape
+    batched = gain.ndim == 5
+    if not batched:
+        gain, gwt, x, xwt = gain[numpy.newaxis], gwt[numpy.newaxis], x[numpy.newaxis], xwt[numpy.newaxis]
+    gain, gwt = gain.copy(), gwt.copy()
+    
+    ntimes, nants, _, nchan, npol = x.shape
     assert npol == 4
-    newshape = (nants, nants, nchan, 2, 2)
+    newshape = (ntimes, nants, nants, nchan, 2, 2)
     x = x.reshape(newshape)
     xwt = xwt.reshape(newshape)
     
-    for ant1 in range(nants):
-        x[ant1, ant1, ...] = 0.0
-        xwt[ant1, ant1, ...] = 0.0
-        for ant2 in range(ant1 + 1, nants):
-            x[ant1, ant2, ...] = numpy.conjugate(x[ant2, ant1, ...])
-            xwt[ant1, ant2, ...] = xwt[ant2, ant1, ...]
+    symmetrise_point_source(x, xwt)
     
     gain[..., 0, 1] = 0.0
     gain[..., 1, 0] = 0.0
     
+    # The solution intervals that have not yet converged
+    active = numpy.arange(ntimes)
     for iter in range(niter):
-        gainLast = gain
-        gain, gwt = gain_substitution_vector(gain, x, xwt)
+        gainLast = gain[active]
+        newgain, newgwt = gain_substitution_vector(gainLast, *select_intervals(active, ntimes, x, xwt))
         for rec in [0, 1]:
-            gain[..., rec, 1 - rec] = 0.0
+            newgain[..., rec, 1 - rec] = 0.0
             if phase_only:
-                gain[..., rec, rec] = gain[..., rec, rec] / numpy.abs(gain[..., rec, rec])
-            gain[..., rec, rec] *= numpy.conjugate(gain[refant, ..., rec, rec]) / numpy.abs(gain[refant, ..., rec, rec])
-        change = numpy.max(numpy.abs(gain - gainLast))
-        gain = 0.5 * (gain + gainLast)
-        if change < tol:
-            return gain, gwt, solution_residual_vector(gain, x, xwt)
-    
-    return gain, gwt, solution_residual_vector(gain, x, xwt)
+                newgain[..., rec, rec] = newgain[..., rec, rec] / numpy.abs(newgain[..., rec, rec])
+            refgain = newgain[:, refant, numpy.newaxis, ..., rec, rec]
+            newgain[..., rec, rec] *= numpy.conjugate(refgain) / numpy.abs(refgain)
+        change = interval_change(newgain, gainLast)
+        newgain = 0.5 * (newgain + gainLast)
+        gain[active], gwt[active] = newgain, newgwt
+        active = active[~(change < tol)]
+        if len(active) == 0:
+            break
+    
+    residual = solution_residual_vector(gain, x, xwt)
+    if not batched:
+        return gain[0], gwt[0], residual[0]
+    return gain, gwt, residual
 
 
 def gain_substitution_vector(gain, x, xwt):
-    nants, nchan, nrec, _ = gain.shape
+    ntimes, nants, nchan, nrec, _ = gain.shape
     newgain = numpy.ones_like(gain, dtype='complex')
     if nrec > 0:
         newgain[..., 0, 1] = 0.0
@@ -188,28 +277,27 @@ def gain_substitution_vector(gain, x, xwt):
     
     # We are going to work with Jones 2x2 matrix formalism so everything has to be
     # converted to that format
-    x = x.reshape(nants, nants, nchan, nrec, nrec)
-    xwt = xwt.reshape(nants, nants, nchan, nrec, nrec)
+    x = x.reshape(ntimes, nants, nants, nchan, nrec, nrec)
+    xwt = xwt.reshape(ntimes, nants, nants, nchan, nrec, nrec)
     
     if nrec > 0:
         gain[..., 0, 1] = 0.0
         gain[..., 1, 0] = 0.0
     
-    for ant1 in range(nants):
-        for chan in range(nchan):
-            # Loop over e.g. 'RR', 'LL, or 'xx', 'YY' ignoring cross terms
-            for rec in range(nrec):
-                top = numpy.sum(x[:, ant1, chan, rec, rec] *
-                                gain[:, chan, rec, rec] * xwt[:, ant1, chan, rec, rec], axis=0)
-                bot = numpy.sum((gain[:, chan, rec, rec] * numpy.conjugate(gain[:, chan, rec, rec]) *
-                                 xwt[:, ant1, chan, rec, rec]).real, axis=0)
-                
-                if bot > 0.0:
-                    newgain[ant1, chan, rec, rec] = top / bot
-                    gwt[ant1, chan, rec, rec] = bot
-                else:
-                    newgain[ant1, chan, rec, rec] = 0.0
-                    gwt[ant1, chan, rec, rec] = 0.0
+    # Use only e.g. 'RR', 'LL, or 'xx', 'YY' ignoring cross terms
+    rec = numpy.arange(nrec)
+    g = gain[..., rec, rec]
+    xwtd = xwt[..., rec, rec]
+    
+    # Sum over antenna2 for all antenna1, channels and receptors at once
+    top = numpy.einsum('tbacr,tbcr->tacr', x[..., rec, rec] * xwtd, g)
+    bot = numpy.einsum('tbacr,tbcr->tacr', xwtd, (g * numpy.conjugate(g)).real)
+    
+    valid = bot > 0.0
+    newdiag = numpy.zeros_like(top)
+    newdiag[valid] = top[valid] / bot[valid]
+    newgain[..., rec, rec] = newdiag
+    gwt[..., rec, rec] = numpy.where(valid, bot, 0.0)
     
     return newgain, gwt
 
@@ -225,10 +313,13 @@ def solve_antenna_gains_itsubs_matrix(gain, gwt, x, xwt, niter=30, tol=1e-8, pha
     scalar self-calibration: Self-alignment, dynamic range and polarimetric fidelity,” Astronomy
     and Astrophysics Supplement Series, vol. 143, no. 3, pp. 515–534, May 2000.
 
-    :param gain: gains
+    All the arrays may have a leading axis of solution intervals, in which case the intervals are
+    iterated together, each until its own solution has converged.
+
+    :param gain: gains [nants, ...] or [ntimes, nants, ...]
     :param gwt: gain weight
-    :param x: Equivalent point source visibility[nants, nants, ...]
-    :param xwt: Equivalent point source weight [nants, nants, ...]
+    :param x: Equivalent point source visibility[nants, nants, ...] or [ntimes, nants, nants, ...]
+    :param xwt: Equivalent point source weight [nants, nants, ...] or [ntimes, nants, nants, ...]
     :param niter: Number of iterations
     :param tol: tolerance on solution change
     :param phase_only: Do solution for only the phase? (default True)
@@ -236,94 +327,173 @@ def solve_antenna_gains_itsubs_matrix(gain, gwt, x, xwt, niter=30, tol=1e-8, pha
     :return: gain [nants, ...], weight [nants, ...]
     """
     
-    nants, _, nchan, npol = x.shape
+    batched = gain.ndim == 5
+    if not batched:
+        gain, gwt, x, xwt = gain[numpy.newaxis], gwt[numpy.newaxis], x[numpy.newaxis], xwt[numpy.newaxis]
+    gain, gwt = gain.copy(), gwt.copy()
+    
+    ntimes, nants, _, nchan, npol = x.shape
     assert npol == 4
-    newshape = (nants, nants, nchan, 2, 2)
+    newshape = (ntimes, nants, nants, nchan, 2, 2)
     x = x.reshape(newshape)
     xwt = xwt.reshape(newshape)
     
-    for ant1 in range(nants):
-        x[ant1, ant1, ...] = 0.0
-        xwt[ant1, ant1, ...] = 0.0
-        for ant2 in range(ant1 + 1, nants):
-            x[ant1, ant2, ...] = numpy.conjugate(x[ant2, ant1, ...])
-            xwt[ant1, ant2, ...] = xwt[ant2, ant1, ...]
+    symmetrise_point_source(x, xwt)
     
     gain[..., 0, 1] = 0.0
     gain[..., 1, 0] = 0.0
     
+    # The solution intervals that have not yet converged
+    active = numpy.arange(ntimes)
     for iter in range(niter):
-        gainLast = gain
-        gain, gwt = gain_substitution_matrix(gain, x, xwt)
+        gainLast = gain[active]
+        newgain, newgwt = gain_substitution_matrix(gainLast, *select_intervals(active, ntimes, x, xwt))
         if phase_only:
-            gain = gain / numpy.abs(gain)
-        change = numpy.max(numpy.abs(gain - gainLast))
-        gain = 0.5 * (gain + gainLast)
-        if change < tol:
-            return gain, gwt, solution_residual_matrix(gain, x, xwt)
+            newgain = newgain / numpy.abs(newgain)
+        change = interval_change(newgain, gainLast)
+        newgain = 0.5 * (newgain + gainLast)
+        gain[active], gwt[active] = newgain, newgwt
+        active = active[~(change < tol)]
+        if len(active) == 0:
+            break
     
-    return gain, gwt, solution_residual_matrix(gain, x, xwt)
+    residual = solution_residual_matrix(gain, x, xwt)
+    if not batched:
+        return gain[0], gwt[0], residual[0]
+    return gain, gwt, residual
 
 
 def gain_substitution_matrix(gain, x, xwt):
-    nants, nchan, nrec, _ = gain.shape
+    ntimes, nants, nchan, nrec, _ = gain.shape
     newgain = numpy.ones_like(gain, dtype='complex')
     gwt = numpy.zeros_like(gain, dtype='float')
     
     # We are going to work with Jones 2x2 matrix formalism so everything has to be
     # converted to that format
-    x = x.reshape(nants, nants, nchan, nrec, nrec)
-    xwt = xwt.reshape(nants, nants, nchan, nrec, nrec)
-    
-    # Write these loops out explicitly. Derivation of these vector equations is tedious but they are
-    # structurally identical to the scalar case with the following changes
-    # Vis -> 2x2 coherency vector, g-> 2x2 Jones matrix, *-> matmul, conjugate->Hermitean transpose (.H)
-    for ant1 in range(nants):
-        for chan in range(nchan):
-            top = 0.0
-            bot = 0.0
-            for ant2 in range(nants):
-                if ant1 != ant2:
-                    xmat = x[ant2, ant1, chan]
-                    xwtmat = xwt[ant2, ant1, chan]
-                    g2 = gain[ant2, chan]
-                    top += xmat * xwtmat * g2
-                    bot += numpy.conjugate(g2) * xwtmat * g2
-            newgain[ant1, chan][bot > 0.0] = top[bot > 0.0] / bot[bot > 0.0]
-            newgain[ant1, chan][bot <= 0.0] = 0.0
-            gwt[ant1, chan] = bot.real
+    x = x.reshape(ntimes, nants, nants, nchan, nrec, nrec)
+    xwt = xwt.reshape(ntimes, nants, nants, nchan, nrec, nrec)
+    
+    # The update is structurally identical to the scalar case, applied to each element of the
+    # 2x2 Jones matrix. The sums over antenna2 are formed for all antenna1, channels and Jones
+    # elements at once: x and xwt are indexed [time, ant2, ant1, chan, rec, rec]
+    gsq = (gain * numpy.conjugate(gain)).real
+    top = numpy.einsum('tbacij,tbcij->tacij', x * xwt, gain)
+    bot = numpy.einsum('tbacij,tbcij->tacij', xwt, gsq)
+    
+    # Exclude the terms with antenna2 == antenna1
+    ant = numpy.arange(nants)
+    top -= x[:, ant, ant] * xwt[:, ant, ant] * gain
+    bot -= xwt[:, ant, ant] * gsq
+    
+    valid = bot > 0.0
+    newgain[valid] = top[valid] / bot[valid]
+    newgain[~valid] = 0.0
+    gwt[...] = bot
     return newgain, gwt
 
 
+def solve_antenna_gains_stefcal(gain, gwt, x, xwt, niter=30, tol=1e-8, phase_only=True, refant=0):
+    """Solve for the scalar or diagonal antenna gains using StefCal
+
+    x(antenna2, antenna1) = gain(antenna1) conj(gain(antenna2))
+
+    Each iteration is the same weighted least squares update of every antenna gain, with the other
+    gains held fixed, as used in Antsol. Following StefCal, the new gains are averaged with the
+    previous ones only on every second iteration, which converges in far fewer iterations. The
+    phases are referred to the reference antenna once converged.
+
+    See S. Salvini and S. J. Wijnholds, “Fast gain calibration in radio astronomy using alternating
+    direction implicit methods: Analysis and applications,” Astronomy and Astrophysics, vol. 571,
+    A97, 2014.
+
+    All the arrays may have a leading axis of solution intervals, in which case the intervals are
+    iterated together, each until its own solution has converged.
+
+    :param gain: gains [nants, ...] or [ntimes, nants, ...]
+    :param gwt: gain weight
+    :param x: Equivalent point source visibility[nants, nants, ...] or [ntimes, nants, nants, ...]
+    :param xwt: Equivalent point source weight [nants, nants, ...] or [ntimes, nants, nants, ...]
+    :param niter: Maximum number of iterations
+    :param tol: tolerance on the fractional solution change
+    :param phase_only: Do solution for only the phase? (default True)
+    :param refant: Reference antenna for phase (default=0.0)
+    :return: gain [nants, ...], weight [nants, ...]
+    """
+    
+    batched = gain.ndim == 5
+    if not batched:
+        gain, gwt, x, xwt = gain[numpy.newaxis], gwt[numpy.newaxis], x[numpy.newaxis], xwt[numpy.newaxis]
+    gain, gwt = gain.copy(), gwt.copy()
+    
+    ntimes, nants, nchan, nrec, _ = gain.shape
+    newshape = (ntimes, nants, nants, nchan, nrec, nrec)
+    x = x.reshape(newshape)
+    xwt = xwt.reshape(newshape)
+    symmetrise_point_source(x, xwt)
+    
+    if nrec > 1:
+        gain_substitution = gain_substitution_vector
+        residual_function = solution_residual_vector
+    else:
+        gain_substitution = gain_substitution_scalar
+        residual_function = solution_residual_scalar
+    
+    rec = numpy.arange(nrec)
+    diagonal = numpy.zeros([nrec, nrec], dtype='bool')
+    diagonal[rec, rec] = True
+    gain[..., ~diagonal] = 0.0
+    
+    # The solution intervals that have not yet converged
+    active = numpy.arange(ntimes)
+    for iter in range(niter):
+        gainLast = gain[active]
+        newgain, newgwt = gain_substitution(gainLast, *select_intervals(active, ntimes, x, xwt))
+        if phase_only:
+            mask = numpy.abs(newgain) > 0.0
+            newgain[mask] = newgain[mask] / numpy.abs(newgain[mask])
+        if iter % 2 == 1:
+            newgain = 0.5 * (newgain + gainLast)
+        change = interval_change(newgain, gainLast, relative=True)
+        gain[active], gwt[active] = newgain, newgwt
+        active = active[~(change < tol)]
+        if len(active) == 0:
+            break
+    
+    # Refer the phases to the reference antenna
+    refgain = gain[:, refant][:, numpy.newaxis][..., rec, rec]
+    refabs = numpy.abs(refgain)
+    refphasor = numpy.ones_like(refgain)
+    refphasor[refabs > 0.0] = numpy.conjugate(refgain[refabs > 0.0]) / refabs[refabs > 0.0]
+    gain[..., rec, rec] *= refphasor
+    
+    residual = residual_function(gain, x, xwt)
+    if not batched:
+        return gain[0], gwt[0], residual[0]
+    return gain, gwt, residual
+
+
 def solution_residual_scalar(gain, x, xwt):
     """Calculate residual across all baselines of gain for point source equivalent visibilities
     
-    :param gain: gain [nant, ...]
-    :param x: Point source equivalent visibility [nant, ...]
-    :param xwt: Point source equivalent weight [nant, ...]
-    :return: residual[...]
+    :param gain: gain [ntimes, nant, ...]
+    :param x: Point source equivalent visibility [ntimes, nant, ...]
+    :param xwt: Point source equivalent weight [ntimes, nant, ...]
+    :return: residual[ntimes, ...]
     """
     
-    nants, nchan, nrec, _ = gain.shape
-    x = x.reshape(nants, nants, nchan, nrec, nrec)
-    
-    xwt = xwt.reshape(nants, nants, nchan, nrec, nrec)
+    ntimes, nants, nchan, nrec, _ = gain.shape
+    x = x.reshape(ntimes, nants, nants, nchan, nrec, nrec)[..., 0, 0]
+    xwt = xwt.reshape(ntimes, nants, nants, nchan, nrec, nrec)[..., 0, 0]
     
-    residual = numpy.zeros([nchan, nrec, nrec])
-    sumwt = numpy.zeros([nchan, nrec, nrec])
+    # error[:, ant2, ant1, chan] = x[:, ant2, ant1, chan] - gain[:, ant1, chan] * conj(gain[:, ant2, chan])
+    g = gain[..., 0, 0]
+    error = x - g[:, numpy.newaxis, ...] * numpy.conjugate(g[:, :, numpy.newaxis, ...])
     
-    for ant1 in range(nants):
-        for ant2 in range(nants):
-            for chan in range(nchan):
-                error = x[ant2, ant1, chan, 0, 0] - \
-                    gain[ant1, chan, 0, 0] * numpy.conjugate(gain[ant2, chan, 0, 0])
-                residual += (error * xwt[ant2, ant1, chan, 0, 0] * numpy.conjugate(error)).real
-                sumwt += xwt[ant2, ant1, chan, 0, 0]
+    # The residual is summed over all antennas and channels
+    residual = numpy.sum((error * xwt * numpy.conjugate(error)).real, axis=(1, 2, 3))
+    sumwt = numpy.sum(xwt, axis=(1, 2, 3))
     
-    residual[sumwt > 0.0] = numpy.sqrt(residual[sumwt > 0.0] / sumwt[sumwt > 0.0])
-    residual[sumwt <= 0.0] = 0.0
-    
-    return residual
+    return broadcast_residual(residual, sumwt, [ntimes, nchan, nrec, nrec])
 
 
 def solution_residual_vector(gain, x, xwt):
@@ -331,66 +501,68 @@ def solution_residual_vector(gain, x, xwt):
     
     Vector case i.e. off-diagonals of gains are zero
 
-    :param gain: gain [nant, ...]
-    :param x: Point source equivalent visibility [nant, ...]
-    :param xwt: Point source equivalent weight [nant, ...]
-    :return: residual[...]
+    :param gain: gain [ntimes, nant, ...]
+    :param x: Point source equivalent visibility [ntimes, nant, ...]
+    :param xwt: Point source equivalent weight [ntimes, nant, ...]
+    :return: residual[ntimes, ...]
     """
     
-    nants, nchan, nrec, _ = gain.shape
-    x = x.reshape(nants, nants, nchan, nrec, nrec)
+    ntimes, nants, nchan, nrec, _ = gain.shape
+    x = x.reshape(ntimes, nants, nants, nchan, nrec, nrec)
     x[..., 1, 0] = 0.0
     x[..., 0, 1] = 0.0
     
-    xwt = xwt.reshape(nants, nants, nchan, nrec, nrec)
+    xwt = xwt.reshape(ntimes, nants, nants, nchan, nrec, nrec)
     xwt[..., 1, 0] = 0.0
     xwt[..., 0, 1] = 0.0
     
-    residual = numpy.zeros([nchan, nrec, nrec])
-    sumwt = numpy.zeros([nchan, nrec, nrec])
+    # Only the parallel hands i.e. the diagonals of the Jones matrices
+    rec = numpy.arange(nrec)
+    x = x[..., rec, rec]
+    xwt = xwt[..., rec, rec]
+    g = gain[..., rec, rec]
+    error = x - g[:, numpy.newaxis, ...] * numpy.conjugate(g[:, :, numpy.newaxis, ...])
     
-    for ant1 in range(nants):
-        for ant2 in range(nants):
-            for chan in range(nchan):
-                for rec in range(nrec):
-                    error = x[ant2, ant1, chan, rec, rec] - \
-                        gain[ant1, chan, rec, rec] * numpy.conjugate(gain[ant2, chan, rec, rec])
-                    residual += (error * xwt[ant2, ant1, chan, rec, rec] * numpy.conjugate(error)).real
-                    sumwt += xwt[ant2, ant1, chan, rec, rec]
+    # The residual is summed over all antennas, channels and receptors
+    residual = numpy.sum((error * xwt * numpy.conjugate(error)).real, axis=(1, 2, 3, 4))
+    sumwt = numpy.sum(xwt, axis=(1, 2, 3, 4))
     
-    residual[sumwt > 0.0] = numpy.sqrt(residual[sumwt > 0.0] / sumwt[sumwt > 0.0])
-    residual[sumwt <= 0.0] = 0.0
-    
-    return residual
+    return broadcast_residual(residual, sumwt, [ntimes, nchan, nrec, nrec])
 
 
 def solution_residual_matrix(gain, x, xwt):
     """Calculate residual across all baselines of gain for point source equivalent visibilities
 
-    :param gain: gain [nant, ...]
-    :param x: Point source equivalent visibility [nant, ...]
-    :param xwt: Point source equivalent weight [nant, ...]
-    :return: residual[...]
+    :param gain: gain [ntimes, nant, ...]
+    :param x: Point source equivalent visibility [ntimes, nant, ...]
+    :param xwt: Point source equivalent weight [ntimes, nant, ...]
+    :return: residual[ntimes, ...]
     """
     
-    nants, _, nchan, nrec, _ = x.shape
+    ntimes, nants, nchan, nrec, _ = gain.shape
+    x = x.reshape(ntimes, nants, nants, nchan, nrec, nrec)
+    xwt = xwt.reshape(ntimes, nants, nants, nchan, nrec, nrec)
     
-    residual = numpy.zeros([nchan, nrec, nrec])
-    sumwt = numpy.zeros([nchan, nrec, nrec])
+    error = x - gain[:, numpy.newaxis, ...] * numpy.conjugate(gain[:, :, numpy.newaxis, ...])
     
-    # This is written out in long winded form but should be optimised for
-    # production code!
-    for ant1 in range(nants):
-        for ant2 in range(nants):
-            for chan in range(nchan):
-                for rec1 in range(nrec):
-                    for rec2 in range(nrec):
-                        error = x[ant2, ant1, chan, rec2, rec1] - \
-                            gain[ant1, chan, rec2, rec1] * numpy.conjugate(gain[ant2, chan, rec2, rec1])
-                        residual[chan, rec2, rec1] += (error * xwt[ant2, ant1, chan, rec2, rec1] * numpy.conjugate(
-                            error)).real
-                        sumwt[chan, rec2, rec1] += xwt[ant2, ant1, chan, rec2, rec1]
+    # The residual is summed over all antennas, separately for each channel and polarisation
+    residual = numpy.sum((error * xwt * numpy.conjugate(error)).real, axis=(1, 2))
+    sumwt = numpy.sum(xwt, axis=(1, 2))
     
     residual[sumwt > 0.0] = numpy.sqrt(residual[sumwt > 0.0] / sumwt[sumwt > 0.0])
     residual[sumwt <= 0.0] = 0.0
     return residual
+
+
+def broadcast_residual(residual, sumwt, shape):
+    """ Normalise the summed residual for each solution interval and broadcast to the residual shape
+
+    :param residual: summed weighted squared error [ntimes]
+    :param sumwt: summed weight [ntimes]
+    :param shape: residual shape [ntimes, nchan, nrec, nrec]
+    :return: residual
+    """
+    result = numpy.zeros(shape)
+    mask = sumwt > 0.0
+    result[mask, ...] = numpy.sqrt(residual[mask] / sumwt[mask])[:, numpy.newaxis, numpy.newaxis, numpy.newaxis]
+    return result
@@ -66,7 +66,7 @@ def coordinates2Offset(npixel: int, cx: int, cy: int):
     return (mg[0] - cy) / npixel, (mg[1] - cx) / npixel
 
 
-def anti_aliasing_calculate(shape, oversampling=1, support=3):
+def anti_aliasing_calculate(shape, oversampling=1, support=3, separable=False):
     """
     Compute the prolate spheroidal anti-aliasing function
     
@@ -76,10 +76,15 @@ def anti_aliasing_calculate(shape, oversampling=1, support=3):
     
     Return the 2D grid correction function (gcf), and the convolving kernel (kernel
 
+    The kernel is either the full 4D oversampled kernel [oversampling, oversampling, width, width] or, if
+    separable is True, the 1D oversampled kernels for the y and x axes [2, oversampling, width]. The
+    4D kernel is the outer product of the 1D kernels.
+
     See VLA Scientific Memoranda 129, 131, 132
     :param shape: (height, width) pair
     :param oversampling: Number of sub-samples per grid pixel
     :param support: Support of kernel (in pixels) width is 2*support+2
+    :param separable: Return the two 1D kernels instead of the 4D kernel
     """
     
     # 2D Prolate spheroidal angular function is separable
@@ -93,6 +98,12 @@ def anti_aliasing_calculate(shape, oversampling=1, support=3):
     nu = numpy.arange(-support, +support, 1.0 / oversampling)
     kernel1d = grdsf(nu / support)[1]
     l1d = len(kernel1d)
+    if separable:
+        kernel2d = numpy.zeros((oversampling, s1d))
+        for f in range(oversampling):
+            kernel2d[f, 2:] = kernel1d[range(f, l1d, oversampling)[::-1]]
+        kernel2d /= numpy.sum(kernel2d[0, :])
+        return gcf, numpy.array([kernel2d, kernel2d]).astype('complex')
     # Rearrange to get the convolution function isolated by (yf, xf). For this convolution function
     # the result is heavily redundant but it does fit well into the general framework
     kernel4d = numpy.zeros((oversampling, oversampling, s1d, s1d))
@@ -183,6 +194,20 @@ def w_beam(npixel, field_of_view, w, cx=None, cy=None, remove_shift=False):
     return cp
 
 
+def dense_kernel(kernel):
+    """ Convert a separable kernel [2, oversampling, width] to the 4D kernel [oversampling, oversampling, width, width]
+
+    A 4D kernel is returned unchanged.
+
+    :param kernel: Separable or 4D oversampled kernel
+    :return: 4D oversampled kernel
+    """
+    if kernel.ndim == 4:
+        return kernel
+    kernely, kernelx = kernel
+    return kernely[:, numpy.newaxis, :, numpy.newaxis] * kernelx[numpy.newaxis, :, numpy.newaxis, :]
+
+
 def frac_coord(npixel, kernel_oversampling, p):
     """ Compute whole and fractional parts of coordinates, rounded to
     kernel_oversampling-th fraction of pixel size
@@ -217,6 +242,7 @@ def convolutional_degrid(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap):
     :return: Array of visibilities.
     """
     kernel_indices, kernels = kernel_list
+    kernels = [dense_kernel(kernel) for kernel in kernels]
     kernel_oversampling, _, gh, gw = kernels[0].shape
     assert gh % 2 == 0, "Convolution kernel must have even number of pixels"
     assert gw % 2 == 0, "Convolution kernel must have even number of pixels"
@@ -251,6 +277,74 @@ def convolutional_degrid(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap):
     return numpy.array(vis)
 
 
+def convolutional_degrid_vectorised(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap, chunksize=2 ** 16):
+    """Convolutional degridding with frequency and polarisation independent, without looping over samples
+
+    This gives the same result as convolutional_degrid. For each chunk of samples, the flat grid indices of all
+    kernel footprints are calculated at once, the grid values are gathered, and the sum with the kernel weights
+    is done as a single batched matrix product. Separable kernels are applied as two 1D contractions.
+
+    :param kernel_list: list of oversampled convolution kernel
+    :param vshape: Shape of visibility
+    :param uvgrid:   The uv plane to de-grid from
+    :param vuvwmap: function to map uvw to grid fractions
+    :param vfrequencymap: function to map frequency to image channels
+    :param chunksize: Number of kernel footprint points to be gathered per chunk. This bounds the memory used.
+    :return: Array of visibilities.
+    """
+    kernel_indices, kernels = kernel_list
+    separable = kernels[0].ndim == 3
+    if separable:
+        _, kernel_oversampling, gw = kernels[0].shape
+        gh = gw
+    else:
+        kernel_oversampling, _, gh, gw = kernels[0].shape
+    assert gh % 2 == 0, "Convolution kernel must have even number of pixels"
+    assert gw % 2 == 0, "Convolution kernel must have even number of pixels"
+    inchan, inpol, ny, nx = uvgrid.shape
+    nvis = vshape[0]
+    vnpol = vshape[1]
+    vis = numpy.zeros([nvis, vnpol], dtype='complex')
+
+    # uvw -> fraction of grid mapping
+    y, yf = frac_coord(ny, kernel_oversampling, vuvwmap[:, 1])
+    y -= gh // 2
+    x, xf = frac_coord(nx, kernel_oversampling, vuvwmap[:, 0])
+    x -= gw // 2
+    chan = numpy.array(vfrequencymap, dtype='int')
+
+    if len(kernels) > 1:
+        ckernels = numpy.conjugate(numpy.array(kernels))
+        kind = numpy.array(kernel_indices, dtype='int')
+    else:
+        ckernels = numpy.conjugate(kernels[0])[numpy.newaxis, ...]
+        kind = numpy.zeros([nvis], dtype='int')
+
+    # Flat grid index of the first pixel of each footprint, and the offsets of the rest of the footprint
+    corner = (chan * inpol * ny + y) * nx + x
+    offsets = (numpy.arange(vnpol)[:, numpy.newaxis, numpy.newaxis] * ny * nx +
+               numpy.arange(gh)[numpy.newaxis, :, numpy.newaxis] * nx +
+               numpy.arange(gw)[numpy.newaxis, numpy.newaxis, :]).reshape([vnpol, gh * gw])
+
+    flatgrid = uvgrid.reshape(-1)
+
+    nchunk = max(1, chunksize // (vnpol * gh * gw))
+    for start in range(0, nvis, nchunk):
+        rows = slice(start, start + nchunk)
+        values = flatgrid[corner[rows][:, numpy.newaxis, numpy.newaxis] + offsets[numpy.newaxis, ...]]
+        if separable:
+            # Contract over x and then over y
+            values = values.reshape([-1, vnpol, gh, gw])
+            ckernelx = ckernels[kind[rows], 1, xf[rows]][:, numpy.newaxis, :, numpy.newaxis]
+            ckernely = ckernels[kind[rows], 0, yf[rows]][:, :, numpy.newaxis]
+            vis[rows] = numpy.matmul(numpy.matmul(values, ckernelx)[..., 0], ckernely)[..., 0]
+        else:
+            ckernel = ckernels[kind[rows], yf[rows], xf[rows]].reshape([-1, gh * gw, 1])
+            vis[rows] = numpy.matmul(values, ckernel)[..., 0]
+
+    return vis.reshape(vshape)
+
+
 def convolutional_grid(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequencymap):
     """Grid after convolving with frequency and polarisation independent gcf
 
@@ -266,6 +360,7 @@ def convolutional_grid(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequency
     """
     
     kernel_indices, kernels = kernel_list
+    kernels = [dense_kernel(kernel) for kernel in kernels]
     kernel_oversampling, _, gh, gw = kernels[0].shape
     assert gh % 2 == 0, "Convolution kernel must have even number of pixels"
     assert gw % 2 == 0, "Convolution kernel must have even number of pixels"
@@ -304,6 +399,204 @@ def convolutional_grid(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequency
     return uvgrid, sumwt
 
 
+def add_to_flat_grid(flatgrid, indices, values):
+    """Add values to a flat grid at the given indices, accumulating repeated indices
+
+    If the indices span a range of the grid not much longer than their number, the values are summed with
+    numpy.bincount over that range. Otherwise the distinct indices are found first, so that however sparse the
+    indices are, no temporary array is much larger than indices.
+
+    :param flatgrid: Flat complex grid to add to
+    :param indices: Flat grid indices
+    :param values: Complex values, one for each index
+    :return: flatgrid
+    """
+    lo = indices.min()
+    hi = indices.max() + 1
+    if hi - lo <= 4 * len(indices):
+        flatgrid[lo:hi] += numpy.bincount(indices - lo, weights=values.real, minlength=hi - lo) + \
+                           1j * numpy.bincount(indices - lo, weights=values.imag, minlength=hi - lo)
+    else:
+        unique, inverse = numpy.unique(indices, return_inverse=True)
+        flatgrid[unique] += numpy.bincount(inverse, weights=values.real, minlength=len(unique)) + \
+                            1j * numpy.bincount(inverse, weights=values.imag, minlength=len(unique))
+    return flatgrid
+
+
+def convolutional_grid_vectorised(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequencymap, chunksize=2 ** 16):
+    """Grid after convolving with frequency and polarisation independent gcf, without looping over samples
+
+    This gives the same result as convolutional_grid. The samples are sorted by grid position and split into
+    chunks. For each chunk the flat grid indices of all kernel footprints are calculated at once and the
+    weighted kernel values are accumulated by add_to_flat_grid. Sorting means that each chunk usually touches only a
+    compact range of the grid. The footprint of a separable kernel is formed as the outer product of the two 1D
+    kernels.
+
+    :param kernel_list: List of oversampled convolution kernels
+    :param uvgrid: Grid to add to [nchan, npol, npixel, npixel]
+    :param vis: Visibility values
+    :param visweights: Visibility weights
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param chunksize: Number of kernel footprint points to be accumulated per chunk. This bounds the memory used.
+    :return: uv grid[nchan, npol, ny, nx], sumwt[nchan, npol]
+    """
+    kernel_indices, kernels = kernel_list
+    separable = kernels[0].ndim == 3
+    if separable:
+        _, kernel_oversampling, gw = kernels[0].shape
+        gh = gw
+    else:
+        kernel_oversampling, _, gh, gw = kernels[0].shape
+    assert gh % 2 == 0, "Convolution kernel must have even number of pixels"
+    assert gw % 2 == 0, "Convolution kernel must have even number of pixels"
+    inchan, inpol, ny, nx = uvgrid.shape
+    nvis = vuvwmap.shape[0]
+    npol = vis.shape[-1]
+
+    wts = numpy.reshape(visweights, [nvis, npol])
+    viswt = numpy.reshape(vis, [nvis, npol]) * wts
+    chan = numpy.array(vfrequencymap, dtype='int')
+
+    sumwt = numpy.zeros([inchan, inpol])
+    for pol in range(npol):
+        sumwt[:, pol] = numpy.bincount(chan, weights=wts[:, pol], minlength=inchan)
+
+    # uvw -> fraction of grid mapping
+    y, yf = frac_coord(ny, kernel_oversampling, vuvwmap[:, 1])
+    y -= gh // 2
+    x, xf = frac_coord(nx, kernel_oversampling, vuvwmap[:, 0])
+    x -= gw // 2
+
+    if len(kernels) > 1:
+        allkernels = numpy.array(kernels)
+        kind = numpy.array(kernel_indices, dtype='int')
+    else:
+        allkernels = kernels[0][numpy.newaxis, ...]
+        kind = numpy.zeros([nvis], dtype='int')
+
+    # Flat grid index of the first pixel of each footprint, and the offsets of the rest of the footprint
+    corner = (chan * inpol * ny + y) * nx + x
+    offsets = (numpy.arange(gh)[:, numpy.newaxis] * nx + numpy.arange(gw)[numpy.newaxis, :]).flatten()
+    order = numpy.argsort(corner, kind='mergesort')
+
+    # Work on a flat view of the grid, copying only if the grid is not contiguous
+    flatgrid = uvgrid.reshape(-1)
+
+    nchunk = max(1, chunksize // (gh * gw))
+    for start in range(0, nvis, nchunk):
+        rows = order[start:start + nchunk]
+        indices = (corner[rows][:, numpy.newaxis] + offsets[numpy.newaxis, :]).flatten()
+        if separable:
+            kernel = (allkernels[kind[rows], 0, yf[rows]][:, :, numpy.newaxis] *
+                      allkernels[kind[rows], 1, xf[rows]][:, numpy.newaxis, :]).reshape([len(rows), gh * gw])
+        else:
+            kernel = allkernels[kind[rows], yf[rows], xf[rows]].reshape([len(rows), gh * gw])
+        for pol in range(npol):
+            values = (kernel * viswt[rows, pol][:, numpy.newaxis]).flatten()
+            add_to_flat_grid(flatgrid, indices + pol * ny * nx, values)
+
+    if not numpy.may_share_memory(flatgrid, uvgrid):
+        uvgrid[...] = flatgrid.reshape(uvgrid.shape)
+
+    return uvgrid, sumwt
+
+
+def convolutional_grid_hermitian(kernel_list, halfgrid, vis, visweights, vuvwmap, vfrequencymap,
+                                 chunksize=2 ** 16):
+    """Grid onto the half of the uv plane needed for a complex to real inverse FFT
+
+    The real part of the inverse FFT of a full grid G is the inverse FFT of its Hermitian part
+    (G(k) + G*(-k))/2, which is determined by the half plane kx >= 0. Kernel footprint points falling at
+    kx < 0 are added in conjugate at -k, and the halves of the interior columns are taken. The columns
+    kx = 0 and kx = nx/2 are made Hermitian by the complex to real transform itself.
+
+    The half grid has centred rows and unshifted columns kx = 0 ... nx/2, and is modulated by (-1)**(ky+kx). Then
+    irfft2 of halfgrid, multiplied by (-1)**y, is the same as the real part of ifft of the full grid made by
+    convolutional_grid.
+
+    :param kernel_list: List of oversampled convolution kernels
+    :param halfgrid: Grid to add to [nchan, npol, ny, nx//2 + 1]
+    :param vis: Visibility values
+    :param visweights: Visibility weights
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param chunksize: Number of kernel footprint points to be accumulated per chunk. This bounds the memory used.
+    :return: half uv grid[nchan, npol, ny, nx//2 + 1], sumwt[nchan, npol]
+    """
+    kernel_indices, kernels = kernel_list
+    separable = kernels[0].ndim == 3
+    if separable:
+        _, kernel_oversampling, gw = kernels[0].shape
+        gh = gw
+    else:
+        kernel_oversampling, _, gh, gw = kernels[0].shape
+    assert gh % 2 == 0, "Convolution kernel must have even number of pixels"
+    assert gw % 2 == 0, "Convolution kernel must have even number of pixels"
+    inchan, inpol, ny, nw = halfgrid.shape
+    nx = 2 * (nw - 1)
+    assert ny % 2 == 0, "Hermitian gridding requires even sized grid"
+    nvis = vuvwmap.shape[0]
+    npol = vis.shape[-1]
+
+    wts = numpy.reshape(visweights, [nvis, npol])
+    viswt = numpy.reshape(vis, [nvis, npol]) * wts
+    chan = numpy.array(vfrequencymap, dtype='int')
+
+    sumwt = numpy.zeros([inchan, inpol])
+    for pol in range(npol):
+        sumwt[:, pol] = numpy.bincount(chan, weights=wts[:, pol], minlength=inchan)
+
+    # uvw -> fraction of grid mapping, in the coordinates of the full grid
+    y, yf = frac_coord(ny, kernel_oversampling, vuvwmap[:, 1])
+    y -= gh // 2
+    x, xf = frac_coord(nx, kernel_oversampling, vuvwmap[:, 0])
+    x -= gw // 2
+
+    if len(kernels) > 1:
+        allkernels = numpy.array(kernels)
+        kind = numpy.array(kernel_indices, dtype='int')
+    else:
+        allkernels = kernels[0][numpy.newaxis, ...]
+        kind = numpy.zeros([nvis], dtype='int')
+
+    order = numpy.argsort((chan * ny + y) * nx + x, kind='mergesort')
+    yoffsets = numpy.repeat(numpy.arange(gh), gw)
+    xoffsets = numpy.tile(numpy.arange(gw), gh)
+
+    # Work on a flat view of the grid, copying only if the grid is not contiguous
+    flatgrid = halfgrid.reshape(-1)
+
+    nchunk = max(1, chunksize // (gh * gw))
+    for start in range(0, nvis, nchunk):
+        rows = order[start:start + nchunk]
+        ky = y[rows][:, numpy.newaxis] + yoffsets[numpy.newaxis, :] - ny // 2
+        kx = x[rows][:, numpy.newaxis] + xoffsets[numpy.newaxis, :] - nx // 2
+        # Points at kx < 0 go to -k in conjugate. kx = -nx/2 is the same column as kx = nx/2.
+        mirror = (kx < 0) & (kx > -(nx // 2))
+        col = numpy.abs(kx)
+        row = numpy.where(mirror, (ny // 2 - ky) % ny, ky + ny // 2)
+        factor = (1 - 2 * ((ky + kx) % 2)) * numpy.where((col > 0) & (col < nx // 2), 0.5, 1.0)
+        indices = ((chan[rows][:, numpy.newaxis] * inpol * ny + row) * nw + col)
+        if separable:
+            kernel = (allkernels[kind[rows], 0, yf[rows]][:, :, numpy.newaxis] *
+                      allkernels[kind[rows], 1, xf[rows]][:, numpy.newaxis, :]).reshape([len(rows), gh * gw])
+        else:
+            kernel = allkernels[kind[rows], yf[rows], xf[rows]].reshape([len(rows), gh * gw])
+        # The direct and the mirrored points each usually cover a compact range of the grid
+        for pol in range(npol):
+            values = kernel * viswt[rows, pol][:, numpy.newaxis] * factor
+            if (~mirror).any():
+                add_to_flat_grid(flatgrid, indices[~mirror] + pol * ny * nw, values[~mirror])
+            if mirror.any():
+                add_to_flat_grid(flatgrid, indices[mirror] + pol * ny * nw, numpy.conj(values[mirror]))
+
+    if not numpy.may_share_memory(flatgrid, halfgrid):
+        halfgrid[...] = flatgrid.reshape(halfgrid.shape)
+
+    return halfgrid, sumwt
+
+
 def weight_gridding(shape, visweights, vuvwmap, vfrequencymap, vpolarisationmap=None, weighting='uniform'):
     """Reweight data using one of a number of algorithms
 
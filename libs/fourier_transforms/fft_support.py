@@ -1,11 +1,137 @@
 """ FFT support functions
 
+The 2D FFTs can be done by one of several backends:
+
+- 'numpy': numpy.fft, single threaded
+- 'scipy': scipy.fft, using workers threads
+- 'pyfftw': pyfftw, using workers threads, with plans cached and FFTW wisdom optionally saved and loaded
+
+The default backend and number of workers are taken from the environment variables ARL_FFT_BACKEND and
+ARL_FFT_WORKERS, and can be changed with set_fft_backend. They can also be overridden in each call of
+fft and ifft.
+
+For even sized grids, fft_checkerboard and ifft_checkerboard give the same results as fft and ifft
+but replace the shifts (each a full copy of the grid) by multiplication with a checkerboard of signs.
 """
 
+import functools
+import os
+import pickle
+
 import numpy
 
+default_fft_backend = os.getenv('ARL_FFT_BACKEND', 'numpy')
+default_fft_workers = int(os.getenv('ARL_FFT_WORKERS', '1'))
+
+
+def set_fft_backend(backend='numpy', workers=1):
+    """ Set the default FFT backend
+    
+    :param backend: 'numpy' | 'scipy' | 'pyfftw'
+    :param workers: Number of threads to use (scipy and pyfftw only)
+    """
+    global default_fft_backend, default_fft_workers
+    assert backend in ['numpy', 'scipy', 'pyfftw'], "Unknown FFT backend %s" % backend
+    default_fft_backend = backend
+    default_fft_workers = workers
+
+
+def get_fft_backend():
+    """ Get the default FFT backend
+
+    :return: backend, workers
+    """
+    return default_fft_backend, default_fft_workers
+
+
+def fft2(a, inverse=False, backend=None, workers=None):
+    """ Unshifted 2D FFT of the last two axes using the selected backend
+    
+    :param a: array to transform
+    :param inverse: Do the inverse transform
+    :param backend: 'numpy' | 'scipy' | 'pyfftw' (default from set_fft_backend)
+    :param workers: Number of threads (default from set_fft_backend)
+    :return: transformed array
+    """
+    if backend is None:
+        backend = default_fft_backend
+    if workers is None:
+        workers = default_fft_workers
+    
+    if backend == 'numpy':
+        if inverse:
+            return numpy.fft.ifft2(a, axes=(-2, -1))
+        else:
+            return numpy.fft.fft2(a, axes=(-2, -1))
+    elif backend == 'scipy':
+        import scipy.fft
+        if inverse:
+            return scipy.fft.ifft2(a, axes=(-2, -1), workers=workers)
+        else:
+            return scipy.fft.fft2(a, axes=(-2, -1), workers=workers)
+    elif backend == 'pyfftw':
+        import pyfftw.interfaces.cache
+        import pyfftw.interfaces.numpy_fft
+        # Keep the plans so that repeated transforms of the same shape are not planned again
+        pyfftw.interfaces.cache.enable()
+        if inverse:
+            return pyfftw.interfaces.numpy_fft.ifft2(a, axes=(-2, -1), threads=workers, planner_effort='FFTW_MEASURE')
+        else:
+            return pyfftw.interfaces.numpy_fft.fft2(a, axes=(-2, -1), threads=workers, planner_effort='FFTW_MEASURE')
+    else:
+        raise ValueError("Unknown FFT backend %s" % backend)
+
+
+def irfft2(a, shape, backend=None, workers=None):
+    """ Unshifted 2D complex to real inverse FFT of the last two axes using the selected backend
+
+    :param a: Half plane array to transform [..., ny, nx//2 + 1]
+    :param shape: Shape (ny, nx) of the real output
+    :param backend: 'numpy' | 'scipy' | 'pyfftw' (default from set_fft_backend)
+    :param workers: Number of threads (default from set_fft_backend)
+    :return: real array [..., ny, nx]
+    """
+    if backend is None:
+        backend = default_fft_backend
+    if workers is None:
+        workers = default_fft_workers
+    
+    if backend == 'numpy':
+        return numpy.fft.irfft2(a, s=shape, axes=(-2, -1))
+    elif backend == 'scipy':
+        import scipy.fft
+        return scipy.fft.irfft2(a, s=shape, axes=(-2, -1), workers=workers)
+    elif backend == 'pyfftw':
+        import pyfftw.interfaces.cache
+        import pyfftw.interfaces.numpy_fft
+        pyfftw.interfaces.cache.enable()
+        return pyfftw.interfaces.numpy_fft.irfft2(a, s=shape, axes=(-2, -1), threads=workers,
+                                                  planner_effort='FFTW_MEASURE')
+    else:
+        raise ValueError("Unknown FFT backend %s" % backend)
+
+
+def export_fftw_wisdom(filename):
+    """ Save the accumulated FFTW wisdom (pyfftw backend only)
+
+    :param filename: Name of file to write
+    """
+    import pyfftw
+    with open(filename, 'wb') as f:
+        pickle.dump(pyfftw.export_wisdom(), f)
+
+
+def import_fftw_wisdom(filename):
+    """ Load FFTW wisdom saved by export_fftw_wisdom (pyfftw backend only)
+
+    :param filename: Name of file to read
+    """
+    import pyfftw
+    with open(filename, 'rb') as f:
+        pyfftw.import_wisdom(pickle.load(f))
+
 
-def fft(a):
+def fft(a, backend=None, workers=None):
     """ Fourier transformation from image to grid space
     
     .. note::
@@ -13,15 +139,18 @@ def fft(a):
         If there are four axes then the last outer axes are not transformed
 
     :param a: image in `lm` coordinate space
+    :param backend: FFT backend (default from set_fft_backend)
+    :param workers: Number of threads (default from set_fft_backend)
     :return: `uv` grid
     """
     if (len(a.shape) == 4):
-        return numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(a, axes=[2, 3])), axes=[2, 3])
+        return numpy.fft.fftshift(fft2(numpy.fft.ifftshift(a, axes=[2, 3]), backend=backend, workers=workers),
+                                  axes=[2, 3])
     else:
-        return numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(a)))
+        return numpy.fft.fftshift(fft2(numpy.fft.ifftshift(a), backend=backend, workers=workers))
 
 
-def ifft(a):
+def ifft(a, backend=None, workers=None):
     """ Fourier transformation from grid to image space
 
     .. note::
@@ -29,12 +158,95 @@ def ifft(a):
         If there are four axes then the last outer axes are not transformed
 
     :param a: `uv` grid to transform
+    :param backend: FFT backend (default from set_fft_backend)
+    :param workers: Number of threads (default from set_fft_backend)
     :return: an image in `lm` coordinate space
     """
     if (len(a.shape) == 4):
-        return numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(a, axes=[2, 3])), axes=[2, 3])
+        return numpy.fft.fftshift(fft2(numpy.fft.ifftshift(a, axes=[2, 3]), inverse=True, backend=backend,
+                                       workers=workers), axes=[2, 3])
+    else:
+        return numpy.fft.fftshift(fft2(numpy.fft.ifftshift(a), inverse=True, backend=backend, workers=workers))
+
+
+@functools.lru_cache(maxsize=16)
+def checkerboard(ny, nx, signed=False):
+    """ The checkerboard of signs (-1)**(y+x) for an even sized grid
+    
+    For even ny and nx, multiplying by (-1)**y is the same in Fourier space as shifting by ny/2, so::
+    
+        fftshift(fft2(ifftshift(a))) == checkerboard(ny, nx, signed=True) * fft2(checkerboard(ny, nx) * a)
+        
+    and similarly for ifft2. The signed checkerboard includes the overall sign (-1)**((ny+nx)/2).
+    Since the multiplications are by +-1 they are exact, and can be fused into other operations such as
+    the gridding correction. The array returned is cached and so is read-only.
+
+    :param ny: Number of pixels on y axis
+    :param nx: Number of pixels on x axis
+    :param signed: Include the overall sign
+    :return: [ny, nx] array of +-1
+    """
+    assert ny % 2 == 0 and nx % 2 == 0, "Checkerboard modulation requires even sized grid"
+    cb = numpy.outer(1 - 2 * (numpy.arange(ny) % 2), 1 - 2 * (numpy.arange(nx) % 2)).astype('float')
+    if signed and ((ny + nx) // 2) % 2 == 1:
+        cb = -cb
+    cb.flags.writeable = False
+    return cb
+
+
+def checkerboard_modulate(a, signed=False):
+    """ Multiply in place by the checkerboard over the last two axes
+    
+    Some FFT libraries return the last two axes transposed in memory. The multiplication is done in the
+    memory order of a, which is much faster in that case.
+
+    :param a: Array to be modulated, even sized on the last two axes
+    :param signed: Include the overall sign
+    :return: a
+    """
+    ny, nx = a.shape[-2:]
+    at = a.swapaxes(-1, -2)
+    if not a.flags['C_CONTIGUOUS'] and at.flags['C_CONTIGUOUS']:
+        at *= checkerboard(nx, ny, signed=signed)
+    else:
+        a *= checkerboard(ny, nx, signed=signed)
+    return a
+
+
+def fft_checkerboard(a, backend=None, workers=None, overwrite_input=False):
+    """ Fourier transformation from image to grid space, using checkerboard modulation instead of shifts
+    
+    For 2D or 4D even sized grids, the result is the same as fft.
+
+    :param a: image in `lm` coordinate space
+    :param backend: FFT backend (default from set_fft_backend)
+    :param workers: Number of threads (default from set_fft_backend)
+    :param overwrite_input: Modulate a in place, avoiding a copy
+    :return: `uv` grid
+    """
+    if overwrite_input:
+        a = checkerboard_modulate(a)
+    else:
+        a = a * checkerboard(*a.shape[-2:])
+    return checkerboard_modulate(fft2(a, backend=backend, workers=workers), signed=True)
+
+
+def ifft_checkerboard(a, backend=None, workers=None, overwrite_input=False):
+    """ Fourier transformation from grid to image space, using checkerboard modulation instead of shifts
+    
+    For 2D or 4D even sized grids, the result is the same as ifft.
+
+    :param a: `uv` grid to transform
+    :param backend: FFT backend (default from set_fft_backend)
+    :param workers: Number of threads (default from set_fft_backend)
+    :param overwrite_input: Modulate a in place, avoiding a copy
+    :return: an image in `lm` coordinate space
+    """
+    if overwrite_input:
+        a = checkerboard_modulate(a)
     else:
-        return numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(a)))
+        a = a * checkerboard(*a.shape[-2:])
+    return checkerboard_modulate(fft2(a, inverse=True, backend=backend, workers=workers), signed=True)
 
 
 def pad_mid(ff, npixel):
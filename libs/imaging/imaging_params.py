@@ -2,7 +2,11 @@
 Functions that aid definition of fourier transform processing.
 """
 
+import collections
+import functools
+import hashlib
 import logging
+import os
 import warnings
 
 from astropy.wcs import FITSFixedWarning
@@ -116,20 +120,140 @@ def get_uvw_map(vis: Visibility, im: Image, padding=2):
     return uvw_mode, shape, padding, vuvwmap
 
 
-def standard_kernel_list(vis: Visibility, shape, oversampling=8, support=3):
+@functools.lru_cache(maxsize=32)
+def anti_aliasing_cache(shape, oversampling=8, support=3, kernelname='2d'):
+    """Cached gridding correction function and kernel, as calculated by anti_aliasing_calculate
+
+    The same gcf and kernel are needed by every call of predict_2d and invert_2d for a given grid so they are
+    calculated once and kept in a bounded, process-local cache. The returned arrays are shared between callers
+    and so are read-only. The hits and misses can be inspected with anti_aliasing_cache.cache_info() and the
+    cache emptied with anti_aliasing_cache.cache_clear().
+
+    :param shape: (height, width) tuple of the grid
+    :param oversampling: Number of sub-samples per grid pixel
+    :param support: Support of kernel (in pixels)
+    :param kernelname: '2d' for the 4D kernel, '2d_separable' for the separable form
+    :return: gcf, kernel
+    """
+    assert kernelname in ['2d', '2d_separable'], "Unknown kernel %s" % kernelname
+    gcf, kernel = anti_aliasing_calculate(tuple(shape), oversampling, support,
+                                          separable=(kernelname == '2d_separable'))
+    gcf.flags.writeable = False
+    kernel.flags.writeable = False
+    return gcf, kernel
+
+
+def standard_kernel_list(vis: Visibility, shape, oversampling=8, support=3, separable=True):
     """Return a generator to calculate the standard visibility kernel
 
+    The standard kernel is separable so by default it is kept as two 1D oversampled kernels. The
+    vectorised gridder and degridder then apply it as two 1D contractions.
+
     :param vis: visibility
     :param shape: tuple with 2D shape of grid
     :param oversampling: Oversampling factor
     :param support: Support of kernel
+    :param separable: Return the separable form of the kernel
     :return: Function to look up gridding kernel
     """
-    return numpy.zeros_like(vis.w, dtype='int'), [anti_aliasing_calculate(shape, oversampling, support)[1]]
+    kernelname = '2d_separable' if separable else '2d'
+    return numpy.zeros_like(vis.w, dtype='int'), [anti_aliasing_cache(tuple(shape), oversampling, support,
+                                                                      kernelname)[1]]
+
+
+class WKernelCache:
+    """ Store of w projection kernels, with least recently used eviction under a memory budget
+
+    The kernels are keyed on the w plane value, the field of view and shape of the grid, the kernel width,
+    the oversampling, and remove_shift. If cache_dir is given, each new kernel is also saved there as a
+    .npy file, and kernels not in memory are looked for there before being calculated. Repeated runs on
+    the same configuration can thereby start warm.
+
+    The kernels returned are shared between callers and so are read-only.
+    """
+    
+    def __init__(self, max_bytes=2 ** 30, cache_dir=None):
+        """ Create a w kernel cache
+
+        :param max_bytes: Maximum number of bytes of kernels held in memory
+        :param cache_dir: Directory for .npy copies of the kernels (default None, meaning no disk copies)
+        """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.kernels = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+    
+    def __len__(self):
+        return len(self.kernels)
+    
+    def __str__(self):
+        return "WKernelCache: %d kernels, %d bytes (max %d), hits %d, disk hits %d, misses %d" % \
+               (len(self.kernels), self.nbytes, self.max_bytes, self.hits, self.disk_hits, self.misses)
+    
+    def filename(self, key):
+        """ Name of the .npy file holding the kernel for this key
+
+        :param key: Key of kernel
+        :return: file name
+        """
+        return os.path.join(self.cache_dir, 'wkernel_%s.npy' % hashlib.sha1(repr(key).encode()).hexdigest())
+    
+    def get(self, key):
+        """ Get a kernel, first from memory and then from disk
+
+        :param key: Key of kernel
+        :return: kernel or None if it is not in the cache
+        """
+        if key in self.kernels:
+            self.kernels.move_to_end(key)
+            self.hits += 1
+            return self.kernels[key]
+        if self.cache_dir is not None and os.path.exists(self.filename(key)):
+            self.disk_hits += 1
+            kernel = numpy.load(self.filename(key))
+            self.add(key, kernel, save=False)
+            return kernel
+        self.misses += 1
+        return None
+    
+    def add(self, key, kernel, save=True):
+        """ Add a kernel, evicting the least recently used kernels if the memory budget is exceeded
+
+        :param key: Key of kernel
+        :param kernel: Kernel
+        :param save: Save to the cache_dir (if defined)
+        """
+        kernel.flags.writeable = False
+        if key in self.kernels:
+            self.nbytes -= self.kernels.pop(key).nbytes
+        self.kernels[key] = kernel
+        self.nbytes += kernel.nbytes
+        while self.nbytes > self.max_bytes and len(self.kernels) > 1:
+            _, evicted = self.kernels.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        if save and self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            numpy.save(self.filename(key), kernel)
+    
+    def clear(self):
+        """ Remove all kernels from memory and reset the counters. Files in cache_dir are not removed.
+        """
+        self.kernels.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+
+# The default process-local cache used by w_kernel_list
+w_kernel_cache = WKernelCache()
 
 
 # noinspection PyTypeChecker
-def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernelwidth=16, **kwargs):
+def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernelwidth=16, cache=None, **kwargs):
     """ Calculate w convolution kernels
     
     Uses create_w_term_like to calculate the w screen. This is exactly as wstacking does.
@@ -140,55 +264,69 @@ def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernel
     convolution function for all channels and polarisations. Changing that behaviour would
     require modest changes here and to the gridding/degridding routines.
 
+    The w planes are at integer multiples of wstep, and each row uses the nearest plane. Since the planes
+    do not depend on the visibility, the kernels are kept in a WKernelCache and reused by later calls.
+
     :param im:
     :param kernelwidth:
     :param vis: visibility
     :param oversampling: Oversampling factor
     :param wstep: Step in w between cached functions
+    :param cache: WKernelCache to use (default is the process-local w_kernel_cache)
     :return: (indices to the w kernel for each row, kernels)
     """
 
     nchan, npol, ny, nx = im.shape
-    gcf, _ = anti_aliasing_calculate((ny, nx))
+    gcf, _ = anti_aliasing_cache((ny, nx), 1, 3, '2d')
 
     assert oversampling % 2 == 0 or oversampling == 1, "oversampling must be unity or even"
     assert kernelwidth % 2 == 0, "kernelwidth must be even"
+    
+    if cache is None:
+        cache = w_kernel_cache
 
     wmaxabs = numpy.max(numpy.abs(vis.w))
     log.debug("w_kernel_list: Maximum absolute w = %.1f, step is %.1f wavelengths" % (wmaxabs, wstep))
 
-    def digitise(w, wstep):
-        return numpy.ceil((w + wmaxabs) / wstep).astype('int')
-    
-    # Find all the unique indices for which we need a kernel
-    nwsteps = digitise(wmaxabs, wstep) + 1
-    w_list = numpy.linspace(-wmaxabs, +wmaxabs, nwsteps)
+    # Find all the w planes for which we need a kernel
+    wplanes = numpy.round(vis.w / wstep).astype('int')
+    wplane_min = numpy.min(wplanes)
+    w_list = wstep * numpy.arange(wplane_min, numpy.max(wplanes) + 1)
     
+    # Only the first channel and polarisation are used so the w screen need only have one of each
     wtemplate = copy_image(im)
-    
-    wtemplate.data = numpy.zeros(wtemplate.shape, dtype=im.data.dtype)
+    wtemplate.data = numpy.zeros([1, 1, ny, nx], dtype=im.data.dtype)
     
     padded_shape = list(wtemplate.shape)
     padded_shape[3] *= oversampling
     padded_shape[2] *= oversampling
+    
+    fov = (nx * abs(im.wcs.wcs.cdelt[0]), ny * abs(im.wcs.wcs.cdelt[1]))
+    remove_shift = get_parameter(kwargs, "remove_shift", False)
+    wcentre = tuple(im.wcs.wcs.crpix[0:2])
 
     # For all the unique indices, calculate the corresponding w kernel
     kernels = list()
     for w in w_list:
-        # Make a w screen
-        wscreen = create_w_term_like(wtemplate, w, vis.phasecentre, **kwargs)
-        wscreen.data /= gcf
-        assert numpy.max(numpy.abs(wscreen.data)) > 0.0, 'w screen is empty'
-        wscreen_padded = pad_image(wscreen, padded_shape)
-
-        wconv = fft_image(wscreen_padded)
-        wconv.data *= float(oversampling)**2
-        # For the moment, ignore the polarisation and channel axes
-        kernels.append(convert_image_to_kernel(wconv, oversampling,
-                                               kernelwidth).data[0, 0, ...])
+        key = (float(w), fov, (ny, nx), wcentre, kernelwidth, oversampling, remove_shift)
+        kernel = cache.get(key)
+        if kernel is None:
+            # Make a w screen
+            wscreen = create_w_term_like(wtemplate, w, vis.phasecentre, **kwargs)
+            wscreen.data /= gcf
+            assert numpy.max(numpy.abs(wscreen.data)) > 0.0, 'w screen is empty'
+            wscreen_padded = pad_image(wscreen, padded_shape)
+    
+            wconv = fft_image(wscreen_padded)
+            wconv.data *= float(oversampling)**2
+            # For the moment, ignore the polarisation and channel axes
+            kernel = convert_image_to_kernel(wconv, oversampling, kernelwidth).data[0, 0, ...]
+            cache.add(key, kernel)
+        kernels.append(kernel)
+    log.debug("w_kernel_list: %s" % str(cache))
     
     # Now make a lookup table from row number of vis to the kernel
-    kernel_indices = digitise(vis.w, wstep)
+    kernel_indices = wplanes - wplane_min
     assert numpy.max(kernel_indices) < len(kernels), "wabsmax %f wstep %f" % (wmaxabs, wstep)
     assert numpy.min(kernel_indices) >= 0, "wabsmax %f wstep %f" % (wmaxabs, wstep)
     return kernel_indices, kernels
@@ -207,7 +345,7 @@ def get_kernel_list(vis: Visibility, im: Image, **kwargs):
     oversampling = get_parameter(kwargs, "oversampling", 8)
     padding = get_parameter(kwargs, "padding", 2)
     
-    gcf, _ = anti_aliasing_calculate((padding * npixel, padding * npixel), oversampling)
+    gcf, _ = anti_aliasing_cache((padding * npixel, padding * npixel), oversampling, 3, '2d')
     
     wabsmax = numpy.max(numpy.abs(vis.w))
     if wstep > 0.0 and wabsmax > 0.0:
@@ -230,9 +368,10 @@ def get_kernel_list(vis: Visibility, im: Image, **kwargs):
         padded_shape = [im.shape[0], im.shape[1], im.shape[2] * padding, im.shape[3] * padding]
 
         remove_shift = get_parameter(kwargs, "remove_shift", True)
+        cache = get_parameter(kwargs, "w_kernel_cache", None)
         padded_image = pad_image(im, padded_shape)
         kernel_list = w_kernel_list(vis, padded_image, oversampling=oversampling, wstep=wstep,
-                                    kernelwidth=kernelwidth, remove_shift=remove_shift)
+                                    kernelwidth=kernelwidth, remove_shift=remove_shift, cache=cache)
     else:
         kernelname = '2d'
         kernel_list = standard_kernel_list(vis, (padding * npixel, padding * npixel),
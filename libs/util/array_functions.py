@@ -108,6 +108,30 @@ def average_chunks2(arr, wts, chunksize):
     return chunks, weights
 
 
+def average_chunks2_batch(arr, wts, chunksize):
+    """ Average a batch of two dimensional arrays with weights by chunks
+
+    This gives the same result as average_chunks2 applied to each of arr[:, i, :], but the whole batch
+    is averaged in a few array operations.
+
+    :param arr: 3D array of values [n0, nbatch, n1]
+    :param wts: 3D array of weights
+    :param chunksize: 2-tuple of averaging region along the first and last axes e.g. (2,3)
+    :return: 3D array of averaged data_models, 3d array of weights
+    """
+    wts = wts.reshape(arr.shape)
+    
+    chunks, weights = arr, wts
+    for axis, size in [(2, chunksize[1]), (0, chunksize[0])]:
+        if size > 1:
+            places = range(0, chunks.shape[axis], size)
+            chunks = numpy.add.reduceat(weights * chunks, places, axis=axis)
+            weights = numpy.add.reduceat(weights, places, axis=axis)
+            chunks[weights > 0.0] = chunks[weights > 0.0] / weights[weights > 0.0]
+    
+    return chunks, weights
+
+
 def tukey_filter(x, r):
     """ Calculate the Tukey (tapered cosine) filter
     
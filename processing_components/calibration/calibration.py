@@ -21,20 +21,28 @@ from data_models.memory_data_models import BlockVisibility, GainTable, assert_vi
 
 from libs.calibration.solvers import solve_from_X
 
-from ..visibility.base import create_visibility_from_rows
 from ..calibration.operations import apply_gaintable, create_gaintable_from_blockvisibility
 from ..visibility.coalesce import convert_blockvisibility_to_visibility, decoalesce_visibility
-from ..visibility.base import copy_visibility
+from ..visibility.base import copy_visibility, create_visibility_view_from_rows
 from ..imaging.base import predict_skycomponent_visibility, predict_2d
 from ..visibility.operations import divide_visibility
 
 log = logging.getLogger(__name__)
 
 def solve_gaintable(vis: BlockVisibility, modelvis: BlockVisibility = None, gt=None, phase_only=True, niter=30,
-                    tol=1e-8, crosspol=False, normalise_gains=True, **kwargs) -> GainTable:
+                    tol=1e-8, crosspol=False, normalise_gains=True, solver='antsol', **kwargs) -> GainTable:
     """Solve a gain table by fitting an observed visibility to a model visibility
     
     If modelvis is None, a point source model is assumed.
+    
+    The gains are found by Antsol iterative substitution (solver='antsol') or by StefCal
+    (solver='stefcal'). StefCal usually needs far fewer iterations but cannot solve for cross
+    polarisation gains.
+    
+    The solve path is dense: the solvers work on the point source visibility averaged over each solution interval,
+    as [nintervals, nants, nants, nchan, npol]. A compact BlockVisibility is scattered into that form (see
+    scatter_compact_baselines), so the compact layout saves memory in the data but not in the solve. For solutions
+    every integration the solve holds a dense array as large as the data.
 
     :param vis: BlockVisibility containing the observed data_models
     :param modelvis: BlockVisibility containing the visibility predicted by a model
@@ -43,6 +51,8 @@ def solve_gaintable(vis: BlockVisibility, modelvis: BlockVisibility = None, gt=N
     :param niter: Number of iterations (default 30)
     :param tol: Iteration stops when the fractional change in the gain solution is below this tolerance
     :param crosspol: Do solutions including cross polarisations i.e. XY, YX or RL, LR
+    :param normalise_gains: Normalise the amplitude of the gains to unity (not for phase only)
+    :param solver: Gain solver: 'antsol' or 'stefcal' (default 'antsol')
     :return: GainTable containing solution
 
     """
@@ -61,33 +71,131 @@ def solve_gaintable(vis: BlockVisibility, modelvis: BlockVisibility = None, gt=N
     else:
         log.debug("solve_gaintable: starting from existing gaintable")
 
-    for row in range(gt.ntimes):
-        vis_rows = numpy.abs(vis.time - gt.time[row]) < gt.interval[row] / 2.0
-        if numpy.sum(vis_rows) > 0:
-            subvis = create_visibility_from_rows(vis, vis_rows)
-            if modelvis is not None:
-                model_subvis = create_visibility_from_rows(modelvis, vis_rows)
-                pointvis = divide_visibility(subvis, model_subvis)
-                x = numpy.sum(pointvis.vis * pointvis.weight, axis=0)
-                xwt = numpy.sum(pointvis.weight, axis=0)
-            else:
-                x = numpy.sum(subvis.vis * subvis.weight, axis=0)
-                xwt = numpy.sum(subvis.weight, axis=0)
-            
-            mask = numpy.abs(xwt) > 0.0
-            x_shape = x.shape
-            x[mask] = x[mask] / xwt[mask]
-            x[~mask] = 0.0
-            x = x.reshape(x_shape)
-            
-            gt = solve_from_X(gt, x, xwt, row, crosspol, niter, phase_only,
-                              tol, npol=vis.polarisation_frame.npol)
-            if normalise_gains and not phase_only:
-                gabs = numpy.average(numpy.abs(gt.data['gain'][row]))
-                gt.data['gain'][row] /= gabs
+    # Stack the averaged point source visibility for every solution interval that has data
+    order, starts, stops = solution_intervals(vis.time, gt)
+    rows = numpy.flatnonzero(stops > starts)
+    
+    if len(rows) > 0:
+        x, xwt = sum_point_source(vis, modelvis, order, starts[rows], stops[rows])
+        
+        mask = numpy.abs(xwt) > 0.0
+        x[mask] = x[mask] / xwt[mask]
+        x[~mask] = 0.0
+        
+        if vis.compact:
+            # The solvers still work on the dense [nants, nants, nchan, npol] point source visibility
+            x, xwt = scatter_compact_baselines(x, xwt, vis.nants)
+        
+        # Solve all the intervals together
+        gt = solve_from_X(gt, x, xwt, rows, crosspol, niter, phase_only,
+                          tol, npol=vis.polarisation_frame.npol, solver=solver)
+        if normalise_gains and not phase_only:
+            gabs = numpy.average(numpy.abs(gt.data['gain'][rows]), axis=(1, 2, 3, 4))
+            gt.data['gain'][rows] /= gabs[:, numpy.newaxis, numpy.newaxis, numpy.newaxis, numpy.newaxis]
     
     assert isinstance(gt, GainTable), "gt is not a GainTable: %r" % gt
     
     assert_vis_gt_compatible(vis, gt)
     
-    return gt
\ No newline at end of file
+    return gt
+
+
+def solution_intervals(time, gt: GainTable):
+    """ Find the visibility times in each solution interval of a gaintable
+
+    A time is in the interval of a gaintable row if abs(time - gt.time[row]) < gt.interval[row] / 2. These times
+    are contiguous once sorted. They are found by searchsorted, and the edges then checked with the same test, since
+    gt.time +/- gt.interval / 2 may round differently.
+
+    :param time: Visibility times
+    :param gt: GainTable
+    :return: Sort order of time, and for each gaintable row the range [start, stop) of the sorted times in its interval
+    """
+    order = numpy.argsort(time, kind='mergesort')
+    times = time[order]
+    ntimes = len(times)
+    halfwidth = gt.interval / 2.0
+    
+    def inside(index):
+        return numpy.abs(times[numpy.clip(index, 0, ntimes - 1)] - gt.time) < halfwidth
+    
+    starts = numpy.maximum(numpy.searchsorted(times, gt.time - halfwidth, side='left') - 1, 0)
+    stops = numpy.minimum(numpy.searchsorted(times, gt.time + halfwidth, side='right') + 1, ntimes)
+    for step in range(3):
+        starts += (starts < ntimes) & ~inside(starts)
+        stops -= (stops > 0) & ~inside(stops - 1)
+    return order, starts, stops
+
+
+def sum_point_source(vis: BlockVisibility, modelvis: BlockVisibility, order, starts, stops):
+    """ Sum the weighted point source equivalent visibility, and its weight, over ranges of times
+
+    The point source equivalent visibility is that of divide_visibility, or vis itself if modelvis is None. For the
+    scalar case the division is done within the sum, as vis * conj(model) * weight, with weight |model|^2 * weight.
+
+    Usually the times are sorted and the ranges do not overlap. Then successive ranges are summed by one
+    numpy.add.reduceat over a view of the data, a block of times at a time. Otherwise each range is summed
+    separately.
+
+    :param vis: BlockVisibility
+    :param modelvis: Model BlockVisibility, or None
+    :param order: Sort order of the times, as from solution_intervals
+    :param starts: Start of each range in the sorted times
+    :param stops: Stop of each range in the sorted times, all greater than starts
+    :return: x, xwt: sum of the weighted visibility and of the weight [nranges, ...]
+    """
+    shape = [len(starts)] + list(vis.vis.shape[1:])
+    x = numpy.zeros(shape, dtype='complex')
+    xwt = numpy.zeros(shape)
+    
+    def terms(index):
+        if modelvis is None:
+            weight = vis.weight[index]
+            return vis.vis[index] * weight, weight
+        if vis.polarisation_frame.npol == 1:
+            model = modelvis.vis[index]
+            weight = vis.weight[index]
+            return vis.vis[index] * numpy.conj(model) * weight, numpy.abs(model) ** 2 * weight
+        pointvis = divide_visibility(create_visibility_view_from_rows(vis, index),
+                                     create_visibility_view_from_rows(modelvis, index))
+        return pointvis.vis * pointvis.weight, pointvis.weight
+    
+    contiguous = numpy.array_equal(order, numpy.arange(len(order))) and numpy.all(stops[:-1] <= starts[1:])
+    # Sum about 4M samples at a time
+    block = max(1, 2 ** 22 // int(numpy.prod(shape[1:])))
+    first = 0
+    while first < len(starts):
+        if contiguous:
+            last = max(first + 1, numpy.searchsorted(stops, starts[first] + block, side='right'))
+            # The edges of the ranges, relative to the start of the block. The sums at the odd edges are of the
+            # gaps between the ranges, and the final stop is the end of the block.
+            edges = numpy.stack([starts[first:last], stops[first:last]], axis=1).flatten()[:-1] - starts[first]
+            wvis, weight = terms(slice(starts[first], stops[last - 1]))
+            x[first:last] = numpy.add.reduceat(wvis, edges, axis=0)[::2]
+            xwt[first:last] = numpy.add.reduceat(weight, edges, axis=0)[::2]
+        else:
+            last = first + 1
+            wvis, weight = terms(numpy.sort(order[starts[first]:stops[first]]))
+            x[first] = numpy.sum(wvis, axis=0)
+            xwt[first] = numpy.sum(weight, axis=0)
+        first = last
+    return x, xwt
+
+
+def scatter_compact_baselines(x: numpy.ndarray, xwt: numpy.ndarray, nants):
+    """ Scatter the point source visibility for the baselines of a compact BlockVisibility into the dense form
+
+    This is the form used by the solvers, which have not been converted to the compact layout.
+
+    :param x: Point source visibility [..., nbaselines, nchan, npol]
+    :param xwt: Point source weight [..., nbaselines, nchan, npol]
+    :param nants: Number of antennas
+    :return: x, xwt [..., nants, nants, nchan, npol] with the baselines at [a2, a1] and zero elsewhere
+    """
+    a1, a2 = numpy.triu_indices(nants, 1)
+    dshape = list(x.shape[:-3]) + [nants, nants] + list(x.shape[-2:])
+    dx = numpy.zeros(dshape, dtype=x.dtype)
+    dxwt = numpy.zeros(dshape, dtype=xwt.dtype)
+    dx[..., a2, a1, :, :] = x
+    dxwt[..., a2, a1, :, :] = xwt
+    return dx, dxwt
@@ -9,6 +9,7 @@
 import logging
 
 from data_models.memory_data_models import Visibility
+from data_models.parameters import get_parameter
 
 from ..calibration.operations import create_gaintable_from_blockvisibility, apply_gaintable, qa_gaintable
 from ..calibration.calibration import solve_gaintable
@@ -30,16 +31,26 @@ def create_calibration_controls(**kwargs):
     Get this dictionary and then adjust parameters as desired
     
     The calibrate function takes a context string e.g. TGB. It then calibrates each of these Jones matrices in turn.
+    
+    The gain solver ('antsol' or 'stefcal') is given by the solver keyword (default 'antsol'). StefCal
+    cannot solve for the matrix P so that always uses 'antsol'.
 
     :param kwargs:
     :return:
     """
+    
+    solver = get_parameter(kwargs, 'solver', 'antsol')
 
-    controls = {'T': {'shape': 'scalar', 'timeslice': 'auto', 'phase_only': True, 'first_selfcal': 0},
-                'G': {'shape': 'vector', 'timeslice': 60.0, 'phase_only': False, 'first_selfcal': 0},
-                'P': {'shape': 'matrix', 'timeslice': 1e4, 'phase_only': False, 'first_selfcal': 0},
-                'B': {'shape': 'vector', 'timeslice': 1e5, 'phase_only': False, 'first_selfcal': 0},
-                'I': {'shape': 'vector', 'timeslice': 1.0, 'phase_only': True, 'first_selfcal': 0}}
+    controls = {'T': {'shape': 'scalar', 'timeslice': 'auto', 'phase_only': True, 'first_selfcal': 0,
+                      'solver': solver},
+                'G': {'shape': 'vector', 'timeslice': 60.0, 'phase_only': False, 'first_selfcal': 0,
+                      'solver': solver},
+                'P': {'shape': 'matrix', 'timeslice': 1e4, 'phase_only': False, 'first_selfcal': 0,
+                      'solver': 'antsol'},
+                'B': {'shape': 'vector', 'timeslice': 1e5, 'phase_only': False, 'first_selfcal': 0,
+                      'solver': solver},
+                'I': {'shape': 'vector', 'timeslice': 1.0, 'phase_only': True, 'first_selfcal': 0,
+                      'solver': solver}}
 
     return controls
 
@@ -82,7 +93,8 @@ def calibrate_function(vis, model_vis, calibration_context='T', controls=None, i
             gaintables[c] = solve_gaintable(avis, amvis,
                                             timeslice=controls[c]['timeslice'],
                                             phase_only=controls[c]['phase_only'],
-                                            crosspol=controls[c]['shape'] == 'matrix')
+                                            crosspol=controls[c]['shape'] == 'matrix',
+                                            solver=controls[c].get('solver', 'antsol'))
             log.debug('calibrate_function: Jones matrix %s, iteration %d' % (c, iteration))
             log.debug(qa_gaintable(gaintables[c], context='Jones matrix %s, iteration %d' % (c, iteration)))
             avis = apply_gaintable(avis, gaintables[c], inverse=True, timeslice=controls[c]['timeslice'])
@@ -116,8 +116,11 @@ def apply_gaintable(vis: BlockVisibility, gt: GainTable, inverse=False, vis_slic
     if is_scalar:
         log.debug('apply_gaintable: scalar gains')
 
+    # The baselines are at [time, a2, a1] in the dense block, and at [time, baseline] if compact
+    a1, a2 = numpy.triu_indices(vis.nants, 1)
+
     for chunk, rows in enumerate(vis_timeslice_iter(vis, vis_slices=vis_slices)):
-        if numpy.sum(rows) > 0:
+        if len(rows) > 0:
             vistime = numpy.average(vis.time[rows])
             gaintable_rows = abs(gt.time - vistime) < gt.interval / 2.0
             
@@ -129,39 +132,65 @@ def apply_gaintable(vis: BlockVisibility, gt: GainTable, inverse=False, vis_slic
             
             original = vis.vis[rows]
             applied = copy.deepcopy(original)
-            for time in range(ntimes):
-                for a1 in range(vis.nants - 1):
-                    for a2 in range(a1 + 1, vis.nants):
-                        if is_scalar:
-                            smueller = gain[time, a1, :, 0] * numpy.conjugate(gain[time, a2, :, 0])
-                            if inverse:
-                                if numpy.abs(smueller).all() > 0.0:
-                                    applied[time, a2, a1, :, 0][..., numpy.newaxis] = \
-                                        original[time, a2, a1, :, 0][..., numpy.newaxis] / smueller
-                            else:
-                                applied[time, a2, a1, :, 0][..., numpy.newaxis] = \
-                                    original[time, a2, a1, :, 0][..., numpy.newaxis] * smueller
-                        else:
-                            for chan in range(nchan):
-                                mueller = numpy.kron(gain[time, a1, chan, :, :],
-                                                     numpy.conjugate(gain[time, a2, chan, :, :]))
-                                if inverse:
-                                    # If the Mueller is singular, ignore it
-                                    try:
-                                        mueller = numpy.linalg.inv(mueller)
-                                        applied[time, a2, a1, chan, :] = \
-                                            numpy.matmul(mueller, original[time, a2, a1, chan, :])
-                                    except numpy.linalg.linalg.LinAlgError:
-                                        applied[time, a2, a1, chan, :] = \
-                                            original[time, a2, a1, chan, :]
-                                else:
-                                    applied[time, a2, a1, chan, :] = \
-                                        numpy.matmul(mueller, original[time, a2, a1, chan, :])
+            if vis.compact:
+                observed = original[:ntimes]
+            else:
+                observed = original[:ntimes, a2, a1]
+            
+            if is_scalar:
+                sgain = gain[..., 0, 0]
+                smueller = sgain[:, a1] * numpy.conjugate(sgain[:, a2])
+                corrected = observed[..., 0].copy()
+                if inverse:
+                    # Only correct the baselines with a non-zero gain product in every channel
+                    valid = numpy.all(numpy.abs(smueller) > 0.0, axis=-1)
+                    corrected[valid] = observed[..., 0][valid] / smueller[valid]
+                else:
+                    corrected = corrected * smueller
+                result = observed.copy()
+                result[..., 0] = corrected
+            else:
+                if inverse:
+                    # inv(kron(g1, g2*)) = kron(inv(g1), inv(g2)*). If the Mueller is singular, ignore it
+                    jones, valid = invert_jones_matrices(gain)
+                    valid = valid[:, a1] & valid[:, a2]
+                else:
+                    jones = gain
+                    valid = numpy.ones([ntimes, len(a1), nchan], dtype='bool')
+                # kron(g1, g2*) acting on the visibility as a 2x2 matrix V is g1 V g2^H
+                vmatrix = observed.reshape(observed.shape[:-1] + (nrec, nrec))
+                result = numpy.einsum('tbcij,tbcjl,tbckl->tbcik', jones[:, a1], vmatrix,
+                                      numpy.conjugate(jones[:, a2])).reshape(observed.shape)
+                result[~valid] = observed[~valid]
+            
+            if vis.compact:
+                applied[:ntimes] = result
+            else:
+                applied[:ntimes, a2, a1] = result
             
             vis.data['vis'][rows] = applied
     return vis
 
 
+def invert_jones_matrices(gain: numpy.ndarray):
+    """Invert the 2x2 Jones matrices of a gain array in closed form
+
+    :param gain: Gain array [..., 2, 2]
+    :return: inverse [..., 2, 2], boolean array [...] True where the matrix is not singular
+    """
+    assert gain.shape[-2:] == (2, 2), "Closed form inversion requires 2x2 Jones matrices"
+    det = gain[..., 0, 0] * gain[..., 1, 1] - gain[..., 0, 1] * gain[..., 1, 0]
+    valid = det != 0.0
+    rdet = numpy.zeros_like(det)
+    rdet[valid] = 1.0 / det[valid]
+    inverse = numpy.empty_like(gain)
+    inverse[..., 0, 0] = gain[..., 1, 1] * rdet
+    inverse[..., 0, 1] = -gain[..., 0, 1] * rdet
+    inverse[..., 1, 0] = -gain[..., 1, 0] * rdet
+    inverse[..., 1, 1] = gain[..., 0, 0] * rdet
+    return inverse, valid
+
+
 def append_gaintable(gt: GainTable, othergt: GainTable) -> GainTable:
     """Append othergt to gt
 
@@ -44,7 +44,8 @@ def import_image_from_fits(fitsfile: str) -> Image:
     with warnings.catch_warnings():
         warnings.simplefilter('ignore', FITSFixedWarning)
         hdulist = fits.open(fitsfile)
-        fim.data = hdulist[0].data
+        # FITS data are big-endian, the in-memory data models use native byte order
+        fim.data = hdulist[0].data.astype(hdulist[0].data.dtype.newbyteorder('='))
         fim.wcs = WCS(fitsfile)
         hdulist.close()
     
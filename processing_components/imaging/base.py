@@ -33,8 +33,10 @@ from data_models.memory_data_models import Visibility, BlockVisibility, Image, S
 from data_models.parameters import get_parameter
 from data_models.polarisation import convert_pol_frame, PolarisationFrame
 
-from libs.fourier_transforms.convolutional_gridding import convolutional_grid, convolutional_degrid
-from libs.fourier_transforms.fft_support import fft, ifft, pad_mid, extract_mid
+from libs.fourier_transforms.convolutional_gridding import convolutional_grid, convolutional_degrid, \
+    convolutional_grid_vectorised, convolutional_degrid_vectorised, convolutional_grid_hermitian
+from libs.fourier_transforms.fft_support import fft, ifft, fft2, irfft2, pad_mid, extract_mid, \
+    checkerboard, checkerboard_modulate
 from libs.image.operations import create_image_from_array
 from libs.imaging.imaging_params import get_frequency_map, get_polarisation_map, get_uvw_map, get_kernel_list
 from libs.util.coordinate_support import simulate_point, skycoord_to_lmn
@@ -129,9 +131,29 @@ def predict_2d(vis: Union[BlockVisibility, Visibility], model: Image,
     uvw_mode, shape, padding, vuvwmap = get_uvw_map(avis, model, **padding)
     kernel_name, gcf, vkernellist = get_kernel_list(avis, model, **kwargs)
     
-    uvgrid = fft((pad_mid(model.data, int(round(padding * nx))) * gcf).astype(dtype=complex))
-    
-    avis.data['vis'] = convolutional_degrid(vkernellist, avis.data['vis'].shape, uvgrid, vuvwmap, vfrequencymap)
+    # The FFT backend and number of threads can be chosen, otherwise the defaults in fft_support are used
+    fft_backend = get_parameter(kwargs, "fft_backend", None)
+    fft_workers = get_parameter(kwargs, "fft_workers", None)
+    npad = int(round(padding * nx))
+    if npad % 2 == 0:
+        # For even grids the shifts in fft are replaced by checkerboard modulation. The input modulation
+        # is fused into the gridding correction, applied before padding.
+        cb = extract_mid(checkerboard(npad, npad), nx)
+        uvgrid = pad_mid(model.data * (extract_mid(gcf, nx) * cb), npad).astype(dtype=complex)
+        uvgrid = checkerboard_modulate(fft2(uvgrid, backend=fft_backend, workers=fft_workers), signed=True)
+    else:
+        uvgrid = fft((pad_mid(model.data, npad) * gcf).astype(dtype=complex), backend=fft_backend,
+                     workers=fft_workers)
+    
+    # The vectorised degridder is much faster. The loop degridder is kept as a reference.
+    gridder = get_parameter(kwargs, "gridder", "vectorised")
+    if gridder == "vectorised":
+        avis.data['vis'] = convolutional_degrid_vectorised(vkernellist, avis.data['vis'].shape, uvgrid, vuvwmap,
+                                                           vfrequencymap)
+    elif gridder == "loop":
+        avis.data['vis'] = convolutional_degrid(vkernellist, avis.data['vis'].shape, uvgrid, vuvwmap, vfrequencymap)
+    else:
+        raise ValueError("Unknown gridder %s" % gridder)
     
     # Now we can shift the visibility from the image frame to the original visibility frame
     svis = shift_vis_to_image(avis, model, tangent=True, inverse=True)
@@ -180,9 +202,36 @@ def invert_2d(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool =
     kernel_name, gcf, vkernellist = get_kernel_list(svis, im, **kwargs)
     
     # Optionally pad to control aliasing
-    imgridpad = numpy.zeros([nchan, npol, int(round(padding * ny)), int(round(padding * nx))], dtype='complex')
-    imgridpad, sumwt = convolutional_grid(vkernellist, imgridpad, svis.data['vis'], svis.data['imaging_weight'],
-                                          vuvwmap, vfrequencymap)
+    nypad, nxpad = int(round(padding * ny)), int(round(padding * nx))
+    
+    # The vectorised gridder is much faster. The loop gridder is kept as a reference.
+    gridder = get_parameter(kwargs, "gridder", "vectorised")
+    
+    # Since the dirty image is real, only half of the uv plane is needed. The hermitian option grids onto
+    # that half plane and uses a complex to real FFT, halving the grid size and FFT time.
+    imaginary = get_parameter(kwargs, "imaginary", False)
+    hermitian = get_parameter(kwargs, "hermitian", False) and not imaginary
+    if hermitian and gridder != "vectorised":
+        log.warning("invert_2d: hermitian gridding is only done by the vectorised gridder, using %s gridder on "
+                    "the full plane" % gridder)
+        hermitian = False
+    if hermitian:
+        assert nypad % 2 == 0 and nxpad % 2 == 0, "Hermitian gridding requires even sized grid"
+        imgridpad = numpy.zeros([nchan, npol, nypad, nxpad // 2 + 1], dtype='complex')
+    else:
+        imgridpad = numpy.zeros([nchan, npol, nypad, nxpad], dtype='complex')
+    
+    if hermitian:
+        imgridpad, sumwt = convolutional_grid_hermitian(vkernellist, imgridpad, svis.data['vis'],
+                                                        svis.data['imaging_weight'], vuvwmap, vfrequencymap)
+    elif gridder == "vectorised":
+        imgridpad, sumwt = convolutional_grid_vectorised(vkernellist, imgridpad, svis.data['vis'],
+                                                         svis.data['imaging_weight'], vuvwmap, vfrequencymap)
+    elif gridder == "loop":
+        imgridpad, sumwt = convolutional_grid(vkernellist, imgridpad, svis.data['vis'], svis.data['imaging_weight'],
+                                              vuvwmap, vfrequencymap)
+    else:
+        raise ValueError("Unknown gridder %s" % gridder)
     
     # Fourier transform the padded grid to image, multiply by the gridding correction
     # function, and extract the unpadded inner part.
@@ -190,10 +239,28 @@ def invert_2d(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool =
     # Normalise weights for consistency with transform
     sumwt /= float(padding * int(round(padding * nx)) * ny)
     
-    imaginary = get_parameter(kwargs, "imaginary", False)
+    # The FFT backend and number of threads can be chosen, otherwise the defaults in fft_support are used
+    fft_backend = get_parameter(kwargs, "fft_backend", None)
+    fft_workers = get_parameter(kwargs, "fft_workers", None)
+    
+    if hermitian:
+        # The half grid is modulated so that irfft2 gives the image multiplied by (-1)**y
+        image = irfft2(imgridpad, (nypad, nxpad), backend=fft_backend, workers=fft_workers)
+        rowsign = 1 - 2 * (numpy.arange(nypad) % 2)
+        image = extract_mid(image, npixel=nx) * extract_mid(gcf * rowsign[:, numpy.newaxis], npixel=nx)
+    elif nypad % 2 == 0 and nxpad % 2 == 0:
+        # For even grids the shifts in ifft are replaced by checkerboard modulation. The output modulation
+        # is fused into the gridding correction, applied only to the inner part.
+        imgridpad = checkerboard_modulate(imgridpad)
+        image = fft2(imgridpad, inverse=True, backend=fft_backend, workers=fft_workers)
+        correction = extract_mid(gcf, npixel=nx) * extract_mid(checkerboard(nypad, nxpad, signed=True), npixel=nx)
+        image = extract_mid(image, npixel=nx) * correction
+    else:
+        image = extract_mid(ifft(imgridpad, backend=fft_backend, workers=fft_workers) * gcf, npixel=nx)
+    
     if imaginary:
         log.debug("invert_2d: retaining imaginary part of dirty image")
-        result = extract_mid(ifft(imgridpad) * gcf, npixel=nx)
+        result = image
         resultreal = create_image_from_array(result.real, im.wcs, im.polarisation_frame)
         resultimag = create_image_from_array(result.imag, im.wcs, im.polarisation_frame)
         if normalize:
@@ -201,7 +268,7 @@ def invert_2d(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool =
             resultimag = normalize_sumwt(resultimag, sumwt)
         return resultreal, sumwt, resultimag
     else:
-        result = extract_mid(numpy.real(ifft(imgridpad)) * gcf, npixel=nx)
+        result = image.real
         resultimage = create_image_from_array(result, im.wcs, im.polarisation_frame)
         if normalize:
             resultimage = normalize_sumwt(resultimage, sumwt)
@@ -237,7 +304,7 @@ def predict_skycomponent_visibility(vis: Union[Visibility, BlockVisibility],
                 
     elif isinstance(vis, BlockVisibility):
         
-        ntimes, nant, _, nchan, npol = vis.vis.shape
+        nchan = vis.nchan
     
         k = numpy.array(vis.frequency) / constants.c.to('m s^-1').value
     
@@ -251,9 +318,9 @@ def predict_skycomponent_visibility(vis: Union[Visibility, BlockVisibility],
         
             l, m, n = skycoord_to_lmn(comp.direction, vis.phasecentre)
             uvw = vis.uvw[..., numpy.newaxis] * k
-            phasor = numpy.ones([ntimes, nant, nant, nchan, npol], dtype='complex')
+            phasor = numpy.ones(vis.vis.shape, dtype='complex')
             for chan in range(nchan):
-                phasor[:,:,:,chan,:] = simulate_point(uvw[...,chan], l, m)[...,numpy.newaxis]
+                phasor[...,chan,:] = simulate_point(uvw[...,chan], l, m)[...,numpy.newaxis]
                 
             vis.data['vis'][..., :, :] += flux[:, :] * phasor[..., :]
 
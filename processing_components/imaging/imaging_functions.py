@@ -8,8 +8,6 @@
 
 import logging
 
-import numpy
-
 from data_models.memory_data_models import Visibility, Image
 
 from ..image.gather_scatter import image_scatter_facets
@@ -18,7 +16,7 @@ from ..imaging.base import normalize_sumwt
 from ..imaging.base import predict_2d, invert_2d
 from ..imaging.timeslice_single import predict_timeslice_single, invert_timeslice_single
 from ..imaging.wstack_single import predict_wstack_single, invert_wstack_single
-from ..visibility.base import copy_visibility, create_visibility_from_rows
+from ..visibility.base import copy_visibility, create_visibility_from_rows, create_visibility_view_from_rows
 from ..visibility.coalesce import convert_blockvisibility_to_visibility, convert_visibility_to_blockvisibility
 from ..visibility.iterators import vis_timeslice_iter, vis_null_iter, vis_wslice_iter
 
@@ -34,33 +32,40 @@ def imaging_contexts():
         image_iterator: Iterator for traversing images
         vis_iterator: Iterator for traversing visibilities
         inner: The innermost axis
+        view: The invert function leaves the visibility unchanged, so it can be given a read-only view
     
     :return:
     """
     contexts = {'2d': {'predict': predict_2d,
                        'invert': invert_2d,
                        'vis_iterator': vis_null_iter,
-                       'inner': 'image'},
+                       'inner': 'image',
+                       'view': True},
                 'facets': {'predict': predict_2d,
                            'invert': invert_2d,
                            'vis_iterator': vis_null_iter,
-                           'inner': 'image'},
+                           'inner': 'image',
+                           'view': True},
                 'facets_timeslice': {'predict': predict_timeslice_single,
                                      'invert': invert_timeslice_single,
                                      'vis_iterator': vis_timeslice_iter,
-                                     'inner': 'image'},
+                                     'inner': 'image',
+                                     'view': False},
                 'facets_wstack': {'predict': predict_wstack_single,
                                   'invert': invert_wstack_single,
                                   'vis_iterator': vis_wslice_iter,
-                                  'inner': 'image'},
+                                  'inner': 'image',
+                                  'view': False},
                 'timeslice': {'predict': predict_timeslice_single,
                               'invert': invert_timeslice_single,
                               'vis_iterator': vis_timeslice_iter,
-                              'inner': 'image'},
+                              'inner': 'image',
+                              'view': False},
                 'wstack': {'predict': predict_wstack_single,
                            'invert': invert_wstack_single,
                            'vis_iterator': vis_wslice_iter,
-                           'inner': 'image'}}
+                           'inner': 'image',
+                           'view': False}}
     
     return contexts
 
@@ -97,6 +102,11 @@ def invert_function(vis, im: Image, dopsf=False, normalize=True, context='2d', i
     c = imaging_context(context)
     vis_iter = c['vis_iterator']
     invert = c['invert']
+    # The timeslice and wstack inverts remove w from their input, so they need a copy of each slice
+    if c['view']:
+        create_slice = create_visibility_view_from_rows
+    else:
+        create_slice = create_visibility_from_rows
     if inner is None:
         inner = c['inner']
     
@@ -110,8 +120,8 @@ def invert_function(vis, im: Image, dopsf=False, normalize=True, context='2d', i
     if inner == 'image':
         totalwt = None
         for rows in vis_iter(svis, vis_slices=vis_slices):
-            if numpy.sum(rows):
-                visslice = create_visibility_from_rows(svis, rows)
+            if len(rows):
+                visslice = create_slice(svis, rows)
                 sumwt = 0.0
                 workimage = create_empty_image_like(im)
                 for dpatch in image_scatter_facets(workimage, facets=facets, overlap=overlap, taper=taper):
@@ -132,8 +142,8 @@ def invert_function(vis, im: Image, dopsf=False, normalize=True, context='2d', i
         for dpatch in image_scatter_facets(workimage, facets=facets, overlap=overlap, taper=taper):
             totalwt = None
             for rows in vis_iter(svis, vis_slices=vis_slices):
-                if numpy.sum(rows):
-                    visslice = create_visibility_from_rows(svis, rows)
+                if len(rows):
+                    visslice = create_slice(svis, rows)
                     result, sumwt = invert(visslice, dpatch, dopsf, normalize=False, **kwargs)
                     # Ensure that we fill in the elements of dpatch instead of creating a new numpy arrray
                     dpatch.data[...] += result.data[...]
@@ -189,7 +199,9 @@ def predict_function(vis, model: Image, context='2d', inner=None, vis_slices=1,
     
     if inner == 'image':
         for rows in vis_iter(svis, vis_slices=vis_slices):
-            if numpy.sum(rows):
+            if len(rows):
+                # The predict functions overwrite the vis of their input, so this slice must be a copy rather
+                # than a view: writing through a view would add the prediction into svis twice
                 visslice = create_visibility_from_rows(svis, rows)
                 visslice.data['vis'][...] = 0.0
                 for dpatch in image_scatter_facets(model, facets=facets, overlap=overlap, taper=taper):
@@ -199,7 +211,8 @@ def predict_function(vis, model: Image, context='2d', inner=None, vis_slices=1,
     else:
         for dpatch in image_scatter_facets(model, facets=facets, overlap=overlap, taper=taper):
             for rows in vis_iter(svis, vis_slices=vis_slices):
-                if numpy.sum(rows):
+                if len(rows):
+                    # A copy for the same reason as above
                     visslice = create_visibility_from_rows(svis, rows)
                     result.data['vis'][...] = 0.0
                     result = predict(visslice, dpatch, **kwargs)
@@ -11,7 +11,7 @@ from astropy import constants as constants
 from astropy import units as u
 from astropy.coordinates import SkyCoord
 
-from data_models.memory_data_models import Visibility, BlockVisibility, Configuration
+from data_models.memory_data_models import Visibility, BlockVisibility, Configuration, VisibilityColumns
 from data_models.polarisation import PolarisationFrame, ReceptorFrame, correlate_polarisation
 from libs.util.coordinate_support import xyz_to_uvw, uvw_to_xyz, skycoord_to_lmn, simulate_point
 
@@ -33,7 +33,7 @@ def copy_visibility(vis: Union[Visibility, BlockVisibility], zero=False) -> Unio
     assert isinstance(vis, Visibility) or isinstance(vis, BlockVisibility), vis
     
     newvis = copy.copy(vis)
-    newvis.data = numpy.copy(vis.data)
+    newvis.data = vis.data.copy()
     if isinstance(vis, Visibility):
         newvis.cindex = vis.cindex
         newvis.blockvis = vis.blockvis
@@ -42,6 +42,26 @@ def copy_visibility(vis: Union[Visibility, BlockVisibility], zero=False) -> Unio
     return newvis
 
 
+def convert_visibility_layout(vis: Visibility, columnar=True) -> Visibility:
+    """ Convert a Visibility between columnar data and a numpy structured array
+
+    The columnar form (VisibilityColumns) holds each column as a separate contiguous array, which is faster to
+    stream through e.g. gridding. The structured array is the form used for persistence.
+
+    :param vis: Visibility
+    :param columnar: Convert to columnar data (True) or to a structured array (False)
+    :return: Visibility with data in the requested layout, sharing everything else with vis
+    """
+    assert isinstance(vis, Visibility), vis
+    
+    newvis = copy.copy(vis)
+    if columnar:
+        newvis.data = VisibilityColumns(vis.data)
+    else:
+        newvis.data = numpy.asarray(vis.data)
+    return newvis
+
+
 def create_visibility(config: Configuration, times: numpy.array, frequency: numpy.array,
                       channel_bandwidth, phasecentre: SkyCoord,
                       weight: float, polarisation_frame=PolarisationFrame('stokesI'),
@@ -131,11 +151,13 @@ def create_blockvisibility(config: Configuration,
                            polarisation_frame: PolarisationFrame = None,
                            integration_time=1.0,
                            channel_bandwidth=1e6,
-                           zerow=False, **kwargs) -> BlockVisibility:
+                           zerow=False, compact=False, **kwargs) -> BlockVisibility:
     """ Create a BlockVisibility from Configuration, hour angles, and direction of source
 
     Note that we keep track of the integration time for BDA purposes
 
+    If compact is True, only the baselines a1 < a2 are held (see BlockVisibility)
+
     :param config: Configuration of antennas
     :param times: hour angles in radians
     :param frequency: frequencies (Hz] [nchan]
@@ -144,6 +166,7 @@ def create_blockvisibility(config: Configuration,
     :param channel_bandwidth: channel bandwidths: (Hz] [nchan]
     :param integration_time: Integration time ('auto' or value in s)
     :param polarisation_frame:
+    :param compact: Hold only the baselines a1 < a2
     :return: BlockVisibility
     """
     assert phasecentre is not None, "Must specify phase centre"
@@ -156,11 +179,16 @@ def create_blockvisibility(config: Configuration,
     nants = len(config.data['names'])
     ntimes = len(times)
     npol = polarisation_frame.npol
-    visshape = [ntimes, nants, nants, nch, npol]
+    if compact:
+        a1, a2 = numpy.triu_indices(nants, 1)
+        visshape = [ntimes, len(a1), nch, npol]
+        ruvw = numpy.zeros([ntimes, len(a1), 3])
+    else:
+        visshape = [ntimes, nants, nants, nch, npol]
+        ruvw = numpy.zeros([ntimes, nants, nants, 3])
     rvis = numpy.zeros(visshape, dtype='complex')
     rweight = weight * numpy.ones(visshape)
     rtimes = numpy.zeros([ntimes])
-    ruvw = numpy.zeros([ntimes, nants, nants, 3])
     
     # Do each hour angle in turn
     for iha, ha in enumerate(times):
@@ -170,11 +198,14 @@ def create_blockvisibility(config: Configuration,
         ant_pos = xyz_to_uvw(ants_xyz, ha, phasecentre.dec.rad)
         rtimes[iha] = ha * 43200.0 / numpy.pi
         
-        # Loop over all pairs of antennas. Note that a2>a1
-        for a1 in range(nants):
-            for a2 in range(a1 + 1, nants):
-                ruvw[iha, a2, a1, :] = (ant_pos[a2, :] - ant_pos[a1, :])
-                ruvw[iha, a1, a2, :] = (ant_pos[a1, :] - ant_pos[a2, :])
+        if compact:
+            ruvw[iha] = ant_pos[a2, :] - ant_pos[a1, :]
+        else:
+            # Loop over all pairs of antennas. Note that a2>a1
+            for ant1 in range(nants):
+                for ant2 in range(ant1 + 1, nants):
+                    ruvw[iha, ant2, ant1, :] = (ant_pos[ant2, :] - ant_pos[ant1, :])
+                    ruvw[iha, ant1, ant2, :] = (ant_pos[ant1, :] - ant_pos[ant2, :])
     
     rintegration_time = numpy.full_like(rtimes, integration_time)
     rchannel_bandwidth = numpy.full_like(frequency, channel_bandwidth)
@@ -191,50 +222,163 @@ def create_blockvisibility(config: Configuration,
     return vis
 
 
+def convert_blockvisibility_to_compact(vis: BlockVisibility) -> BlockVisibility:
+    """ Convert a dense BlockVisibility to the compact form, keeping only the baselines a1 < a2
+
+    The autocorrelations and the baselines a1 > a2 are dropped.
+
+    :param vis: BlockVisibility
+    :return: Compact BlockVisibility
+    """
+    assert isinstance(vis, BlockVisibility), vis
+    if vis.compact:
+        return vis
+    
+    a1, a2 = numpy.triu_indices(vis.nants, 1)
+    newvis = BlockVisibility(frequency=vis.frequency, channel_bandwidth=vis.channel_bandwidth,
+                             phasecentre=vis.phasecentre, configuration=vis.configuration,
+                             uvw=vis.uvw[:, a2, a1, :], time=vis.time, vis=vis.vis[:, a2, a1, ...],
+                             weight=vis.weight[:, a2, a1, ...], integration_time=vis.integration_time,
+                             polarisation_frame=vis.polarisation_frame)
+    newvis.data['index'] = vis.data['index']
+    return newvis
+
+
+def convert_compact_to_blockvisibility(vis: BlockVisibility) -> BlockVisibility:
+    """ Convert a compact BlockVisibility to the dense form
+
+    The uvw are filled in for both a1 < a2 and a1 > a2. The vis and weight are filled in for a1 < a2 only, and are
+    zero elsewhere.
+
+    :param vis: Compact BlockVisibility
+    :return: BlockVisibility
+    """
+    assert isinstance(vis, BlockVisibility), vis
+    if not vis.compact:
+        return vis
+    
+    ntimes, nbaselines, nchan, npol = vis.vis.shape
+    nants = vis.nants
+    a1, a2 = numpy.triu_indices(nants, 1)
+    uvw = numpy.zeros([ntimes, nants, nants, 3])
+    uvw[:, a2, a1, :] = vis.uvw
+    uvw[:, a1, a2, :] = -vis.uvw
+    dvis = numpy.zeros([ntimes, nants, nants, nchan, npol], dtype='complex')
+    dvis[:, a2, a1, ...] = vis.vis
+    dweight = numpy.zeros([ntimes, nants, nants, nchan, npol])
+    dweight[:, a2, a1, ...] = vis.weight
+    newvis = BlockVisibility(frequency=vis.frequency, channel_bandwidth=vis.channel_bandwidth,
+                             phasecentre=vis.phasecentre, configuration=vis.configuration,
+                             uvw=uvw, time=vis.time, vis=dvis, weight=dweight,
+                             integration_time=vis.integration_time, polarisation_frame=vis.polarisation_frame)
+    newvis.data['index'] = vis.data['index']
+    return newvis
+
+
 def create_visibility_from_rows(vis: Union[Visibility, BlockVisibility], rows: numpy.ndarray, makecopy=True) \
         -> None:
     """ Create a Visibility from selected rows
 
+    Only the selected rows are copied. The configuration, phase centre, etc. are shared with vis.
+
     :param vis: Visibility
-    :param rows: Boolean array of row selction
-    :param makecopy: Make a deep copy (True)
+    :param rows: Boolean array of row selction, or array (or sequence) of row numbers
+    :param makecopy: Make a new Visibility (True), or replace the data of vis
     :return: Visibility
     """
     
-    if rows is None or numpy.sum(rows) == 0:
+    if rows is None:
         return None
     
-    assert len(rows) == vis.nvis, "Length of rows does not agree with length of visibility"
+    rows = numpy.asarray(rows)
+    if rows.dtype == bool:
+        if numpy.sum(rows) == 0:
+            return None
+        assert len(rows) == vis.nvis, "Length of rows does not agree with length of visibility"
+    elif len(rows) == 0:
+        return None
     
     if isinstance(vis, Visibility):
         
         if makecopy:
-            newvis = copy_visibility(vis)
-            if vis.cindex is not None and len(rows) == len(vis.cindex):
+            newvis = copy.copy(vis)
+            if vis.cindex is not None and len(vis.cindex) == vis.nvis:
                 newvis.cindex = vis.cindex[rows]
             else:
                 newvis.cindex = None
-            if vis.blockvis is not None:
-                newvis.blockvis = vis.blockvis
-            newvis.data = copy.deepcopy(vis.data[rows])
+            newvis.data = vis.data[rows]
             return newvis
         else:
-            vis.data = copy.deepcopy(vis.data[rows])
+            vis.data = vis.data[rows]
             if vis.cindex is not None:
                 vis.cindex = vis.cindex[rows]
             return vis
     else:
         
         if makecopy:
-            newvis = copy_visibility(vis)
-            newvis.data = copy.deepcopy(vis.data[rows])
+            newvis = copy.copy(vis)
+            newvis.data = vis.data[rows]
             return newvis
         else:
-            vis.data = copy.deepcopy(vis.data[rows])
+            vis.data = vis.data[rows]
             
             return vis
 
 
+def rows_to_slice(rows: Union[numpy.ndarray, slice]) -> Union[slice, None]:
+    """ Convert a selection of rows to a slice, if the rows are contiguous
+
+    :param rows: Boolean array of row selection, array of row numbers, or slice
+    :return: slice, or None if the rows are not contiguous
+    """
+    if isinstance(rows, slice):
+        return rows
+    rows = numpy.asarray(rows)
+    if rows.dtype == bool:
+        rows = numpy.flatnonzero(rows)
+    if len(rows) == 0:
+        return None
+    if rows[-1] - rows[0] + 1 == len(rows) and numpy.all(numpy.diff(rows) == 1):
+        return slice(int(rows[0]), int(rows[-1]) + 1)
+    return None
+
+
+def create_visibility_view_from_rows(vis: Union[Visibility, BlockVisibility], rows, writeable=False) \
+        -> Union[Visibility, BlockVisibility]:
+    """ Create a Visibility sharing the data of selected rows, without copying
+
+    If the rows are contiguous (e.g. a time slice of a BlockVisibility, or the slices from vis_slice_views), the
+    data of the new Visibility is a view into vis.data, and everything else is shared with vis. Otherwise the
+    selected rows are copied as in create_visibility_from_rows. The data are read-only unless writeable is True, in
+    which case writes to a view go through to vis.
+
+    :param vis: Visibility or BlockVisibility
+    :param rows: Boolean array of row selection, array of row numbers, or slice
+    :param writeable: Allow writing to the data (False)
+    :return: Visibility or BlockVisibility, or None if no rows are selected
+    """
+    if rows is None:
+        return None
+    
+    rowslice = rows_to_slice(rows)
+    if rowslice is None:
+        newvis = create_visibility_from_rows(vis, rows)
+    else:
+        newvis = copy.copy(vis)
+        newvis.data = vis.data[rowslice]
+        if len(newvis.data) == 0:
+            return None
+        if isinstance(vis, Visibility):
+            if vis.cindex is not None and len(vis.cindex) == vis.nvis:
+                newvis.cindex = vis.cindex[rowslice]
+            else:
+                newvis.cindex = None
+    
+    if newvis is not None and not writeable:
+        newvis.data.setflags(write=False)
+    return newvis
+
+
 def phaserotate_visibility(vis: Visibility, newphasecentre: SkyCoord, tangent=True, inverse=False) -> Visibility:
     """
     Phase rotate from the current phase centre to a new phase centre
@@ -22,7 +22,7 @@ import numpy
 
 from astropy import constants
 
-from libs.util.array_functions import average_chunks, average_chunks2
+from libs.util.array_functions import average_chunks2_batch
 
 from data_models.memory_data_models import Visibility, BlockVisibility
 from data_models.parameters import get_parameter
@@ -45,6 +45,11 @@ def coalesce_visibility(vis: BlockVisibility, **kwargs) -> Visibility:
 
     If coalescence_factor=0.0 then just a format conversion is done
 
+    If columnar=True then the Visibility holds its columns as separate arrays (see VisibilityColumns)
+
+    If a CoalescencePlan made by create_coalescence_plan is given as coalescence_plan, and it matches vis, it is
+    used instead of recalculating the coalescence.
+
     :param vis: BlockVisibility to be coalesced
     :return: Coalesced visibility with  cindex and blockvis filled in
     """
@@ -55,9 +60,14 @@ def coalesce_visibility(vis: BlockVisibility, **kwargs) -> Visibility:
     max_time_coal = get_parameter(kwargs, 'max_time_coal', 100)
     frequency_coal = get_parameter(kwargs, 'frequency_coal', 0.0)
     max_frequency_coal = get_parameter(kwargs, 'max_frequency_coal', 100)
+    columnar = get_parameter(kwargs, 'columnar', False)
+
+    coalescence_plan = get_parameter(kwargs, 'coalescence_plan', None)
+    if coalescence_plan is not None and coalescence_plan.matches(vis):
+        return coalescence_plan.coalesce(vis)
 
     if time_coal == 0.0 and frequency_coal == 0.0:
-        return convert_blockvisibility_to_visibility((vis))
+        return convert_blockvisibility_to_visibility(vis, columnar=columnar)
 
     cvis, cuvw, cwts, ctime, cfrequency, cchannel_bandwidth, ca1, ca2, cintegration_time, cindex \
         = average_in_blocks(vis.data['vis'], vis.data['uvw'], vis.data['weight'], vis.time, vis.integration_time,
@@ -70,7 +80,7 @@ def coalesce_visibility(vis: BlockVisibility, **kwargs) -> Visibility:
                                weight=cwts, imaging_weight=cimwt,
                                configuration=vis.configuration, integration_time=cintegration_time,
                                polarisation_frame=vis.polarisation_frame, cindex=cindex,
-                               blockvis=vis)
+                               blockvis=vis, columnar=columnar)
 
     log.debug('coalesce_visibility: Created new Visibility for coalesced data_models, coalescence factors (t,f) = (%.3f,%.3f)'
               % (time_coal, frequency_coal))
@@ -81,10 +91,11 @@ def coalesce_visibility(vis: BlockVisibility, **kwargs) -> Visibility:
     return coalesced_vis
 
 
-def convert_blockvisibility_to_visibility(vis: BlockVisibility) -> Visibility:
+def convert_blockvisibility_to_visibility(vis: BlockVisibility, columnar=False) -> Visibility:
     """ Convert the BlockVisibility data with no coalescence
 
     :param vis: BlockVisibility to be converted
+    :param columnar: Hold the columns of the Visibility as separate arrays
     :return: Visibility with  cindex and blockvis filled in
     """
 
@@ -100,7 +111,7 @@ def convert_blockvisibility_to_visibility(vis: BlockVisibility) -> Visibility:
                                weight=cwts, imaging_weight=cimwt,
                                configuration=vis.configuration, integration_time=cintegration_time,
                                polarisation_frame=vis.polarisation_frame, cindex=cindex,
-                               blockvis=vis)
+                               blockvis=vis, columnar=columnar)
 
     log.debug('convert_visibility: Original %s, converted %s' % (vis_summary(vis),
                                                                  vis_summary(converted_vis)))
@@ -130,12 +141,10 @@ def decoalesce_visibility(vis: Visibility, overwrite=False, **kwargs) -> BlockVi
 
     vshape = decomp_vis.data['vis'].shape
 
-    npol = vshape[-1]
-    dvis = numpy.zeros(vshape, dtype='complex')
-    assert numpy.max(vis.cindex) < dvis.size
+    assert vis.cindex.size * vshape[-1] == numpy.prod(vshape), "Incorrect template used in decoalescing"
     assert numpy.max(vis.cindex) < vis.vis.shape[0], "Incorrect template used in decoalescing"
-    for i in range(dvis.size // npol):
-        decomp_vis.data['vis'].flat[i:i + npol] = vis.data['vis'][vis.cindex[i]]
+    # Each element [time, baseline, channel] of the block takes all polarisations from its row in the coalesced data
+    decomp_vis.data['vis'][...] = vis.data['vis'][vis.cindex].reshape(vshape)
 
     log.debug('decoalesce_visibility: Coalesced %s, decoalesced %s' % (vis_summary(vis),
                                                                        vis_summary(
@@ -144,63 +153,259 @@ def decoalesce_visibility(vis: Visibility, overwrite=False, **kwargs) -> BlockVi
     return decomp_vis
 
 
-def average_in_blocks(vis, uvw, wts, times, integration_time, frequency, channel_bandwidth, time_coal=1.0,
-                      max_time_coal=100, frequency_coal=1.0, max_frequency_coal=100):
-    # Calculate the averaging factors for time and frequency making them the same for all times
-    # for this baseline
-    # Find the maximum possible baseline and then scale to this.
+class CoalescencePlan:
+    """ Plan for coalescing a BlockVisibility, and decoalescing back, by array operations alone
 
-    # The input visibility is a block of shape [ntimes, nant, nant, nchan, npol]. We will map this
-    # into rows like vis[npol] and with additional columns antenna1, antenna2, frequency
+    The mapping from the BlockVisibility to the coalesced Visibility depends only on the uvw, times, frequencies,
+    and on which samples have zero weight. None of these change between major cycles, so the plan holds the
+    coalesced Visibility as a template (with uvw, time, frequency, etc. already averaged), the index cindex, and the
+    rows to which each sample of the block contributes. Coalescing is then a weighted sum of the vis and weight
+    columns over cindex, and decoalescing is a gather on cindex.
 
+    Rows that come from a single sample take the vis and weight of that sample unchanged, except that as in
+    average_chunks2 the vis is zero if the sample has zero weight and its baseline is averaged. Use
+    create_coalescence_plan to make a plan, and pass it to coalesce_visibility (and hence predict_2d, invert_2d,
+    and the imaging workflows) as coalescence_plan.
+    """
+    
+    def __init__(self, template: Visibility, source, copied=None):
+        """ Create a coalescence plan
+
+        :param template: Coalesced Visibility with cindex and blockvis filled in
+        :param source: Flat indices [time, baseline, channel] of the block samples contributing to the coalesced rows
+        :param copied: For each source sample, True if its baseline is not averaged (default all True)
+        """
+        self.blockshape = template.blockvis.vis.shape
+        self.time = numpy.copy(template.blockvis.time)
+        self.frequency = numpy.copy(template.blockvis.frequency)
+        self.zero_weight = numpy.packbits(template.blockvis.weight == 0.0)
+        self.template = copy_visibility(template)
+        self.template.blockvis = None
+        self.cindex = template.cindex
+        self.source = source
+        self.rows = self.cindex[source]
+        self.nrows = template.nvis
+        count = numpy.bincount(self.rows, minlength=self.nrows)
+        self.averaged = numpy.max(count) > 1
+        # The sample of the block for each row coming from just one sample
+        self.single_rows = numpy.where(count == 1)[0]
+        sample = numpy.zeros(self.nrows, dtype='int')
+        sample[self.rows] = numpy.arange(len(self.rows))
+        self.single_samples = sample[self.single_rows]
+        # The single sample rows of averaged baselines, which are zeroed where the weight is zero
+        if copied is None:
+            self.averaged_single_rows = numpy.zeros([0], dtype='int')
+        else:
+            self.averaged_single_rows = self.single_rows[~copied[self.single_samples]]
+    
+    def __str__(self):
+        return "CoalescencePlan: block shape %s, %d coalesced rows, averaged %s" % \
+               (str(self.blockshape), self.nrows, self.averaged)
+    
+    def matches(self, vis: BlockVisibility):
+        """ Can this plan be used for this BlockVisibility?
+
+        :param vis: BlockVisibility
+        :return: True if vis has the same shape, times, frequencies, and zero weights as the BlockVisibility the plan
+            was made for
+        """
+        return isinstance(vis, BlockVisibility) and vis.vis.shape == self.blockshape \
+               and numpy.array_equal(vis.time, self.time) and numpy.array_equal(vis.frequency, self.frequency) \
+               and numpy.array_equal(numpy.packbits(vis.weight == 0.0), self.zero_weight)
+    
+    def coalesce(self, vis: BlockVisibility) -> Visibility:
+        """ Coalesce a BlockVisibility using this plan (forward pass)
+
+        The current vis and weight columns of vis are used.
+
+        :param vis: BlockVisibility matching the plan
+        :return: Coalesced visibility with cindex and blockvis filled in
+        """
+        assert self.matches(vis), "Coalescence plan does not match vis %r" % vis
+        npol = self.blockshape[-1]
+        bvis = vis.data['vis'].reshape([-1, npol])[self.source]
+        bwts = vis.data['weight'].reshape([-1, npol])[self.source]
+        
+        coalesced_vis = copy_visibility(self.template)
+        coalesced_vis.blockvis = vis
+        if not self.averaged:
+            coalesced_vis.data['vis'][self.rows] = bvis
+            coalesced_vis.data['weight'][self.rows] = bwts
+        else:
+            wvis = bwts * bvis
+            for pol in range(npol):
+                cwts = numpy.bincount(self.rows, weights=bwts[:, pol], minlength=self.nrows)
+                cvis = numpy.bincount(self.rows, weights=wvis[:, pol].real, minlength=self.nrows) + \
+                       1j * numpy.bincount(self.rows, weights=wvis[:, pol].imag, minlength=self.nrows)
+                cvis[cwts > 0.0] /= cwts[cwts > 0.0]
+                coalesced_vis.data['vis'][:, pol] = cvis
+                coalesced_vis.data['weight'][:, pol] = cwts
+            coalesced_vis.data['vis'][self.single_rows] = bvis[self.single_samples]
+            coalesced_vis.data['weight'][self.single_rows] = bwts[self.single_samples]
+        rows = self.averaged_single_rows
+        coalesced_vis.data['vis'][rows] *= coalesced_vis.data['weight'][rows] != 0.0
+        coalesced_vis.data['imaging_weight'][...] = 1.0
+        return coalesced_vis
+    
+    def decoalesce(self, vis: Visibility, overwrite=False) -> BlockVisibility:
+        """ Decoalesce a Visibility made by this plan (backward pass)
+
+        :param vis: Coalesced visibility
+        :param overwrite: Fill into a copy of the BlockVisibility rather than the BlockVisibility itself
+        :return: BlockVisibility with vis column overwritten
+        """
+        assert vis.cindex is self.cindex, "Visibility was not coalesced with this plan"
+        return decoalesce_visibility(vis, overwrite=overwrite)
+
+
+def create_coalescence_plan(vis: BlockVisibility, **kwargs) -> CoalescencePlan:
+    """ Create a plan for coalescing a BlockVisibility, to be reused every time the vis is coalesced
+
+    The coalescence parameters are those of coalesce_visibility::
+
+        plan = create_coalescence_plan(vt, time_coal=1.0, max_time_coal=100)
+        dirtyimage, sumwt = invert_2d(vt, model, coalescence_plan=plan, time_coal=1.0, max_time_coal=100)
+
+    :param vis: BlockVisibility
+    :return: CoalescencePlan
+    """
+    assert isinstance(vis, BlockVisibility), "vis is not a BlockVisibility: %r" % vis
+    
+    kwargs = dict(kwargs)
+    kwargs.pop('coalescence_plan', None)
+    coalesced_vis = coalesce_visibility(vis, **kwargs)
+    
+    # The samples contributing are those of the upper triangle for conversion, and all samples of baselines with
+    # some weight for averaging
+    ntimes, nchan, npol = vis.vis.shape[0], vis.nchan, vis.npol
+    weight = vis.data['weight'].reshape([ntimes, -1, nchan, npol])
+    nblock = weight.shape[1]
+    time_coal = get_parameter(kwargs, 'time_coal', 0.0)
+    frequency_coal = get_parameter(kwargs, 'frequency_coal', 0.0)
+    if time_coal == 0.0 and frequency_coal == 0.0:
+        if vis.compact:
+            baselines = numpy.ones([nblock], dtype='bool')
+        else:
+            baselines = numpy.tril(numpy.ones([vis.nants, vis.nants], dtype='bool'), -1).flatten()
+        copied = None
+    else:
+        _, uvw, _, ba1, ba2, nant = block_baselines(vis.data['vis'], vis.data['uvw'], vis.data['weight'])
+        allpwtsgrid = numpy.sum(weight, axis=3)
+        baselines, time_average, frequency_average = \
+            averaging_factors(uvw, allpwtsgrid, ba1, ba2, nant, time_coal, get_parameter(kwargs, 'max_time_coal', 100),
+                              frequency_coal, get_parameter(kwargs, 'max_frequency_coal', 100))
+        copied = (time_average == 1) & (frequency_average == 1)
+    mask = numpy.broadcast_to(baselines[numpy.newaxis, :, numpy.newaxis], [ntimes, nblock, nchan])
+    source = numpy.flatnonzero(mask)
+    if copied is not None:
+        copied = copied[(source // nchan) % nblock]
+    
+    plan = CoalescencePlan(coalesced_vis, source, copied)
+    log.debug('create_coalescence_plan: %s' % str(plan))
+    return plan
+
+
+def block_baselines(vis, uvw, wts):
+    """ Reshape the block data to have a single baseline axis
+
+    For a dense block [ntimes, nant, nant, nchan, npol] every (a2, a1) is a baseline, in the order of a2 and then
+    a1. For a compact block [ntimes, nbaselines, nchan, npol] the baselines are those with a1 < a2, in the order of
+    numpy.triu_indices(nant, 1).
+
+    :param vis: Block visibility
+    :param uvw: Block uvw
+    :param wts: Block weights
+    :return: vis, uvw, wts with baseline axis, antenna1 and antenna2 for each baseline, nant
+    """
+    if vis.ndim == 4:
+        nbaselines = vis.shape[1]
+        nant = int(round(0.5 + numpy.sqrt(0.25 + 2 * nbaselines)))
+        a1, a2 = numpy.triu_indices(nant, 1)
+        return vis, uvw, wts, a1, a2, nant
+    
     ntimes, nant, _, nchan, npol = vis.shape
+    a2, a1 = numpy.divmod(numpy.arange(nant * nant), nant)
+    return vis.reshape([ntimes, nant * nant, nchan, npol]), uvw.reshape([ntimes, nant * nant, 3]), \
+           wts.reshape([ntimes, nant * nant, nchan, npol]), a1, a2, nant
 
-    # Pol independent weighting
-    allpwtsgrid = numpy.sum(wts, axis=4)
-    # Pol and frequency independent weighting
-    allcpwtsgrid = numpy.sum(allpwtsgrid, axis=3)
-    # Pol and time independent weighting
-    alltpwtsgrid = numpy.sum(allpwtsgrid, axis=0)
+
+def averaging_factors(uvw, allpwtsgrid, ba1, ba2, nant, time_coal=1.0, max_time_coal=100, frequency_coal=1.0,
+                      max_frequency_coal=100):
+    """ Find the time and frequency averaging factors for each baseline
+
+    The number of integrations averaged goes as the ratio of the maximum possible baseline length to that for the
+    baseline.
+
+    :param uvw: uvw with baseline axis [ntimes, nbaselines, 3], as from block_baselines
+    :param allpwtsgrid: Weights summed over polarisation [ntimes, nbaselines, nchan]
+    :param ba1: antenna1 for each baseline
+    :param ba2: antenna2 for each baseline
+    :param nant: Number of antennas
+    :return: baselines with some weight, time averaging factors, frequency averaging factors
+    """
+    # The scale uvmax is as found from the first three rows of the dense uvw block [ntimes, nant, nant, 3]: the
+    # largest, over times, antennas a and axes, of the sum of the squares over the baselines from antennas 0, 1
+    # and 2 to a. A compact block holds each of these baselines once, as either (a, row) or (row, a), so it gives the
+    # same uvmax and hence the same coalescence.
+    nbaselines = uvw.shape[1]
+    compact = nbaselines != nant * nant
+    uvwsq = numpy.zeros([uvw.shape[0], nant, 3])
+    for row in range(3):
+        uvwsq[:, ba1[ba2 == row]] += uvw[:, ba2 == row] ** 2
+        if compact:
+            uvwsq[:, ba2[ba1 == row]] += uvw[:, ba1 == row] ** 2
+    uvmax = numpy.sqrt(numpy.max(uvwsq))
+
+    # Only baselines with some weight are coalesced
+    present = numpy.any(allpwtsgrid, axis=(0, 2))
 
     # Now calculate on a baseline basis the time and frequency averaging. We do this by looking at
     # the maximum uv distance for all data and for a given baseline. The integration time and
     # channel bandwidth are scale appropriately.
-    uvmax = numpy.sqrt(numpy.max(uvw[:, 0] ** 2 + uvw[:, 1] ** 2 + uvw[:, 2] ** 2))
-    time_average = numpy.ones([nant, nant], dtype='int')
-    frequency_average = numpy.ones([nant, nant], dtype='int')
-    ua = numpy.arange(nant)
-    for a2 in ua:
-        for a1 in ua:
-            if allpwtsgrid[:, a2, a1, :].any() > 0.0:
-                uvdist = numpy.max(numpy.sqrt(uvw[:, a2, a1, 0] ** 2 + uvw[:, a2, a1, 1] ** 2), axis=0)
-                if uvdist > 0.0:
-                    time_average[a2, a1] = min(max_time_coal,
-                                               max(1, int(round((time_coal * uvmax / uvdist)))))
-                    frequency_average[a2, a1] = min(max_frequency_coal,
-                                                    max(1, int(round(frequency_coal * uvmax / uvdist))))
-                else:
-                    time_average[a2, a1] = max_time_coal
-                    frequency_average[a2, a1] = max_frequency_coal
-
-    # See how many time chunks and frequency we need for each baseline. To do this we use the same averaging that
-    # we will use later for the actual data_models. This tells us the number of chunks required for each baseline.
-    frequency_grid, time_grid = numpy.meshgrid(frequency, times)
-    channel_bandwidth_grid, integration_time_grid = numpy.meshgrid(channel_bandwidth, integration_time)
-    cnvis = 0
-    time_chunk_len = numpy.ones([nant, nant], dtype='int')
-    frequency_chunk_len = numpy.ones([nant, nant], dtype='int')
-    for a2 in ua:
-        for a1 in ua:
-            if (time_average[a2, a1] > 0) & (frequency_average[a2, a1] > 0 & (allpwtsgrid[:, a2, a1, ...].any() > 0.0)):
-                time_chunks, _ = average_chunks(times, allcpwtsgrid[:, a2, a1], time_average[a2, a1])
-                time_chunk_len[a2, a1] = time_chunks.shape[0]
-                frequency_chunks, _ = average_chunks(frequency, alltpwtsgrid[a2, a1, :], frequency_average[a2, a1])
-                frequency_chunk_len[a2, a1] = frequency_chunks.shape[0]
-                nrows = time_chunk_len[a2, a1] * frequency_chunk_len[a2, a1]
-                cnvis += nrows
+    uvdist = numpy.max(numpy.sqrt(uvw[..., 0] ** 2 + uvw[..., 1] ** 2), axis=0)
+    time_average = numpy.ones([nbaselines], dtype='int')
+    frequency_average = numpy.ones([nbaselines], dtype='int')
+    nonzero = present & (uvdist > 0.0)
+    time_average[nonzero] = numpy.minimum(max_time_coal,
+                                          numpy.maximum(1, numpy.round(time_coal * uvmax / uvdist[nonzero])))
+    frequency_average[nonzero] = numpy.minimum(max_frequency_coal,
+                                               numpy.maximum(1, numpy.round(frequency_coal * uvmax /
+                                                                            uvdist[nonzero])))
+    zero = present & ~nonzero
+    time_average[zero] = max_time_coal
+    frequency_average[zero] = max_frequency_coal
+    
+    return present, time_average, frequency_average
+
+
+def average_in_blocks(vis, uvw, wts, times, integration_time, frequency, channel_bandwidth, time_coal=1.0,
+                      max_time_coal=100, frequency_coal=1.0, max_frequency_coal=100):
+    # Calculate the averaging factors for time and frequency making them the same for all times
+    # for this baseline
+    # Find the maximum possible baseline and then scale to this.
+
+    # The input visibility is a block of shape [ntimes, nant, nant, nchan, npol], or [ntimes, nbaselines, nchan,
+    # npol] if compact. We will map this into rows like vis[npol] and with additional columns antenna1, antenna2,
+    # frequency
+
+    vis, uvw, wts, ba1, ba2, nant = block_baselines(vis, uvw, wts)
+    ntimes, nbaselines, nchan, npol = vis.shape
+    
+    # Pol independent weighting
+    allpwtsgrid = numpy.sum(wts, axis=3)
+    present, time_average, frequency_average = averaging_factors(uvw, allpwtsgrid, ba1, ba2, nant, time_coal,
+                                                                 max_time_coal, frequency_coal, max_frequency_coal)
+
+    # See how many time chunks and frequency we need for each baseline, and so where the rows for
+    # each baseline start.
+    time_chunk_len = -(-ntimes // time_average)
+    frequency_chunk_len = -(-nchan // frequency_average)
+    nrows = numpy.where(present, time_chunk_len * frequency_chunk_len, 0)
+    rowstart = numpy.cumsum(nrows) - nrows
+    cnvis = int(numpy.sum(nrows))
 
     # Now we know enough to define the output coalesced arrays. The shape will be
-    # succesive a1, a2: [len_time_chunks[a2,a1], a2, a1, len_frequency_chunks[a2,a1]]
+    # succesive baselines: [len_time_chunks[baseline], baseline, len_frequency_chunks[baseline]]
     ctime = numpy.zeros([cnvis])
     cfrequency = numpy.zeros([cnvis])
     cchannel_bandwidth = numpy.zeros([cnvis])
@@ -212,118 +417,110 @@ def average_in_blocks(vis, uvw, wts, times, integration_time, frequency, channel
     cintegration_time = numpy.zeros([cnvis])
 
     # For decoalescence we keep an index to map back to the original BlockVisibility
-    rowgrid = numpy.zeros([ntimes, nant, nant, nchan], dtype='int')
-    rowgrid.flat = range(rowgrid.size)
+    cindex = numpy.zeros([ntimes * nbaselines * nchan], dtype='int')
 
-    cindex = numpy.zeros([rowgrid.size], dtype='int')
+    frequency_grid, time_grid = numpy.meshgrid(frequency, times)
+    channel_bandwidth_grid, integration_time_grid = numpy.meshgrid(channel_bandwidth, integration_time)
 
-    # Now go through, chunking up the various arrays. Everything is converted into an array with
-    # axes [time, channel] and then it is averaged over time and frequency chunks for
-    # this baseline.
+    # Baselines with the same averaging factors are averaged together. Everything is converted into an
+    # array with axes [time, baseline, channel] and then it is averaged over time and frequency chunks.
     # To aid decoalescence we will need an index of which output elements a given input element
     # contributes to. This is a many to one. The decoalescence will then just consist of using
     # this index to extract the coalesced value that a given input element contributes towards.
-
-    visstart = 0
-    for a2 in ua:
-        for a1 in ua:
-            if (time_chunk_len[a2, a1] > 0) & (frequency_chunk_len[a2, a1] > 0) & \
-                    (allpwtsgrid[:, a2, a1, :].any() > 0.0):
-
-                nrows = time_chunk_len[a2, a1] * frequency_chunk_len[a2, a1]
-                rows = slice(visstart, visstart + nrows)
-
-                cindex.flat[rowgrid[:, a2, a1, :]] = numpy.array(range(visstart, visstart + nrows))
-
-                ca1[rows] = a1
-                ca2[rows] = a2
-
-                # Average over time and frequency for case where polarisation isn't an issue
-                def average_from_grid(arr):
-                    return average_chunks2(arr, allpwtsgrid[:, a2, a1, :],
-                                           (time_average[a2, a1], frequency_average[a2, a1]))[0]
-
-                ctime[rows] = average_from_grid(time_grid).flatten()
-                cfrequency[rows] = average_from_grid(frequency_grid).flatten()
-
-                for axis in range(3):
-                    uvwgrid = numpy.outer(uvw[:, a2, a1, axis], frequency / constants.c.value)
-                    cuvw[rows, axis] = average_from_grid(uvwgrid).flatten()
-
-                # For some variables, we need the sum not the average
-                def sum_from_grid(arr):
-                    result = average_chunks2(arr, allpwtsgrid[:, a2, a1, :],
-                                             (time_average[a2, a1], frequency_average[a2, a1]))
-                    return result[0] * result[0].size
-
-                cintegration_time[rows] = sum_from_grid(integration_time_grid).flatten()
-                cchannel_bandwidth[rows] = sum_from_grid(channel_bandwidth_grid).flatten()
-
-                # For the polarisations we have to perform the time-frequency average separately for each polarisation
-                for pol in range(npol):
-                    result = average_chunks2(vis[:, a2, a1, :, pol], wts[:, a2, a1, :, pol],
-                                             (time_average[a2, a1], frequency_average[a2, a1]))
-                    cvis[rows, pol], cwts[rows, pol] = result[0].flatten(), result[1].flatten()
-
-                visstart += nrows
-
-    assert cnvis == visstart, "Mismatch between number of rows in coalesced visibility and index"
+    baselines = numpy.nonzero(present)[0]
+    factors = numpy.stack([time_average[baselines], frequency_average[baselines]], axis=1)
+    for ta, fa in numpy.unique(factors, axis=0):
+        group = baselines[(factors[:, 0] == ta) & (factors[:, 1] == fa)]
+        ngroup = len(group)
+        nt, nf = -(-ntimes // ta), -(-nchan // fa)
+        pwts = allpwtsgrid[:, group, :]
+        
+        # The rows for each baseline are [time chunk, frequency chunk]
+        rows = (rowstart[group][:, numpy.newaxis] + numpy.arange(nt * nf)[numpy.newaxis, :]).flatten()
+        
+        def to_rows(arr):
+            return arr.transpose(1, 0, 2).flatten()
+        
+        # Average over time and frequency for case where polarisation isn't an issue
+        def average_from_grid(arr):
+            arr = numpy.broadcast_to(arr, pwts.shape)
+            return average_chunks2_batch(arr, pwts, (ta, fa))[0]
+        
+        ca1[rows] = numpy.repeat(ba1[group], nt * nf)
+        ca2[rows] = numpy.repeat(ba2[group], nt * nf)
+        ctime[rows] = to_rows(average_from_grid(time_grid[:, numpy.newaxis, :]))
+        cfrequency[rows] = to_rows(average_from_grid(frequency_grid[:, numpy.newaxis, :]))
+        
+        for axis in range(3):
+            uvwgrid = uvw[:, group, axis][..., numpy.newaxis] * \
+                      (frequency / constants.c.value)[numpy.newaxis, numpy.newaxis, :]
+            cuvw[rows, axis] = to_rows(average_from_grid(uvwgrid))
+        
+        # For some variables, we need the sum not the average
+        cintegration_time[rows] = to_rows(average_from_grid(integration_time_grid[:, numpy.newaxis, :])) * nt * nf
+        cchannel_bandwidth[rows] = to_rows(average_from_grid(channel_bandwidth_grid[:, numpy.newaxis, :])) * nt * nf
+        
+        # The polarisations are averaged separately, as part of the batch [time, baseline * pol, channel]
+        gvis = vis[:, group, :, :].transpose(0, 1, 3, 2).reshape([ntimes, ngroup * npol, nchan])
+        gwts = wts[:, group, :, :].transpose(0, 1, 3, 2).reshape([ntimes, ngroup * npol, nchan])
+        avis, awts = average_chunks2_batch(gvis, gwts, (ta, fa))
+        cvis[rows, :] = avis.reshape([nt, ngroup, npol, nf]).transpose(1, 0, 3, 2).reshape([-1, npol])
+        cwts[rows, :] = awts.reshape([nt, ngroup, npol, nf]).transpose(1, 0, 3, 2).reshape([-1, npol])
+        
+        # Each element [time, baseline, channel] of the block goes to the row for its time and frequency chunk
+        itime = numpy.arange(ntimes)[:, numpy.newaxis, numpy.newaxis]
+        chan = numpy.arange(nchan)[numpy.newaxis, numpy.newaxis, :]
+        blockindex = (itime * nbaselines + group[numpy.newaxis, :, numpy.newaxis]) * nchan + chan
+        cindex[blockindex.flatten()] = (rowstart[group][numpy.newaxis, :, numpy.newaxis] +
+                                        (itime // ta) * nf + chan // fa).flatten()
 
     return cvis, cuvw, cwts, ctime, cfrequency, cchannel_bandwidth, ca1, ca2, cintegration_time, cindex
 
 
 def convert_blocks(vis, uvw, wts, times, integration_time, frequency, channel_bandwidth):
-    # The input visibility is a block of shape [ntimes, nant, nant, nchan, npol]. We will map this
-    # into rows like vis[npol] and with additional columns antenna1, antenna2, frequency
+    # The input visibility is a block of shape [ntimes, nant, nant, nchan, npol], or [ntimes, nbaselines, nchan,
+    # npol] if compact. We will map this into rows like vis[npol] and with additional columns antenna1, antenna2,
+    # frequency
 
-    ntimes, nant, _, nchan, npol = vis.shape
+    ntimes, nchan, npol = vis.shape[0], vis.shape[-2], vis.shape[-1]
     assert nchan == len(frequency)
-
-    cnvis = ntimes * nant * (nant - 1) * nchan // 2
-
-    # Now we know enough to define the output coalesced arrays. The shape will be
-    # succesive a1, a2: [len_time_chunks[a2,a1], a2, a1, len_frequency_chunks[a2,a1]]
-    ctime = numpy.zeros([cnvis])
-    cfrequency = numpy.zeros([cnvis])
-    cchannel_bandwidth = numpy.zeros([cnvis])
-    cvis = numpy.zeros([cnvis, npol], dtype='complex')
-    cwts = numpy.zeros([cnvis, npol])
-    cuvw = numpy.zeros([cnvis, 3])
-    ca1 = numpy.zeros([cnvis], dtype='int')
-    ca2 = numpy.zeros([cnvis], dtype='int')
-    cintegration_time = numpy.zeros([cnvis])
-
-    # For decoalescence we keep an index to map back to the original BlockVisibility
-    rowgrid = numpy.zeros([ntimes, nant, nant, nchan], dtype='int')
-    rowgrid.flat = range(rowgrid.size)
-
-    cindex = numpy.zeros([rowgrid.size], dtype='int')
-
-    # Now go through, chunking up the various arrays. Everything is converted into an array with
-    # axes [time, channel] and then it is averaged over time and frequency chunks for
-    # this baseline.
-    # To aid decoalescence we will need an index of which output elements a given input element
-    # contributes to. This is a many to one. The decoalescence will then just consist of using
-    # this index to extract the coalesced value that a given input element contributes towards.
-
-    row = 0
-    for itime in range(ntimes):
-        for a1 in range(nant):
-            for a2 in range(a1 + 1, nant):
-                for chan in range(nchan):
-                    ca1[row] = a1
-                    ca2[row] = a2
-                    cfrequency[row] = frequency[chan]
-                    ctime[row] = times[itime]
-
-                    cuvw[row, :] = uvw[itime, a2, a1, :] * frequency[chan] / constants.c.value
-
-                    cindex.flat[rowgrid[itime, a2, a1, chan]] = row
-                    cintegration_time[row] = integration_time[itime]
-                    cchannel_bandwidth[row] = channel_bandwidth[chan]
-                    cvis[row, :] = vis[itime, a2, a1, chan, :]
-                    cwts[row, :] = wts[itime, a2, a1, chan, :]
-                    row += 1
+    # The frequencies may be given as a list
+    frequency = numpy.asarray(frequency)
+
+    # The rows are ordered as [time, baseline, channel] where the baselines are (a1, a2) with a2 > a1,
+    # in order of a1 and then a2. In the dense block these are at [time, a2, a1, channel], and in the compact
+    # block they are all the baselines, in the same order.
+    compact = vis.ndim == 4
+    vis, uvw, wts, ba1, ba2, nant = block_baselines(vis, uvw, wts)
+    nblock = vis.shape[1]
+    a1, a2 = numpy.triu_indices(nant, 1)
+    if compact:
+        baselines = numpy.arange(nblock)
+    else:
+        baselines = a2 * nant + a1
+    nbaselines = len(baselines)
+    cnvis = ntimes * nbaselines * nchan
+
+    cvis = vis[:, baselines, :, :].reshape([cnvis, npol])
+    cwts = wts[:, baselines, :, :].reshape([cnvis, npol])
+    cuvw = (uvw[:, baselines, numpy.newaxis, :] * frequency[numpy.newaxis, numpy.newaxis, :, numpy.newaxis] /
+            constants.c.value).reshape([cnvis, 3])
+
+    ctime = numpy.repeat(times, nbaselines * nchan)
+    cintegration_time = numpy.repeat(integration_time, nbaselines * nchan)
+    cfrequency = numpy.tile(frequency, ntimes * nbaselines)
+    cchannel_bandwidth = numpy.tile(channel_bandwidth, ntimes * nbaselines)
+    ca1 = numpy.tile(numpy.repeat(a1, nchan), ntimes)
+    ca2 = numpy.tile(numpy.repeat(a2, nchan), ntimes)
+
+    # For decoalescence we keep an index to map back to the original BlockVisibility. For every element of
+    # the block [time, baseline, channel] this gives the row it went to. Elements not converted (a2 <= a1) are
+    # left at zero.
+    cindex = numpy.zeros([ntimes * nblock * nchan], dtype='int')
+    itime = numpy.arange(ntimes)[:, numpy.newaxis, numpy.newaxis]
+    chan = numpy.arange(nchan)[numpy.newaxis, numpy.newaxis, :]
+    blockindex = (itime * nblock + baselines[numpy.newaxis, :, numpy.newaxis]) * nchan + chan
+    cindex[blockindex.flatten()] = numpy.arange(cnvis)
 
     return cvis, cuvw, cwts, ctime, cfrequency, cchannel_bandwidth, ca1, ca2, cintegration_time, cindex
 
@@ -339,13 +536,9 @@ def decoalesce_vis(vshape, cvis, cindex):
     :param cindex: Index array from coalescence
     :return: uncoalesced vis
     """
-    npol = vshape[-1]
-    dvis = numpy.zeros(vshape, dtype='complex')
-    assert numpy.max(cindex) < dvis.size
-    for i in range(dvis.size // npol):
-        dvis.flat[i:i + npol] = cvis[cindex[i]]
-
-    return dvis
+    assert cindex.size * vshape[-1] == numpy.prod(vshape), "Incorrect template used in decoalescing"
+    assert numpy.max(cindex) < cvis.shape[0], "Incorrect template used in decoalescing"
+    return cvis[cindex].reshape(vshape)
 
 
 def convert_visibility_to_blockvisibility(vis: Visibility) -> BlockVisibility:
@@ -83,8 +83,8 @@ def visibility_gather(visibility_list: List[Visibility], vis: Visibility, vis_it
 
     for i, rows in enumerate(rowses):
         assert i < len(visibility_list), "Gather not consistent with scatter for slice %d" % i
-        if visibility_list[i] is not None and numpy.sum(rows):
-            assert numpy.sum(rows) == visibility_list[i].nvis, "Mismatch in number of rows in gather for slice %d" % i
+        if visibility_list[i] is not None and len(rows):
+            assert len(rows) == visibility_list[i].nvis, "Mismatch in number of rows in gather for slice %d" % i
             cvis.data[rows] = visibility_list[i].data[...]
     
     if vis_iter == vis_wslice_iter and isinstance(vis, BlockVisibility):
@@ -9,6 +9,7 @@ A typical use would be to make a sequence of snapshot images::
 
 """
 
+import copy
 import logging
 from typing import Union
 
@@ -21,15 +22,15 @@ log = logging.getLogger(__name__)
 
 
 def vis_null_iter(vis: Union[Visibility, BlockVisibility], vis_slices=1) -> numpy.ndarray:
-    """One time iterator returning true for all rows
+    """One time iterator returning all rows
     
     :param vis:
     :param vis_slices:
-    :return:
+    :return: Array of all row numbers
     """
     assert vis is not None
     assert isinstance(vis, Visibility) or isinstance(vis, BlockVisibility), vis
-    yield numpy.ones_like(vis.time, dtype=bool)
+    yield numpy.arange(len(vis.time))
 
 
 def vis_timeslice_iter(vis: Visibility, vis_slices=None) -> numpy.ndarray:
@@ -37,25 +38,11 @@ def vis_timeslice_iter(vis: Visibility, vis_slices=None) -> numpy.ndarray:
 
     :param vis:
     :param vis_slices: Number of time slices
-    :return: Boolean array with selected rows=True
+    :return: Array of selected row numbers, in ascending order
     """
-    assert vis is not None
-    assert isinstance(vis, Visibility) or isinstance(vis, BlockVisibility), vis
-    timemin = numpy.min(vis.time)
-    timemax = numpy.max(vis.time)
-    
-    if vis_slices is None:
-        vis_slices = vis_timeslices(vis, 'auto')
-    
-    boxes = numpy.linspace(timemin, timemax, vis_slices)
-    if vis_slices > 1:
-        timeslice = boxes[1] - boxes[0]
-    else:
-        timeslice = timemax - timemin
-    
-    for box in boxes:
-        rows = numpy.abs(vis.time - box) <= 0.5 * timeslice
-        yield rows
+    rows, offsets = vis_slice_index(vis, vis_slices, axis='time')
+    for islice in range(len(offsets) - 1):
+        yield rows[offsets[islice]:offsets[islice + 1]]
 
 
 def vis_timeslices(vis: Visibility, timeslice='auto') -> int:
@@ -93,17 +80,116 @@ def vis_wslice_iter(vis: Visibility, vis_slices=1) -> numpy.ndarray:
 
     :param vis:
     :param vis_slices: Number of slices
-    :return: Boolean array with selected rows=True
+    :return: Array of selected row numbers, in ascending order
     """
-    assert isinstance(vis, Visibility), vis
-    wmaxabs = numpy.max(numpy.abs(vis.w))
-    
-    boxes = numpy.linspace(- wmaxabs, +wmaxabs, vis_slices)
-    if vis_slices > 1:
-        wstack = boxes[1] - boxes[0]
+    rows, offsets = vis_slice_index(vis, vis_slices, axis='w')
+    for islice in range(len(offsets) - 1):
+        yield rows[offsets[islice]:offsets[islice + 1]]
+
+
+def vis_slice_index(vis: Union[Visibility, BlockVisibility], vis_slices=None, axis='time'):
+    """ Find the rows in each time or w slice all at once
+
+    A row is in a slice if its time is within half a slice width of the slice centre (inclusive), or its w is within
+    half a slice width (exclusive), the slice centres being spread evenly over the range of time or w. The range of
+    slices holding each row is found by a binary search of the slice edges, so a row may be in several slices (e.g.
+    all of them if the slices are degenerate) exactly as for a per-slice test. The rows are then sorted once by
+    slice, so the cost does not grow with the number of slices.
+
+    :param vis: Visibility or BlockVisibility (time only)
+    :param vis_slices: Number of slices (default for time is every time, for w 1)
+    :param axis: 'time' or 'w'
+    :return: rows, offsets: The rows of slice i are rows[offsets[i]:offsets[i+1]], in ascending order
+    """
+    assert vis is not None
+    if axis == 'time':
+        assert isinstance(vis, Visibility) or isinstance(vis, BlockVisibility), vis
+        values = vis.time
+        if vis_slices is None:
+            vis_slices = vis_timeslices(vis, 'auto')
+        boxes = numpy.linspace(numpy.min(values), numpy.max(values), vis_slices)
+        if vis_slices > 1:
+            halfwidth = 0.5 * (boxes[1] - boxes[0])
+        else:
+            halfwidth = 0.5 * (numpy.max(values) - numpy.min(values))
+        
+        # Closed interval: box - halfwidth <= value <= box + halfwidth
+        first = numpy.searchsorted(boxes, values - halfwidth, side='left')
+        last = numpy.searchsorted(boxes, values + halfwidth, side='right')
+        
+        def inside(v, box):
+            return numpy.abs(v - box) <= halfwidth
+    elif axis == 'w':
+        assert isinstance(vis, Visibility), vis
+        values = vis.w
+        if vis_slices is None:
+            vis_slices = 1
+        wmaxabs = numpy.max(numpy.abs(values))
+        boxes = numpy.linspace(- wmaxabs, +wmaxabs, vis_slices)
+        if vis_slices > 1:
+            halfwidth = 0.5 * (boxes[1] - boxes[0])
+        else:
+            halfwidth = wmaxabs
+        
+        # Open interval: box - halfwidth < value < box + halfwidth
+        first = numpy.searchsorted(boxes, values - halfwidth, side='right')
+        last = numpy.searchsorted(boxes, values + halfwidth, side='left')
+        
+        def inside(v, box):
+            return numpy.abs(v - box) < halfwidth
     else:
-        wstack = 2 * wmaxabs
+        raise ValueError("Unknown slice axis %s" % axis)
+    
+    nslices = len(boxes)
+    
+    # Widen the range by one slice on each side and then apply the per-slice test, so that rounding in the
+    # edges cannot move a row at a slice boundary
+    first = numpy.maximum(first - 1, 0)
+    last = numpy.minimum(last + 1, nslices)
+    counts = numpy.maximum(last - first, 0)
+    rows = numpy.repeat(numpy.arange(len(values)), counts)
+    starts = numpy.cumsum(counts) - counts
+    slices = numpy.repeat(first, counts) + numpy.arange(len(rows)) - numpy.repeat(starts, counts)
+    valid = inside(values[rows], boxes[slices])
+    rows = rows[valid]
+    slices = slices[valid]
+    
+    order = numpy.lexsort((rows, slices))
+    offsets = numpy.searchsorted(slices[order], numpy.arange(nslices + 1))
+    return rows[order], offsets
+
+
+def vis_slice_views(vis: Union[Visibility, BlockVisibility], vis_slices=None, axis='time'):
+    """ Reorder the rows of a visibility so that each slice is contiguous, and return views of the slices
+
+    The slices share data with the reordered visibility, so that filling in e.g. the vis column of the slices fills
+    in the reordered visibility without copying. Each row must be in exactly one slice. The cindex of a coalesced
+    Visibility is updated to the new row order, so the reordered visibility can still be decoalesced.
+
+    :param vis: Visibility or BlockVisibility (time only)
+    :param vis_slices: Number of slices
+    :param axis: 'time' or 'w'
+    :return: Reordered visibility, list of slices (None for empty slices)
+    """
+    rows, offsets = vis_slice_index(vis, vis_slices, axis=axis)
+    assert numpy.array_equal(numpy.sort(rows), numpy.arange(len(vis.time))), \
+        "Each row must be in exactly one slice"
+    
+    svis = copy.copy(vis)
+    svis.data = vis.data[rows]
+    if isinstance(vis, Visibility) and vis.cindex is not None:
+        newrow = numpy.zeros(len(rows), dtype='int')
+        newrow[rows] = numpy.arange(len(rows))
+        svis.cindex = newrow[vis.cindex]
     
-    for box in boxes:
-        rows = numpy.abs(vis.w - box) < 0.5 * wstack
-        yield rows
\ No newline at end of file
+    views = list()
+    for islice in range(len(offsets) - 1):
+        if offsets[islice + 1] > offsets[islice]:
+            view = copy.copy(svis)
+            view.data = svis.data[offsets[islice]:offsets[islice + 1]]
+            if isinstance(view, Visibility):
+                view.cindex = None
+            views.append(view)
+        else:
+            views.append(None)
+    return svis, views
@@ -8,7 +8,7 @@ from typing import Union
 import numpy
 from astropy.coordinates import SkyCoord
 
-from data_models.memory_data_models import BlockVisibility, Visibility, QA
+from data_models.memory_data_models import BlockVisibility, Visibility, QA, VisibilityColumns
 
 from libs.imaging.imaging_params import get_frequency_map
 from libs.util.coordinate_support import skycoord_to_lmn, simulate_point
@@ -35,10 +35,22 @@ def append_visibility(vis: Union[Visibility, BlockVisibility], othervis: Union[V
     assert abs(vis.phasecentre.ra.value - othervis.phasecentre.ra.value) < 1e-15
     assert abs(vis.phasecentre.dec.value - othervis.phasecentre.dec.value) < 1e-15
     assert vis.phasecentre.separation(othervis.phasecentre).value < 1e-15
-    vis.data = numpy.hstack((vis.data, othervis.data))
+    vis.data = concatenate_visibility_data([vis.data, othervis.data])
     return vis
 
 
+def concatenate_visibility_data(data_list):
+    """ Concatenate the data of visibilities, in the layout of the first
+
+    :param data_list: List of numpy structured arrays or VisibilityColumns
+    :return: numpy structured array or VisibilityColumns
+    """
+    if isinstance(data_list[0], VisibilityColumns):
+        return VisibilityColumns({name: numpy.concatenate([data[name] for data in data_list])
+                                  for name in data_list[0].dtype.names})
+    return numpy.hstack([numpy.asarray(data) for data in data_list])
+
+
 def sort_visibility(vis, order=None):
     """ Sort a visibility on a given column
     
@@ -48,7 +60,10 @@ def sort_visibility(vis, order=None):
     """
     if order is None:
         order = ['index']
-    vis.data = numpy.sort(vis.data, order=order)
+    if isinstance(vis.data, VisibilityColumns):
+        vis.data = vis.data[numpy.lexsort([vis.data[name] for name in reversed(order)])]
+    else:
+        vis.data = numpy.sort(vis.data, order=order)
     return vis
 
 
@@ -70,7 +85,7 @@ def concatenate_visibility(vis_list, sort=True):
         else:
             assert v.polarisation_frame == vis.polarisation_frame
             assert v.phasecentre.separation(vis.phasecentre).value < 1e-15
-            vis.data = numpy.hstack((vis.data, v.data))
+            vis.data = concatenate_visibility_data([vis.data, v.data])
     
     assert vis is not None
     
@@ -219,23 +234,27 @@ def divide_visibility(vis: BlockVisibility, modelvis: BlockVisibility):
         mask = xwt > 0.0
         x[mask] = vis.vis[mask] / modelvis.vis[mask]
     else:
-        nrows, nants, _, nchan, npol = vis.vis.shape
+        nrows, nchan, npol = vis.vis.shape[0], vis.nchan, vis.npol
         nrec = 2
         assert nrec * nrec == npol
-        xshape = (nrows, nants, nants, nchan, nrec, nrec)
+        xshape = vis.vis.shape[:-1] + (nrec, nrec)
         x = numpy.zeros(xshape, dtype='complex')
         xwt = numpy.zeros(xshape)
         for row in range(nrows):
-            for ant1 in range(nants):
-                for ant2 in range(ant1 + 1, nants):
-                    for chan in range(nchan):
-                        ovis = numpy.matrix(vis.vis[row, ant2, ant1, chan].reshape([2, 2]))
-                        mvis = numpy.matrix(modelvis.vis[row, ant2, ant1, chan].reshape([2, 2]))
-                        wt = numpy.matrix(vis.weight[row, ant2, ant1, chan].reshape([2, 2]))
-                        x[row, ant2, ant1, chan] = numpy.matmul(numpy.linalg.inv(mvis), ovis)
-                        xwt[row, ant2, ant1, chan] = numpy.dot(mvis, numpy.multiply(wt, mvis.H)).real
-        x = x.reshape((nrows, nants, nants, nchan, nrec * nrec))
-        xwt = xwt.reshape((nrows, nants, nants, nchan, nrec * nrec))
+            for baseline, (ant1, ant2) in enumerate(zip(*numpy.triu_indices(vis.nants, 1))):
+                # The baseline is at [row, ant2, ant1] in the dense block, and at [row, baseline] if compact
+                if vis.compact:
+                    index = (row, baseline)
+                else:
+                    index = (row, ant2, ant1)
+                for chan in range(nchan):
+                    ovis = numpy.matrix(vis.vis[index][chan].reshape([2, 2]))
+                    mvis = numpy.matrix(modelvis.vis[index][chan].reshape([2, 2]))
+                    wt = numpy.matrix(vis.weight[index][chan].reshape([2, 2]))
+                    x[index][chan] = numpy.matmul(numpy.linalg.inv(mvis), ovis)
+                    xwt[index][chan] = numpy.dot(mvis, numpy.multiply(wt, mvis.H)).real
+        x = x.reshape(vis.vis.shape)
+        xwt = xwt.reshape(vis.vis.shape)
     
     pointsource_vis = BlockVisibility(data=None, frequency=vis.frequency, channel_bandwidth=vis.channel_bandwidth,
                                       phasecentre=vis.phasecentre, configuration=vis.configuration,
@@ -254,7 +273,6 @@ def integrate_visibility_by_channel(vis: BlockVisibility) -> BlockVisibility:
     assert isinstance(vis, Visibility) or isinstance(vis, BlockVisibility), vis
     
     vis_shape = list(vis.vis.shape)
-    ntimes, nants, _, nchan, npol = vis_shape
     vis_shape[-2] = 1
     newvis = BlockVisibility(data=None,
                              frequency=numpy.ones([1]) * numpy.average(vis.frequency),
@@ -7,22 +7,26 @@ using HDF5
 import unittest
 
 import astropy.units as u
+import h5py
 import numpy
 from astropy.coordinates import SkyCoord
 
+from data_models import data_model_helpers
 from data_models.data_model_helpers import import_visibility_from_hdf5, export_visibility_to_hdf5, \
     import_blockvisibility_from_hdf5, export_blockvisibility_to_hdf5, \
     import_gaintable_from_hdf5, export_gaintable_to_hdf5, \
     import_image_from_hdf5, export_image_to_hdf5, \
     import_skycomponent_from_hdf5, export_skycomponent_to_hdf5, \
-    import_skymodel_from_hdf5, export_skymodel_to_hdf5
+    import_skymodel_from_hdf5, export_skymodel_to_hdf5, LazyHDFData, \
+    import_blockvisibility_from_hdf5_iter
 from data_models.memory_data_models import Skycomponent, SkyModel
 from data_models.polarisation import PolarisationFrame
 from processing_components.calibration.operations import create_gaintable_from_blockvisibility
 from processing_components.imaging.base import predict_skycomponent_visibility
 from processing_components.simulation.testing_support import create_named_configuration, \
     simulate_gaintable, create_test_image
-from processing_components.visibility.base import create_visibility, create_blockvisibility
+from processing_components.visibility.base import create_visibility, create_blockvisibility, copy_visibility, \
+    convert_visibility_layout
 
 
 class TestDataModelHelpers(unittest.TestCase):
@@ -65,6 +69,36 @@ class TestDataModelHelpers(unittest.TestCase):
         assert numpy.abs(newvis.configuration.location.z.value - self.vis.configuration.location.z.value) < 1e-15
         assert numpy.max(numpy.abs(newvis.configuration.xyz - self.vis.configuration.xyz)) < 1e-15
     
+    def test_readwritevisibility_columnar(self):
+        self.vis = create_visibility(self.lowcore, self.times, self.frequency,
+                                     channel_bandwidth=self.channel_bandwidth,
+                                     phasecentre=self.phasecentre,
+                                     polarisation_frame=PolarisationFrame("linear"),
+                                     weight=1.0)
+        self.vis = predict_skycomponent_visibility(self.vis, self.comp)
+        cvis = convert_visibility_layout(self.vis, columnar=True)
+        export_visibility_to_hdf5(cvis, '%s/test_visibility_columnar.hdf' % self.dir)
+        newvis = import_visibility_from_hdf5('%s/test_visibility_columnar.hdf' % self.dir)
+        assert newvis.data.dtype == self.vis.data.dtype
+        assert numpy.array_equal(newvis.data, self.vis.data)
+    
+    def test_readvisibility_bigendian(self):
+        self.vis = create_visibility(self.lowcore, self.times, self.frequency,
+                                     channel_bandwidth=self.channel_bandwidth,
+                                     phasecentre=self.phasecentre,
+                                     polarisation_frame=PolarisationFrame("linear"),
+                                     weight=1.0)
+        self.vis = predict_skycomponent_visibility(self.vis, self.comp)
+        assert self.vis.data.dtype == self.vis.data.dtype.newbyteorder('=')
+        # Files written by earlier versions hold big-endian data
+        oldvis = copy_visibility(self.vis)
+        oldvis.data = self.vis.data.astype(self.vis.data.dtype.newbyteorder('>'))
+        export_visibility_to_hdf5(oldvis, '%s/test_visibility_bigendian.hdf' % self.dir)
+        newvis = import_visibility_from_hdf5('%s/test_visibility_bigendian.hdf' % self.dir)
+        assert newvis.data.dtype == self.vis.data.dtype
+        assert numpy.array_equal(newvis.vis, self.vis.vis)
+        assert numpy.array_equal(newvis.uvw, self.vis.uvw)
+    
     def test_readwriteblockvisibility(self):
         self.vis = create_blockvisibility(self.lowcore, self.times, self.frequency,
                                           channel_bandwidth=self.channel_bandwidth,
@@ -83,7 +117,171 @@ class TestDataModelHelpers(unittest.TestCase):
         assert numpy.abs(newvis.configuration.location.y.value - self.vis.configuration.location.y.value) < 1e-15
         assert numpy.abs(newvis.configuration.location.z.value - self.vis.configuration.location.z.value) < 1e-15
         assert numpy.max(numpy.abs(newvis.configuration.xyz - self.vis.configuration.xyz)) < 1e-15
-    
+
+    def test_readwriteblockvisibility_compact(self):
+        self.vis = create_blockvisibility(self.lowcore, self.times, self.frequency,
+                                          channel_bandwidth=self.channel_bandwidth,
+                                          phasecentre=self.phasecentre,
+                                          polarisation_frame=PolarisationFrame("linear"),
+                                          weight=1.0, compact=True)
+        self.vis = predict_skycomponent_visibility(self.vis, self.comp)
+        export_blockvisibility_to_hdf5(self.vis, '%s/test_blockvisibility_compact.hdf' % self.dir)
+        newvis = import_blockvisibility_from_hdf5('%s/test_blockvisibility_compact.hdf' % self.dir)
+
+        assert newvis.compact
+        assert newvis.nants == self.vis.nants
+        assert newvis.data.shape == self.vis.data.shape
+        assert numpy.max(numpy.abs(self.vis.vis - newvis.vis)) < 1e-15
+        assert numpy.max(numpy.abs(self.vis.uvw - newvis.uvw)) < 1e-15
+
+    def test_readwriteblockvisibility_chunked(self):
+        self.vis = create_blockvisibility(self.lowcore, self.times, self.frequency,
+                                          channel_bandwidth=self.channel_bandwidth,
+                                          phasecentre=self.phasecentre,
+                                          polarisation_frame=PolarisationFrame("linear"),
+                                          weight=1.0)
+        self.vis = predict_skycomponent_visibility(self.vis, self.comp)
+        for compression in [None, 'gzip', 'lzf']:
+            filename = '%s/test_blockvisibility_chunked.hdf' % self.dir
+            export_blockvisibility_to_hdf5(self.vis, filename, times_per_chunk=2, compression=compression)
+            with h5py.File(filename, 'r') as f:
+                data = f['BlockVisibility0/data']
+                assert data.chunks == (2,)
+                assert data.compression == compression
+                assert data.shuffle == (compression is not None)
+            newvis = import_blockvisibility_from_hdf5(filename)
+            assert numpy.array_equal(newvis.data, self.vis.data)
+
+    def test_readwriteblockvisibility_oversize_rows(self):
+        self.vis = create_blockvisibility(self.lowcore, self.times, self.frequency,
+                                          channel_bandwidth=self.channel_bandwidth,
+                                          phasecentre=self.phasecentre,
+                                          polarisation_frame=PolarisationFrame("linear"),
+                                          weight=1.0)
+        self.vis = predict_skycomponent_visibility(self.vis, self.comp)
+        # Pretend that HDF5 cannot hold a chunk as large as one time of this BlockVisibility
+        max_chunk_bytes = data_model_helpers.HDF_MAX_CHUNK_BYTES
+        data_model_helpers.HDF_MAX_CHUNK_BYTES = self.vis.data.dtype.itemsize - 1
+        try:
+            filename = '%s/test_blockvisibility_oversize.hdf' % self.dir
+            export_blockvisibility_to_hdf5(self.vis, filename, times_per_chunk=2, compression='gzip')
+            with h5py.File(filename, 'r') as f:
+                data = f['BlockVisibility0/data']
+                assert data.chunks is None
+                assert data.compression is None
+            newvis = import_blockvisibility_from_hdf5(filename)
+            assert numpy.array_equal(newvis.data, self.vis.data)
+        finally:
+            data_model_helpers.HDF_MAX_CHUNK_BYTES = max_chunk_bytes
+        # Otherwise the chunk is limited to the largest whole number of rows
+        data_model_helpers.HDF_MAX_CHUNK_BYTES = 2 * self.vis.data.dtype.itemsize
+        try:
+            assert data_model_helpers.hdf_chunk_rows(self.vis.data, 4) == 2
+        finally:
+            data_model_helpers.HDF_MAX_CHUNK_BYTES = max_chunk_bytes
+
+    def test_readblockvisibility_partial(self):
+        self.vis = create_blockvisibility(self.lowcore, self.times, self.frequency,
+                                          channel_bandwidth=self.channel_bandwidth,
+                                          phasecentre=self.phasecentre,
+                                          polarisation_frame=PolarisationFrame("linear"),
+                                          weight=1.0)
+        self.vis = predict_skycomponent_visibility(self.vis, self.comp)
+        filename = '%s/test_blockvisibility_partial.hdf' % self.dir
+        export_blockvisibility_to_hdf5(self.vis, filename, times_per_chunk=1)
+        time_range = [self.vis.time[1], self.vis.time[2]]
+        newvis = import_blockvisibility_from_hdf5(filename, time_range=time_range, channel_range=[1, 3])
+        assert newvis.nvis == 2
+        assert numpy.array_equal(newvis.frequency, self.vis.frequency[1:3])
+        assert numpy.array_equal(newvis.channel_bandwidth, self.vis.channel_bandwidth[1:3])
+        assert numpy.array_equal(newvis.time, self.vis.time[1:3])
+        assert numpy.array_equal(newvis.uvw, self.vis.uvw[1:3])
+        assert numpy.array_equal(newvis.vis, self.vis.vis[1:3, ..., 1:3, :])
+        assert numpy.array_equal(newvis.weight, self.vis.weight[1:3, ..., 1:3, :])
+        newvis = import_blockvisibility_from_hdf5(filename, rows=[0, 2])
+        assert numpy.array_equal(newvis.data, self.vis.data[[0, 2]])
+        # Files written without the separate time dataset are read using the time in the data
+        with h5py.File(filename, 'r+') as f:
+            assert numpy.array_equal(f['BlockVisibility0/time'], self.vis.time)
+            del f['BlockVisibility0/time']
+        newvis = import_blockvisibility_from_hdf5(filename, time_range=time_range, channel_range=[1, 3])
+        assert numpy.array_equal(newvis.vis, self.vis.vis[1:3, ..., 1:3, :])
+
+    def test_readvisibility_partial(self):
+        self.vis = create_visibility(self.lowcore, self.times, self.frequency,
+                                     channel_bandwidth=self.channel_bandwidth,
+                                     phasecentre=self.phasecentre,
+                                     polarisation_frame=PolarisationFrame("linear"),
+                                     weight=1.0)
+        self.vis = predict_skycomponent_visibility(self.vis, self.comp)
+        filename = '%s/test_visibility_partial.hdf' % self.dir
+        export_visibility_to_hdf5(self.vis, filename, rows_per_chunk=1000)
+        time_range = [self.vis.time[0], self.vis.time[0]]
+        newvis = import_visibility_from_hdf5(filename, time_range=time_range, channel_range=[2, 3])
+        rows = (self.vis.time == self.vis.time[0]) & (self.vis.frequency == self.frequency[2])
+        assert numpy.array_equal(newvis.data, self.vis.data[rows])
+        rows = numpy.arange(5, self.vis.nvis, 11)
+        newvis = import_visibility_from_hdf5(filename, rows=rows)
+        assert numpy.array_equal(newvis.data, self.vis.data[rows])
+        # Files written without the separate time and frequency datasets are read using those in the data
+        with h5py.File(filename, 'r+') as f:
+            assert numpy.array_equal(f['Visibility0/time'], self.vis.time)
+            assert numpy.array_equal(f['Visibility0/frequency'], self.vis.frequency)
+            del f['Visibility0/time']
+            del f['Visibility0/frequency']
+        newvis = import_visibility_from_hdf5(filename, time_range=time_range, channel_range=[2, 3])
+        rows = (self.vis.time == self.vis.time[0]) & (self.vis.frequency == self.frequency[2])
+        assert numpy.array_equal(newvis.data, self.vis.data[rows])
+
+    def test_readblockvisibility_lazy(self):
+        self.vis = create_blockvisibility(self.lowcore, self.times, self.frequency,
+                                          channel_bandwidth=self.channel_bandwidth,
+                                          phasecentre=self.phasecentre,
+                                          polarisation_frame=PolarisationFrame("linear"),
+                                          weight=1.0)
+        self.vis = predict_skycomponent_visibility(self.vis, self.comp)
+        filename = '%s/test_blockvisibility_lazy.hdf' % self.dir
+        export_blockvisibility_to_hdf5(self.vis, filename)
+        newvis = import_blockvisibility_from_hdf5(filename, channel_range=[0, 2], lazy=True)
+        assert isinstance(newvis.data, LazyHDFData)
+        # Only the columns accessed are read
+        assert numpy.array_equal(newvis.time, self.vis.time)
+        assert list(newvis.data.columns.keys()) == ['time']
+        assert newvis.nchan == 2
+        newvis.data['vis'][...] *= 2.0
+        # The rest of the data are read in one pass
+        fields = []
+        read_hdf_rows = data_model_helpers.read_hdf_rows
+        data_model_helpers.read_hdf_rows = lambda *args, **kwargs: \
+            fields.append(kwargs.get('field')) or read_hdf_rows(*args, **kwargs)
+        try:
+            data = numpy.asarray(newvis.data)
+        finally:
+            data_model_helpers.read_hdf_rows = read_hdf_rows
+        assert fields == [None]
+        assert newvis.data.columns is None
+        assert numpy.array_equal(data['vis'], 2.0 * self.vis.vis[..., 0:2, :])
+        assert numpy.array_equal(newvis.uvw, self.vis.uvw)
+        assert newvis.data.file is None
+
+    def test_readblockvisibility_iter(self):
+        self.vis = create_blockvisibility(self.lowcore, self.times, self.frequency,
+                                          channel_bandwidth=self.channel_bandwidth,
+                                          phasecentre=self.phasecentre,
+                                          polarisation_frame=PolarisationFrame("linear"),
+                                          weight=1.0)
+        self.vis = predict_skycomponent_visibility(self.vis, self.comp)
+        filename = '%s/test_blockvisibility_iter.hdf' % self.dir
+        export_blockvisibility_to_hdf5(self.vis, filename, times_per_chunk=1)
+        for prefetch in [False, True]:
+            chunks = list(import_blockvisibility_from_hdf5_iter(filename, times_per_chunk=2, prefetch=prefetch))
+            assert [chunk.nvis for chunk in chunks] == [2, 1]
+            for chunk in chunks:
+                assert numpy.array_equal(chunk.frequency, self.vis.frequency)
+                assert chunk.configuration.name == self.vis.configuration.name
+            assert numpy.array_equal(numpy.concatenate([chunk.vis for chunk in chunks]), self.vis.vis)
+            assert numpy.array_equal(numpy.concatenate([chunk.time for chunk in chunks]), self.vis.time)
+
     def test_readwritegaintable(self):
         self.vis = create_blockvisibility(self.lowcore, self.times, self.frequency,
                                           channel_bandwidth=self.channel_bandwidth,
@@ -106,6 +304,16 @@ class TestDataModelHelpers(unittest.TestCase):
         assert newim.data.shape == im.data.shape
         assert numpy.max(numpy.abs(im.data - newim.data)) < 1e-15
 
+    def test_readwriteimage_chunked(self):
+        im = create_test_image()
+        export_image_to_hdf5(im, '%s/test_image_chunked.hdf' % self.dir, facets=2, compression='gzip')
+        with h5py.File('%s/test_image_chunked.hdf' % self.dir, 'r') as f:
+            ny, nx = im.data.shape[-2:]
+            assert f['Image0/data'].chunks == (1, 1, ny // 2, nx // 2)
+        newim = import_image_from_hdf5('%s/test_image_chunked.hdf' % self.dir)
+        
+        assert numpy.array_equal(newim.data, im.data)
+
     def test_readwriteskycomponent(self):
         export_skycomponent_to_hdf5(self.comp, '%s/test_skycomponent.hdf' % self.dir)
         newsc = import_skycomponent_from_hdf5('%s/test_skycomponent.hdf' % self.dir)
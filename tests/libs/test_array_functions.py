@@ -7,7 +7,7 @@ import numpy
 import logging
 
 from libs.util.array_functions import average_chunks_jit as average_chunks
-from libs.util.array_functions import average_chunks2, average_chunks_jit
+from libs.util.array_functions import average_chunks2, average_chunks_jit, average_chunks2_batch
 
 log = logging.getLogger(__name__)
 
@@ -81,6 +81,17 @@ class TestArray_functions(unittest.TestCase):
         numpy.testing.assert_array_equal(carr[:, 5], answerarr)
         numpy.testing.assert_array_equal(cwts[:, 5], answerwts)
 
+    def test_average_chunks2_batch(self):
+        arr = numpy.random.normal(size=[11, 3, 7]) + 1j * numpy.random.normal(size=[11, 3, 7])
+        wts = numpy.random.uniform(size=[11, 3, 7])
+        wts[2:5, 1, :] = 0.0
+        for chunksize in [(1, 1), (5, 1), (1, 2), (5, 2), (20, 20)]:
+            carr, cwts = average_chunks2_batch(arr, wts, chunksize)
+            for i in range(3):
+                answerarr, answerwts = average_chunks2(arr[:, i, :], wts[:, i, :], chunksize)
+                numpy.testing.assert_array_equal(carr[:, i, :], answerarr)
+                numpy.testing.assert_array_equal(cwts[:, i, :], answerwts)
+
     def test_average_chunks_jit(self):
         arr = numpy.linspace(0.0, 100.0, 11)
         wts = numpy.ones_like(arr)
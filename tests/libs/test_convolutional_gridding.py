@@ -3,6 +3,7 @@
 
 """
 import random
+import tracemalloc
 import unittest
 
 import numpy
@@ -10,7 +11,9 @@ from numpy.testing import assert_allclose
 
 from libs.fourier_transforms.convolutional_gridding import w_beam, coordinates, \
     coordinates2, coordinateBounds, anti_aliasing_calculate, \
-    convolutional_degrid, convolutional_grid
+    convolutional_degrid, convolutional_grid, convolutional_grid_vectorised, convolutional_degrid_vectorised, \
+    dense_kernel, convolutional_grid_hermitian
+from libs.fourier_transforms.fft_support import ifft, irfft2
 
 
 class TestConvolutionalGridding(unittest.TestCase):
@@ -43,6 +46,13 @@ class TestConvolutionalGridding(unittest.TestCase):
             _, aaf = anti_aliasing_calculate(shape, 8)
             self.assertAlmostEqual(numpy.max(aaf[..., aaf.shape[1] // 2, aaf.shape[0] // 2]), 0.18712109669890534)
 
+    def test_anti_aliasing_calculate_separable(self):
+        for oversampling in [1, 4, 8]:
+            _, kernel = anti_aliasing_calculate((64, 64), oversampling)
+            _, skernel = anti_aliasing_calculate((64, 64), oversampling, separable=True)
+            assert skernel.shape == (2, oversampling, 8)
+            assert_allclose(dense_kernel(skernel), kernel, atol=1e-15)
+
     def test_w_kernel_beam(self):
         assert_allclose(numpy.real(w_beam(5, 0.1, 0))[0, 0], 1.0)
         self.assertAlmostEqualScalar(w_beam(5, 0.1, 100)[2, 2], 1)
@@ -73,6 +83,89 @@ class TestConvolutionalGridding(unittest.TestCase):
         assert uvgrid.shape[2] == npixel
         assert uvgrid.shape[3] == npixel
 
+    def test_convolutional_grid_vectorised(self):
+        npixel = 256
+        nvis = 10000
+        nchan = 2
+        npol = 4
+        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        uvcoords = numpy.array([[random.uniform(-0.25, 0.25), random.uniform(-0.25, 0.25)] for ivis in range(nvis)])
+        vis = numpy.random.normal(size=[nvis, npol]) + 1j * numpy.random.normal(size=[nvis, npol])
+        visweights = numpy.random.uniform(0.5, 1.0, size=[nvis, npol])
+        kernels = (numpy.zeros([nvis], dtype='int'), [kernel])
+        frequencymap = numpy.random.randint(0, nchan, size=[nvis])
+        uvgrid, sumwt = convolutional_grid(kernels, numpy.zeros([nchan, npol, npixel, npixel], dtype='complex'),
+                                           vis, visweights, uvcoords, frequencymap)
+        # Use a small chunksize to exercise the chunking
+        vuvgrid, vsumwt = convolutional_grid_vectorised(kernels,
+                                                        numpy.zeros([nchan, npol, npixel, npixel], dtype='complex'),
+                                                        vis, visweights, uvcoords, frequencymap, chunksize=10000)
+        assert_allclose(vsumwt, sumwt)
+        assert_allclose(vuvgrid, uvgrid, atol=1e-12)
+
+    def test_convolutional_grid_vectorised_kernel_list(self):
+        npixel = 64
+        nvis = 1000
+        npol = 1
+        kernel_list = [numpy.random.normal(size=[4, 4, 8, 8]) + 1j * numpy.random.normal(size=[4, 4, 8, 8])
+                       for i in range(3)]
+        uvcoords = numpy.array([[random.uniform(-0.25, 0.25), random.uniform(-0.25, 0.25)] for ivis in range(nvis)])
+        vis = numpy.random.normal(size=[nvis, npol]) + 1j * numpy.random.normal(size=[nvis, npol])
+        visweights = numpy.ones([nvis, npol])
+        kernels = (numpy.random.randint(0, 3, size=[nvis]), kernel_list)
+        frequencymap = numpy.zeros([nvis], dtype='int')
+        uvgrid, sumwt = convolutional_grid(kernels, numpy.zeros([1, npol, npixel, npixel], dtype='complex'),
+                                           vis, visweights, uvcoords, frequencymap)
+        vuvgrid, vsumwt = convolutional_grid_vectorised(kernels,
+                                                        numpy.zeros([1, npol, npixel, npixel], dtype='complex'),
+                                                        vis, visweights, uvcoords, frequencymap)
+        assert_allclose(vsumwt, sumwt)
+        assert_allclose(vuvgrid, uvgrid, atol=1e-12)
+
+    def test_convolutional_grid_vectorised_sparse(self):
+        # Two samples at opposite corners of different channels are in the same chunk. The temporaries must not
+        # span the grid between them.
+        npixel = 1024
+        nchan = 2
+        npol = 1
+        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        uvcoords = numpy.array([[-0.4, -0.4], [0.4, 0.4]])
+        vis = numpy.ones([2, npol], dtype='complex')
+        visweights = numpy.ones([2, npol])
+        kernels = (numpy.zeros([2], dtype='int'), [kernel])
+        frequencymap = numpy.array([0, 1])
+        uvgrid, sumwt = convolutional_grid(kernels, numpy.zeros([nchan, npol, npixel, npixel], dtype='complex'),
+                                           vis, visweights, uvcoords, frequencymap)
+        vuvgrid = numpy.zeros([nchan, npol, npixel, npixel], dtype='complex')
+        tracemalloc.start()
+        vuvgrid, vsumwt = convolutional_grid_vectorised(kernels, vuvgrid, vis, visweights, uvcoords, frequencymap)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert peak < 2 ** 20, peak
+        assert_allclose(vuvgrid, uvgrid, atol=1e-12)
+
+    def test_convolutional_grid_hermitian_sparse(self):
+        ny, nx = 1024, 1024
+        nchan = 2
+        npol = 1
+        gcf, kernel = anti_aliasing_calculate((ny, nx), 8)
+        # Direct and mirrored samples in different channels
+        uvcoords = numpy.array([[0.4, -0.4], [-0.4, 0.4], [0.4, 0.4], [-0.4, -0.4]])
+        vis = numpy.ones([4, npol], dtype='complex')
+        visweights = numpy.ones([4, npol])
+        kernels = (numpy.zeros([4], dtype='int'), [kernel])
+        frequencymap = numpy.array([0, 0, 1, 1])
+        uvgrid, sumwt = convolutional_grid_vectorised(kernels, numpy.zeros([nchan, npol, ny, nx], dtype='complex'),
+                                                      vis, visweights, uvcoords, frequencymap)
+        huvgrid = numpy.zeros([nchan, npol, ny, nx // 2 + 1], dtype='complex')
+        tracemalloc.start()
+        huvgrid, hsumwt = convolutional_grid_hermitian(kernels, huvgrid, vis, visweights, uvcoords, frequencymap)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert peak < 2 ** 20, peak
+        image = irfft2(huvgrid, (ny, nx)) * (1 - 2 * (numpy.arange(ny) % 2))[:, numpy.newaxis]
+        assert_allclose(image, numpy.real(ifft(uvgrid)), atol=1e-12)
+
     def test_convolutional_degrid(self):
         npixel = 256
         nvis = 100000
@@ -92,6 +185,88 @@ class TestConvolutionalGridding(unittest.TestCase):
         assert vis.shape[0] == nvis
         assert vis.shape[1] == npol
 
+    def test_convolutional_degrid_vectorised(self):
+        npixel = 256
+        nvis = 10000
+        nchan = 2
+        npol = 4
+        uvgrid = numpy.random.normal(size=[nchan, npol, npixel, npixel]) + \
+                 1j * numpy.random.normal(size=[nchan, npol, npixel, npixel])
+        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        uvcoords = numpy.array([[random.uniform(-0.25, 0.25), random.uniform(-0.25, 0.25)] for ivis in range(nvis)])
+        vshape = [nvis, npol]
+        kernels = (numpy.zeros([nvis], dtype='int'), [kernel])
+        frequencymap = numpy.random.randint(0, nchan, size=[nvis])
+        vis = convolutional_degrid(kernels, vshape, uvgrid, uvcoords, frequencymap)
+        # Use a small chunksize to exercise the chunking
+        vvis = convolutional_degrid_vectorised(kernels, vshape, uvgrid, uvcoords, frequencymap, chunksize=10000)
+        assert_allclose(vvis, vis, atol=1e-12)
+
+    def test_convolutional_degrid_vectorised_kernel_list(self):
+        npixel = 64
+        nvis = 1000
+        npol = 1
+        uvgrid = numpy.random.normal(size=[1, npol, npixel, npixel]) + \
+                 1j * numpy.random.normal(size=[1, npol, npixel, npixel])
+        kernel_list = [numpy.random.normal(size=[4, 4, 8, 8]) + 1j * numpy.random.normal(size=[4, 4, 8, 8])
+                       for i in range(3)]
+        uvcoords = numpy.array([[random.uniform(-0.25, 0.25), random.uniform(-0.25, 0.25)] for ivis in range(nvis)])
+        vshape = [nvis, npol]
+        kernels = (numpy.random.randint(0, 3, size=[nvis]), kernel_list)
+        frequencymap = numpy.zeros([nvis], dtype='int')
+        vis = convolutional_degrid(kernels, vshape, uvgrid, uvcoords, frequencymap)
+        vvis = convolutional_degrid_vectorised(kernels, vshape, uvgrid, uvcoords, frequencymap)
+        assert_allclose(vvis, vis, atol=1e-12)
+
+    def test_convolutional_grid_degrid_separable(self):
+        npixel = 256
+        nvis = 10000
+        npol = 4
+        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        _, skernel = anti_aliasing_calculate((npixel, npixel), 8, separable=True)
+        uvcoords = numpy.array([[random.uniform(-0.25, 0.25), random.uniform(-0.25, 0.25)] for ivis in range(nvis)])
+        vis = numpy.random.normal(size=[nvis, npol]) + 1j * numpy.random.normal(size=[nvis, npol])
+        visweights = numpy.ones([nvis, npol])
+        kernels = (numpy.zeros([nvis], dtype='int'), [kernel])
+        skernels = (numpy.zeros([nvis], dtype='int'), [skernel])
+        frequencymap = numpy.zeros([nvis], dtype='int')
+        uvgrid, sumwt = convolutional_grid(kernels, numpy.zeros([1, npol, npixel, npixel], dtype='complex'),
+                                           vis, visweights, uvcoords, frequencymap)
+        suvgrid, ssumwt = convolutional_grid_vectorised(skernels,
+                                                        numpy.zeros([1, npol, npixel, npixel], dtype='complex'),
+                                                        vis, visweights, uvcoords, frequencymap)
+        assert_allclose(ssumwt, sumwt)
+        assert_allclose(suvgrid, uvgrid, atol=1e-12)
+        
+        dvis = convolutional_degrid(kernels, [nvis, npol], uvgrid, uvcoords, frequencymap)
+        sdvis = convolutional_degrid_vectorised(skernels, [nvis, npol], uvgrid, uvcoords, frequencymap)
+        assert_allclose(sdvis, dvis, atol=1e-12)
+
+    def test_convolutional_grid_hermitian(self):
+        ny, nx = 64, 96
+        nvis = 3000
+        nchan = 2
+        npol = 2
+        kernel_list = [numpy.random.normal(size=[4, 4, 8, 8]) + 1j * numpy.random.normal(size=[4, 4, 8, 8])
+                       for i in range(3)]
+        # Include samples whose footprints touch the edges and straddle the v axis
+        uvcoords = numpy.random.uniform(-0.4, 0.4, size=[nvis, 2])
+        uvcoords[:100, 0] = numpy.random.uniform(-0.5 + 4.6 / nx, -0.5 + 6 / nx, size=100)
+        uvcoords[100:200, 1] = numpy.random.uniform(-0.5 + 4.6 / ny, -0.5 + 6 / ny, size=100)
+        uvcoords[200:400, 0] = numpy.random.uniform(-0.05, 0.05, size=200)
+        vis = numpy.random.normal(size=[nvis, npol]) + 1j * numpy.random.normal(size=[nvis, npol])
+        visweights = numpy.random.uniform(0.5, 1.0, size=[nvis, npol])
+        kernels = (numpy.random.randint(0, 3, size=[nvis]), kernel_list)
+        frequencymap = numpy.random.randint(0, nchan, size=[nvis])
+        uvgrid, sumwt = convolutional_grid_vectorised(kernels, numpy.zeros([nchan, npol, ny, nx], dtype='complex'),
+                                                      vis, visweights, uvcoords, frequencymap)
+        huvgrid, hsumwt = convolutional_grid_hermitian(kernels,
+                                                       numpy.zeros([nchan, npol, ny, nx // 2 + 1], dtype='complex'),
+                                                       vis, visweights, uvcoords, frequencymap, chunksize=10000)
+        assert_allclose(hsumwt, sumwt)
+        image = irfft2(huvgrid, (ny, nx)) * (1 - 2 * (numpy.arange(ny) % 2))[:, numpy.newaxis]
+        assert_allclose(image, numpy.real(ifft(uvgrid)), atol=1e-12)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -7,7 +7,9 @@ import unittest
 
 from numpy.testing import assert_allclose
 
-from libs.fourier_transforms.fft_support import extract_mid, pad_mid, extract_oversampled
+from libs.fourier_transforms.fft_support import extract_mid, pad_mid, extract_oversampled, fft, ifft, \
+    set_fft_backend, get_fft_backend, export_fftw_wisdom, import_fftw_wisdom, fft_checkerboard, ifft_checkerboard, \
+    checkerboard
 from libs.fourier_transforms.convolutional_gridding import coordinates2
 
 
@@ -39,6 +41,65 @@ class TestFFTSupport(unittest.TestCase):
             ex = extract_oversampled(a, 0, 0, kernel_oversampling, npixel) / kernel_oversampling ** 2
             assert_allclose(ex, 1 + self._pattern(npixel))
 
+    def _test_fft_backend(self, backend, workers):
+        for shape in [(64, 64), (2, 1, 128, 128), (3, 2, 100, 120)]:
+            a = numpy.random.normal(size=shape) + 1j * numpy.random.normal(size=shape)
+            assert_allclose(fft(a, backend=backend, workers=workers), fft(a, backend='numpy'), atol=1e-10)
+            assert_allclose(ifft(a, backend=backend, workers=workers), ifft(a, backend='numpy'), atol=1e-12)
+            assert_allclose(ifft(fft(a, backend=backend, workers=workers), backend=backend, workers=workers), a,
+                            atol=1e-12)
+    
+    def test_fft_numpy(self):
+        self._test_fft_backend('numpy', 1)
+    
+    def test_fft_scipy(self):
+        try:
+            import scipy.fft
+        except ImportError:
+            self.skipTest("scipy.fft not available")
+        self._test_fft_backend('scipy', 2)
+    
+    def test_fft_pyfftw(self):
+        try:
+            import pyfftw
+        except ImportError:
+            self.skipTest("pyfftw not available")
+        self._test_fft_backend('pyfftw', 2)
+        from data_models.parameters import arl_path
+        wisdomfile = arl_path('test_results/test_fft_pyfftw.wisdom')
+        export_fftw_wisdom(wisdomfile)
+        import_fftw_wisdom(wisdomfile)
+    
+    def test_set_fft_backend(self):
+        backend, workers = get_fft_backend()
+        try:
+            set_fft_backend('numpy', 4)
+            assert get_fft_backend() == ('numpy', 4)
+            with self.assertRaises(AssertionError):
+                set_fft_backend('fftpack')
+        finally:
+            set_fft_backend(backend, workers)
+        with self.assertRaises(ValueError):
+            fft(numpy.zeros([16, 16], dtype='complex'), backend='fftpack')
+
+    def test_fft_checkerboard(self):
+        for shape in [(64, 64), (2, 1, 128, 128), (3, 2, 100, 120), (1, 1, 98, 102)]:
+            a = numpy.random.normal(size=shape) + 1j * numpy.random.normal(size=shape)
+            assert_allclose(fft_checkerboard(a), fft(a), atol=1e-10)
+            assert_allclose(ifft_checkerboard(a), ifft(a), atol=1e-12)
+            b = a.copy()
+            assert_allclose(fft_checkerboard(b, overwrite_input=True), fft(a), atol=1e-10)
+            b = a.copy()
+            assert_allclose(ifft_checkerboard(b, overwrite_input=True), ifft(a), atol=1e-12)
+    
+    def test_checkerboard(self):
+        cb = checkerboard(4, 6)
+        assert cb[0, 0] == 1.0 and cb[0, 1] == -1.0 and cb[1, 1] == 1.0
+        assert_allclose(checkerboard(4, 6, signed=True), -cb)
+        assert_allclose(checkerboard(4, 8, signed=True), checkerboard(4, 8))
+        with self.assertRaises(AssertionError):
+            checkerboard(5, 6)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -64,12 +64,28 @@ class TestCalibrationContext(unittest.TestCase):
         controls = create_calibration_controls()
         controls['T']['first_selfcal'] = 0
         controls['B']['first_selfcal'] = 0
+        # Controls made before the solver could be chosen have no solver, and use Antsol
+        for c in controls:
+            del controls[c]['solver']
         calibrated_vis, gaintables = calibrate_function(self.vis, original, calibration_context='TB', controls=controls)
         residual = numpy.max(gaintables['T'].residual)
         assert residual < 3e-2, "Max T residual = %s" % (residual)
         residual = numpy.max(gaintables['B'].residual)
         assert residual < 6e-5, "Max B residual = %s" % (residual)
 
+    def test_calibrate_function_stefcal(self):
+        self.actualSetup('stokesI', 'stokesI', f=[100.0])
+        gt = create_gaintable_from_blockvisibility(self.vis)
+        gt = simulate_gaintable(gt, phase_error=10.0, amplitude_error=0.0)
+        original = copy_visibility(self.vis)
+        self.vis = apply_gaintable(self.vis, gt)
+        controls = create_calibration_controls(solver='stefcal')
+        assert controls['T']['solver'] == 'stefcal'
+        assert controls['P']['solver'] == 'antsol'
+        calibrated_vis, gaintables = calibrate_function(self.vis, original, calibration_context='T', controls=controls)
+        residual = numpy.max(gaintables['T'].residual)
+        assert residual < 1e-6, "Max T residual = %s" % (residual)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -14,7 +14,7 @@ from data_models.memory_data_models import Skycomponent, GainTable
 from data_models.polarisation import PolarisationFrame
 
 from processing_components.calibration.operations import gaintable_summary, apply_gaintable, create_gaintable_from_blockvisibility, \
-    create_gaintable_from_rows
+    create_gaintable_from_rows, invert_jones_matrices
 from processing_components.simulation.testing_support import create_named_configuration, simulate_gaintable
 from processing_components.visibility.base import copy_visibility, create_blockvisibility
 from processing_components.imaging.base import predict_skycomponent_visibility
@@ -133,6 +133,15 @@ class TestCalibrationOperations(unittest.TestCase):
             error = numpy.max(numpy.abs(vis.vis[:,0,1,...] - original.vis[:,0,1,...]))
             assert error < 1e-12, "Error = %s" % (error)
 
+    def test_invert_jones_matrices(self):
+        gain = numpy.random.randn(3, 4, 2, 2) + 1j * numpy.random.randn(3, 4, 2, 2)
+        gain[1, 2] = [[1.0, 2.0], [1.0, 2.0]]
+        inverse, valid = invert_jones_matrices(gain)
+        assert not valid[1, 2]
+        assert numpy.sum(valid) == 11
+        error = numpy.max(numpy.abs(numpy.matmul(inverse[valid], gain[valid]) - numpy.identity(2)))
+        assert error < 1e-12, "Error = %s" % (error)
+
     def test_create_gaintable_from_rows_makecopy(self):
         self.actualSetup('stokesIQUV', 'linear')
         gt = create_gaintable_from_blockvisibility(self.vis, timeslice='auto')
@@ -14,10 +14,10 @@ from data_models.polarisation import PolarisationFrame
 
 from processing_components.calibration.operations import apply_gaintable, create_gaintable_from_blockvisibility, gaintable_summary, \
     qa_gaintable
-from processing_components.calibration.calibration import solve_gaintable
+from processing_components.calibration.calibration import solve_gaintable, solution_intervals, sum_point_source
 from processing_components.simulation.testing_support import create_named_configuration, simulate_gaintable
 from processing_components.visibility.operations import divide_visibility
-from processing_components.visibility.base import copy_visibility, create_blockvisibility
+from processing_components.visibility.base import copy_visibility, create_blockvisibility, create_visibility_from_rows
 from processing_components.imaging.base import predict_skycomponent_visibility
 
 import logging
@@ -29,7 +29,7 @@ class TestCalibrationSolvers(unittest.TestCase):
     def setUp(self):
         numpy.random.seed(180555)
         
-    def actualSetup(self, sky_pol_frame='stokesIQUV', data_pol_frame='linear', f=None, vnchan=3):
+    def actualSetup(self, sky_pol_frame='stokesIQUV', data_pol_frame='linear', f=None, vnchan=3, compact=False):
         self.lowcore = create_named_configuration('LOWBD2', rmax=300.0)
         self.times = (numpy.pi / 43200.0) * numpy.linspace(0.0, 30.0, 3)
         self.frequency = numpy.linspace(1.0e8, 1.1e8, vnchan)
@@ -51,7 +51,7 @@ class TestCalibrationSolvers(unittest.TestCase):
                                  polarisation_frame=PolarisationFrame(sky_pol_frame))
         self.vis = create_blockvisibility(self.lowcore, self.times, self.frequency, phasecentre=self.phasecentre,
                                           channel_bandwidth=self.channel_bandwidth, weight=1.0,
-                                          polarisation_frame=PolarisationFrame(data_pol_frame))
+                                          polarisation_frame=PolarisationFrame(data_pol_frame), compact=compact)
         self.vis = predict_skycomponent_visibility(self.vis, self.comp)
 
     def test_solve_gaintable_scalar(self):
@@ -104,17 +104,49 @@ class TestCalibrationSolvers(unittest.TestCase):
         assert residual < 3e-8, "Max residual = %s" % (residual)
         assert numpy.max(numpy.abs(gtsol.gain - 1.0)) > 0.1
 
+    def test_solve_gaintable_scalar_pointsource_compact(self):
+        self.actualSetup('stokesI', 'stokesI', f=[100.0], compact=True)
+        assert self.vis.compact
+        gt = create_gaintable_from_blockvisibility(self.vis)
+        gt = simulate_gaintable(gt, phase_error=10.0, amplitude_error=0.0)
+        original = copy_visibility(self.vis)
+        self.vis = apply_gaintable(self.vis, gt)
+        point_vis = divide_visibility(self.vis, original)
+        gtsol = solve_gaintable(point_vis, phase_only=True, niter=200)
+        residual = numpy.max(gtsol.residual)
+        assert residual < 3e-8, "Max residual = %s" % (residual)
+        assert numpy.max(numpy.abs(gtsol.gain - 1.0)) > 0.1
+
+    def test_solve_gaintable_scalar_stefcal(self):
+        self.actualSetup('stokesI', 'stokesI', f=[100.0])
+        gt = create_gaintable_from_blockvisibility(self.vis)
+        gt = simulate_gaintable(gt, phase_error=10.0, amplitude_error=0.1)
+        original = copy_visibility(self.vis)
+        self.vis = apply_gaintable(self.vis, gt)
+        gtsol = solve_gaintable(self.vis, original, phase_only=False, niter=30, solver='stefcal')
+        residual = numpy.max(gtsol.residual)
+        assert residual < 3e-8, "Max residual = %s" % (residual)
+        assert numpy.max(numpy.abs(gtsol.gain - 1.0)) > 0.1
+        assert gtsol.data.dtype == gt.data.dtype
+
+    def test_solve_gaintable_matrix_stefcal(self):
+        self.actualSetup('stokesIQUV', 'linear')
+        with self.assertRaises(AssertionError):
+            solve_gaintable(self.vis, copy_visibility(self.vis), crosspol=True, solver='stefcal')
+
     def core_solve(self, spf, dpf, phase_error=0.1, amplitude_error=0.0, leakage=0.0,
-                   phase_only=True, niter=200, crosspol=False, residual_tol=1e-6, f=None, vnchan=3):
+                   phase_only=True, niter=200, crosspol=False, residual_tol=1e-6, f=None, vnchan=3, compact=False,
+                   solver='antsol'):
         if f is None:
             f = [100.0, 50.0, -10.0, 40.0]
-        self.actualSetup(spf, dpf, f=f, vnchan=vnchan)
+        self.actualSetup(spf, dpf, f=f, vnchan=vnchan, compact=compact)
         gt = create_gaintable_from_blockvisibility(self.vis)
         log.info("Created gain table: %s" % (gaintable_summary(gt)))
         gt = simulate_gaintable(gt, phase_error=phase_error, amplitude_error=amplitude_error, leakage=leakage)
         original = copy_visibility(self.vis)
         vis = apply_gaintable(self.vis, gt)
-        gtsol = solve_gaintable(self.vis, original, phase_only=phase_only, niter=niter, crosspol=crosspol, tol=1e-6)
+        gtsol = solve_gaintable(self.vis, original, phase_only=phase_only, niter=niter, crosspol=crosspol, tol=1e-6,
+                                solver=solver)
         vis = apply_gaintable(vis, gtsol, inverse=True)
         residual = numpy.max(gtsol.residual)
         assert residual < residual_tol, "%s %s Max residual = %s" % (spf, dpf, residual)
@@ -145,6 +177,14 @@ class TestCalibrationSolvers(unittest.TestCase):
         self.core_solve('stokesIQUV', 'circular', phase_error=0.1, amplitude_error=0.01,
                         phase_only=False, f=[100.0, 0.0, 0.0, 50.0])
     
+    def test_solve_gaintable_vector_phase_only_linear_stefcal(self):
+        self.core_solve('stokesIQUV', 'linear', phase_error=0.1, phase_only=True,
+                        f=[100.0, 50.0, 0.0, 0.0], solver='stefcal')
+    
+    def test_solve_gaintable_vector_both_linear_stefcal(self):
+        self.core_solve('stokesIQUV', 'linear', phase_error=0.1, amplitude_error=0.01,
+                        phase_only=False, f=[100.0, 50.0, 0.0, 0.0], niter=30, solver='stefcal')
+    
     def test_solve_gaintable_matrix_both_linear(self):
         self.core_solve('stokesIQUV', 'linear', phase_error=0.1, amplitude_error=0.01,
                         leakage=0.01, residual_tol=1e-3, crosspol=True,
@@ -154,11 +194,77 @@ class TestCalibrationSolvers(unittest.TestCase):
         self.core_solve('stokesIQUV', 'circular', phase_error=0.1, amplitude_error=0.01,
                         leakage=0.01, residual_tol=1e-3, crosspol=True,
                         phase_only=False, f=[100.0, 0.0, 0.0, 50.0])
+    
+    def test_solve_gaintable_vector_both_linear_compact(self):
+        self.core_solve('stokesIQUV', 'linear', phase_error=0.1, amplitude_error=0.01,
+                        phase_only=False, f=[100.0, 50.0, 0.0, 0.0], compact=True)
+    
+    def test_solve_gaintable_matrix_both_linear_compact(self):
+        self.core_solve('stokesIQUV', 'linear', phase_error=0.1, amplitude_error=0.01,
+                        leakage=0.01, residual_tol=1e-3, crosspol=True,
+                        phase_only=False, f=[100.0, 50.0, 0.0, 0.0], compact=True)
         
     def test_solve_gaintable_matrix_both_circular_channel(self):
         self.core_solve('stokesIQUV', 'circular', phase_error=0.1, amplitude_error=0.01,
                         leakage=0.01, residual_tol=1e-3, crosspol=True, vnchan=4,
                         phase_only=False, f=[100.0, 0.0, 0.0, 50.0])
+    
+    def test_solve_gaintable_intervals_independent(self):
+        self.actualSetup('stokesIQUV', 'linear', f=[100.0, 50.0, 0.0, 0.0])
+        gt = create_gaintable_from_blockvisibility(self.vis)
+        gt = simulate_gaintable(gt, phase_error=10.0, amplitude_error=0.1)
+        original = copy_visibility(self.vis)
+        vis = apply_gaintable(self.vis, gt)
+        gtsol = solve_gaintable(vis, original, phase_only=False, niter=200, tol=1e-6)
+        # The intervals are solved together but each must converge as if solved alone
+        for row, time in enumerate(gtsol.time):
+            rows = vis.time == time
+            rowsol = solve_gaintable(create_visibility_from_rows(vis, rows),
+                                     create_visibility_from_rows(original, rows),
+                                     phase_only=False, niter=200, tol=1e-6)
+            assert numpy.max(numpy.abs(rowsol.gain[0] - gtsol.gain[row])) < 1e-12
+            assert numpy.max(numpy.abs(rowsol.residual[0] - gtsol.residual[row])) < 1e-12
+
+    def test_solution_intervals(self):
+        self.actualSetup('stokesI', 'stokesI', f=[100.0])
+        gt = create_gaintable_from_blockvisibility(self.vis)
+        time = numpy.array([0.0, 1.0, 1.5, 2.5, 3.0, 3.0, 10.0, 12.0])
+        # Irregular and overlapping intervals, intervals with no times, and times on the edges of intervals
+        for gtime, interval in [([0.5, 2.0, 3.5, 11.0], [1.0, 1.0, 1.0, 2.0]),
+                                ([0.0, 1.0, 10.0], [1.0, 19.0, 3.0]),
+                                ([5.0, 6.0, 12.0], [1.0, 1.0, 4.0])]:
+            gt.data = numpy.zeros([len(gtime)], dtype=gt.data.dtype)
+            gt.data['time'] = gtime
+            gt.data['interval'] = interval
+            for vtime in [time, time[::-1]]:
+                order, starts, stops = solution_intervals(vtime, gt)
+                for row in range(gt.ntimes):
+                    expected = numpy.flatnonzero(numpy.abs(vtime - gt.time[row]) < gt.interval[row] / 2.0)
+                    found = numpy.sort(order[starts[row]:stops[row]]) if stops[row] > starts[row] else []
+                    assert numpy.array_equal(found, expected), (gtime, interval, row)
+
+    def test_sum_point_source(self):
+        for sky, data in [('stokesI', 'stokesI'), ('stokesIQUV', 'linear')]:
+            self.actualSetup(sky, data, f=[100.0] if sky == 'stokesI' else None)
+            vis = copy_visibility(self.vis)
+            vis.data['vis'] *= numpy.random.uniform(0.5, 1.5, vis.vis.shape)
+            vis.data['weight'] *= numpy.random.uniform(0.5, 1.5, vis.vis.shape)
+            pointvis = divide_visibility(vis, self.vis)
+            time = vis.time
+            order = numpy.arange(len(time))
+            # Successive ranges, and overlapping ranges
+            for starts, stops in [([0, 1], [1, 3]), ([0, 1], [2, 3])]:
+                starts, stops = numpy.array(starts), numpy.array(stops)
+                for modelvis in [None, self.vis]:
+                    x, xwt = sum_point_source(vis, modelvis, order, starts, stops)
+                    source = vis if modelvis is None else pointvis
+                    for i, (start, stop) in enumerate(zip(starts, stops)):
+                        numpy.testing.assert_allclose(x[i], numpy.sum(source.vis[start:stop] *
+                                                                      source.weight[start:stop], axis=0),
+                                                      rtol=1e-12, atol=1e-12)
+                        numpy.testing.assert_allclose(xwt[i], numpy.sum(source.weight[start:stop], axis=0),
+                                                      rtol=1e-12, atol=1e-12)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -19,6 +19,7 @@ from processing_components.simulation.testing_support import create_named_config
     create_unittest_model, insert_unittest_errors, create_unittest_components
 from processing_components.skycomponent.operations import find_skycomponents, find_nearest_skycomponent, \
     insert_skycomponent
+from processing_components.visibility.coalesce import create_coalescence_plan
 from processing_components.visibility.operations import copy_visibility
 
 log = logging.getLogger(__name__)
@@ -199,6 +200,32 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp(zerow=True)
         self._invert_base(context='2d', positionthreshold=2.0, check_components=False)
     
+    def test_invert_2d_hermitian(self):
+        self.actualSetUp(zerow=True, dopol=True)
+        for dopsf in [False, True]:
+            dirty = invert_function(self.vis, self.model, context='2d', dopsf=dopsf)
+            hdirty = invert_function(self.vis, self.model, context='2d', dopsf=dopsf, hermitian=True)
+            numpy.testing.assert_allclose(hdirty[0].data, dirty[0].data, atol=1e-10)
+            numpy.testing.assert_allclose(hdirty[1], dirty[1])
+        # Only the vectorised gridder grids the half plane, so the loop gridder must be used on the full plane
+        dirty = invert_function(self.vis, self.model, context='2d')
+        with self.assertLogs('processing_components.imaging.base', level='WARNING'):
+            ldirty = invert_function(self.vis, self.model, context='2d', hermitian=True, gridder='loop')
+        numpy.testing.assert_allclose(ldirty[0].data, dirty[0].data, atol=1e-10)
+    
+    def test_predict_invert_2d_coalescence_plan(self):
+        self.actualSetUp(zerow=True, block=True)
+        coalescence = {'time_coal': 1.0, 'max_time_coal': 3}
+        plan = create_coalescence_plan(self.vis, **coalescence)
+        dirty = invert_function(self.vis, self.model, context='2d', **coalescence)
+        pdirty = invert_function(self.vis, self.model, context='2d', coalescence_plan=plan, **coalescence)
+        numpy.testing.assert_allclose(pdirty[0].data, dirty[0].data, atol=1e-10)
+        numpy.testing.assert_allclose(pdirty[1], dirty[1])
+        vis = predict_function(copy_visibility(self.vis, zero=True), self.model, context='2d', **coalescence)
+        pvis = predict_function(copy_visibility(self.vis, zero=True), self.model, context='2d',
+                                coalescence_plan=plan, **coalescence)
+        numpy.testing.assert_allclose(pvis.vis, vis.vis, atol=1e-10)
+    
     def test_invert_facets(self):
         self.actualSetUp()
         self._invert_base(context='facets', positionthreshold=2.0, check_components=True, facets=8)
@@ -11,7 +11,8 @@ from astropy.coordinates import SkyCoord
 
 from data_models.polarisation import PolarisationFrame
 
-from libs.imaging.imaging_params import get_frequency_map, w_kernel_list
+from libs.imaging.imaging_params import get_frequency_map, w_kernel_list, get_kernel_list, anti_aliasing_cache, \
+    WKernelCache
 
 from processing_components.simulation.testing_support import create_named_configuration, create_low_test_image_from_gleam
 from processing_components.visibility.base import create_visibility
@@ -93,6 +94,62 @@ class TestImagingParams(unittest.TestCase):
                                                     wstep=50, oversampling=3,
                                                     maxsupport=128)
 
+    def test_w_kernel_list_cache(self):
+        cache = WKernelCache()
+        kernel_indices, kernels = w_kernel_list(self.vis, self.model, kernelwidth=16, wstep=50, oversampling=2,
+                                                cache=cache)
+        assert cache.misses == len(kernels)
+        assert cache.hits == 0
+        kernel_indices2, kernels2 = w_kernel_list(self.vis, self.model, kernelwidth=16, wstep=50, oversampling=2,
+                                                  cache=cache)
+        assert cache.hits == len(kernels)
+        assert cache.misses == len(kernels)
+        numpy.testing.assert_array_equal(kernel_indices, kernel_indices2)
+        for kernel, kernel2 in zip(kernels, kernels2):
+            assert kernel is kernel2
+        
+        # Different kernel parameters must not hit
+        w_kernel_list(self.vis, self.model, kernelwidth=16, wstep=50, oversampling=4, cache=cache)
+        assert cache.misses == 2 * len(kernels)
+
+    def test_w_kernel_list_cache_eviction(self):
+        kernel_indices, kernels = w_kernel_list(self.vis, self.model, kernelwidth=16, wstep=50, oversampling=2,
+                                                cache=WKernelCache())
+        assert len(kernels) > 2
+        cache = WKernelCache(max_bytes=2 * kernels[0].nbytes)
+        w_kernel_list(self.vis, self.model, kernelwidth=16, wstep=50, oversampling=2, cache=cache)
+        assert len(cache) == 2
+        assert cache.nbytes <= cache.max_bytes
+
+    def test_w_kernel_list_cache_disk(self):
+        import shutil
+        cache_dir = "%s/test_w_kernel_list_cache" % self.dir
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        kernel_indices, kernels = w_kernel_list(self.vis, self.model, kernelwidth=16, wstep=50, oversampling=2,
+                                                cache=WKernelCache(cache_dir=cache_dir))
+        warm = WKernelCache(cache_dir=cache_dir)
+        kernel_indices, kernels2 = w_kernel_list(self.vis, self.model, kernelwidth=16, wstep=50, oversampling=2,
+                                                 cache=warm)
+        assert warm.disk_hits == len(kernels)
+        assert warm.misses == 0
+        for kernel, kernel2 in zip(kernels, kernels2):
+            numpy.testing.assert_array_equal(kernel, kernel2)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_get_kernel_list_cache(self):
+        anti_aliasing_cache.cache_clear()
+        kernelname, gcf, (kernel_indices, kernels) = get_kernel_list(self.vis, self.model, oversampling=8)
+        assert kernelname == '2d'
+        misses = anti_aliasing_cache.cache_info().misses
+        assert misses > 0
+        kernelname, gcf2, (kernel_indices, kernels2) = get_kernel_list(self.vis, self.model, oversampling=8)
+        assert anti_aliasing_cache.cache_info().misses == misses
+        assert anti_aliasing_cache.cache_info().hits > 0
+        assert gcf2 is gcf
+        assert kernels2[0] is kernels[0]
+        with self.assertRaises(ValueError):
+            gcf[0, 0] = 0.0
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -6,6 +6,7 @@ import unittest
 
 import numpy
 
+from astropy import constants
 from astropy.coordinates import SkyCoord
 import astropy.units as u
 
@@ -13,8 +14,9 @@ from data_models.polarisation import PolarisationFrame
 
 from processing_components.simulation.testing_support import create_named_configuration
 from processing_components.visibility.coalesce import coalesce_visibility, decoalesce_visibility, \
-    convert_blockvisibility_to_visibility
-from processing_components.visibility.base import create_blockvisibility, create_visibility_from_rows
+    convert_blockvisibility_to_visibility, convert_blocks, create_coalescence_plan
+from processing_components.visibility.base import create_blockvisibility, create_visibility_from_rows, \
+    convert_blockvisibility_to_compact, copy_visibility
 from processing_components.visibility.iterators import vis_timeslice_iter
 
 import logging
@@ -53,6 +55,54 @@ class TestCoalesce(unittest.TestCase):
         dvis = decoalesce_visibility(cvis, overwrite=True)
         assert dvis.nvis == self.blockvis.nvis
 
+    def test_convert_blocks(self):
+        ntimes, nant, nchan, npol = 3, 6, 2, 4
+        vis = numpy.random.normal(size=[ntimes, nant, nant, nchan, npol]) + \
+              1j * numpy.random.normal(size=[ntimes, nant, nant, nchan, npol])
+        wts = numpy.random.uniform(size=[ntimes, nant, nant, nchan, npol])
+        uvw = numpy.random.normal(size=[ntimes, nant, nant, 3])
+        times = numpy.arange(ntimes) * 10.0
+        integration_time = numpy.random.uniform(9.0, 11.0, size=[ntimes])
+        frequency = numpy.array([1e8, 1.1e8])
+        channel_bandwidth = numpy.array([1e6, 2e6])
+        cvis, cuvw, cwts, ctime, cfrequency, cchannel_bandwidth, ca1, ca2, cintegration_time, cindex = \
+            convert_blocks(vis, uvw, wts, times, integration_time, frequency, channel_bandwidth)
+        # Check against the rows in the order time, antenna1, antenna2 > antenna1, channel
+        row = 0
+        for itime in range(ntimes):
+            for a1 in range(nant):
+                for a2 in range(a1 + 1, nant):
+                    for chan in range(nchan):
+                        assert (ca1[row], ca2[row]) == (a1, a2)
+                        assert ctime[row] == times[itime]
+                        assert cintegration_time[row] == integration_time[itime]
+                        assert cfrequency[row] == frequency[chan]
+                        assert cchannel_bandwidth[row] == channel_bandwidth[chan]
+                        assert numpy.array_equal(cuvw[row], uvw[itime, a2, a1] * frequency[chan] / constants.c.value)
+                        assert numpy.array_equal(cvis[row], vis[itime, a2, a1, chan])
+                        assert numpy.array_equal(cwts[row], wts[itime, a2, a1, chan])
+                        assert cindex[((itime * nant + a2) * nant + a1) * nchan + chan] == row
+                        row += 1
+        assert row == cvis.shape[0]
+        # The frequencies may be given as lists
+        lcvis, lcuvw = convert_blocks(vis, uvw, wts, times, integration_time, list(frequency),
+                                      list(channel_bandwidth))[:2]
+        assert numpy.array_equal(lcvis, cvis)
+        assert numpy.array_equal(lcuvw, cuvw)
+
+    def test_convert_decoalesce_values(self):
+        self.blockvis = create_blockvisibility(self.lowcore, self.times[:3], self.frequency,
+                                               phasecentre=self.phasecentre, weight=1.0,
+                                               polarisation_frame=PolarisationFrame('linear'),
+                                               channel_bandwidth=self.channel_bandwidth)
+        original = numpy.arange(self.blockvis.vis.size).reshape(self.blockvis.vis.shape) * (1.0 + 1.0j)
+        self.blockvis.data['vis'][...] = original
+        cvis = convert_blockvisibility_to_visibility(self.blockvis)
+        dvis = decoalesce_visibility(cvis, overwrite=True)
+        # Only the baselines with antenna2 > antenna1 are in the converted Visibility
+        a2, a1 = numpy.tril_indices(self.blockvis.vis.shape[1], -1)
+        assert numpy.array_equal(dvis.vis[:, a2, a1, ...], original[:, a2, a1, ...])
+
     def test_coalesce_decoalesce(self):
         cvis = coalesce_visibility(self.blockvis, time_coal=1.0, frequency_coal=1.0)
         assert numpy.min(cvis.frequency) == numpy.min(self.frequency)
@@ -62,6 +112,97 @@ class TestCoalesce(unittest.TestCase):
         dvis = decoalesce_visibility(cvis, overwrite=True)
         assert dvis.nvis == self.blockvis.nvis
 
+    def test_coalesce_cindex(self):
+        cvis = coalesce_visibility(self.blockvis, time_coal=1.0, frequency_coal=1.0)
+        ntimes, nant, _, nchan, npol = self.blockvis.vis.shape
+        cindex = cvis.cindex.reshape([ntimes, nant, nant, nchan])
+        itime, a2, a1, chan = numpy.meshgrid(numpy.arange(ntimes), numpy.arange(nant), numpy.arange(nant),
+                                             numpy.arange(nchan), indexing='ij')
+        # Each element of the block goes to a row for the same baseline, and each row is the
+        # average of the elements going to it
+        assert numpy.array_equal(cvis.antenna1[cindex], a1)
+        assert numpy.array_equal(cvis.antenna2[cindex], a2)
+        count = numpy.bincount(cindex.flatten(), minlength=cvis.nvis)
+        assert numpy.min(count) > 0
+        meantime = numpy.bincount(cindex.flatten(), weights=self.blockvis.time[itime].flatten()) / count
+        numpy.testing.assert_allclose(cvis.time, meantime)
+        meanfrequency = numpy.bincount(cindex.flatten(), weights=self.frequency[chan].flatten()) / count
+        numpy.testing.assert_allclose(cvis.frequency, meanfrequency)
+
+    def test_coalescence_plan(self):
+        self.blockvis.data['vis'] = numpy.random.randn(*self.blockvis.vis.shape) + \
+                                    1j * numpy.random.randn(*self.blockvis.vis.shape)
+        self.blockvis.data['weight'] = numpy.random.uniform(0.5, 1.0, self.blockvis.vis.shape)
+        for kwargs in [{}, {'time_coal': 1.0, 'frequency_coal': 1.0}, {'time_coal': 1.0, 'max_time_coal': 2}]:
+            plan = create_coalescence_plan(self.blockvis, **kwargs)
+            assert plan.matches(self.blockvis)
+            cvis = coalesce_visibility(self.blockvis, **kwargs)
+            pvis = coalesce_visibility(self.blockvis, coalescence_plan=plan, **kwargs)
+            assert pvis.blockvis is self.blockvis
+            assert numpy.array_equal(pvis.cindex, cvis.cindex)
+            for column in ['uvw', 'time', 'frequency', 'antenna1', 'antenna2', 'imaging_weight']:
+                assert numpy.array_equal(pvis.data[column], cvis.data[column]), column
+            numpy.testing.assert_allclose(pvis.vis, cvis.vis, atol=1e-12)
+            numpy.testing.assert_allclose(pvis.weight, cvis.weight, atol=1e-12)
+            dvis = plan.decoalesce(pvis, overwrite=True)
+            numpy.testing.assert_allclose(dvis.vis, decoalesce_visibility(cvis, overwrite=True).vis, atol=1e-12)
+
+    def test_coalescence_plan_flagged(self):
+        rng = numpy.random.RandomState(1805550721)
+        shape = self.blockvis.vis.shape
+        self.blockvis.data['vis'] = rng.randn(*shape) + 1j * rng.randn(*shape)
+        self.blockvis.data['weight'] = rng.uniform(0.5, 1.0, shape) * (rng.uniform(0.0, 1.0, shape) > 0.3)
+        for kwargs in [{}, {'time_coal': 1.0, 'frequency_coal': 1.0},
+                       {'frequency_coal': 1.0, 'max_frequency_coal': 2}]:
+            plan = create_coalescence_plan(self.blockvis, **kwargs)
+            cvis = coalesce_visibility(self.blockvis, **kwargs)
+            pvis = coalesce_visibility(self.blockvis, coalescence_plan=plan, **kwargs)
+            numpy.testing.assert_allclose(pvis.vis, cvis.vis, atol=1e-12)
+            numpy.testing.assert_allclose(pvis.weight, cvis.weight, atol=1e-12)
+            
+            # Flagging more samples changes the coalescence, so the plan must not be used
+            flaggedvis = copy_visibility(self.blockvis)
+            flaggedvis.data['weight'][0, ...] = 0.0
+            assert not plan.matches(flaggedvis)
+            pvis = coalesce_visibility(flaggedvis, coalescence_plan=plan, **kwargs)
+            numpy.testing.assert_allclose(pvis.vis, coalesce_visibility(flaggedvis, **kwargs).vis, atol=1e-12)
+
+    def test_coalescence_plan_no_match(self):
+        plan = create_coalescence_plan(self.blockvis, time_coal=1.0)
+        for rows in vis_timeslice_iter(self.blockvis):
+            visslice = create_visibility_from_rows(self.blockvis, rows)
+            assert not plan.matches(visslice)
+            cvisslice = coalesce_visibility(visslice, coalescence_plan=plan, time_coal=1.0)
+            assert cvisslice.blockvis is visslice
+
+    def test_coalesce_compact(self):
+        self.blockvis.data['vis'] = numpy.random.randn(*self.blockvis.vis.shape) + \
+                                    1j * numpy.random.randn(*self.blockvis.vis.shape)
+        self.blockvis.data['weight'] = numpy.random.uniform(0.5, 1.0, self.blockvis.vis.shape)
+        compactvis = convert_blockvisibility_to_compact(self.blockvis)
+        
+        def upper_rows(vis):
+            # The rows for baselines antenna1 < antenna2, in a fixed order
+            order = numpy.lexsort((vis.frequency, vis.time, vis.antenna2, vis.antenna1))
+            return vis.data[order[vis.antenna1[order] < vis.antenna2[order]]]
+        
+        for kwargs in [{}, {'time_coal': 1.0, 'frequency_coal': 1.0}]:
+            cvis = upper_rows(coalesce_visibility(self.blockvis, **kwargs))
+            compactcvis = coalesce_visibility(compactvis, **kwargs)
+            assert numpy.all(compactcvis.antenna1 < compactcvis.antenna2)
+            pvis = upper_rows(compactcvis)
+            for column in ['uvw', 'time', 'frequency', 'antenna1', 'antenna2', 'vis', 'weight']:
+                numpy.testing.assert_allclose(pvis[column], cvis[column], atol=1e-12, err_msg=column)
+            plan = create_coalescence_plan(compactvis, **kwargs)
+            assert plan.matches(compactvis)
+            assert not plan.matches(self.blockvis)
+            numpy.testing.assert_allclose(plan.coalesce(compactvis).vis, compactcvis.vis, atol=1e-12)
+        
+        cvis = convert_blockvisibility_to_visibility(compactvis)
+        dvis = decoalesce_visibility(cvis, overwrite=True)
+        assert dvis.compact
+        assert numpy.array_equal(dvis.vis, compactvis.vis)
+
     def test_coalesce_decoalesce_frequency(self):
         cvis = coalesce_visibility(self.blockvis, time_coal=0.0, max_time_coal=1, frequency_coal=1.0)
         assert numpy.min(cvis.frequency) == numpy.min(self.frequency)
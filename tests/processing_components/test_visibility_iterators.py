@@ -8,7 +8,8 @@ import unittest
 from astropy.coordinates import SkyCoord
 import astropy.units as u
 from processing_components.simulation.testing_support import create_named_configuration
-from processing_components.visibility.iterators import vis_timeslice_iter, vis_wslice_iter, vis_null_iter, vis_timeslices, vis_wslices
+from processing_components.visibility.iterators import vis_timeslice_iter, vis_wslice_iter, vis_null_iter, vis_timeslices, vis_wslices, \
+    vis_slice_index, vis_slice_views
 from processing_components.visibility.base import create_visibility, create_visibility_from_rows
 
 import logging
@@ -52,7 +53,7 @@ class TestVisibilityIterators(unittest.TestCase):
             total_rows += visslice.nvis
             assert visslice.vis[0].real == visslice.time[0]
             assert len(rows)
-            assert numpy.sum(rows) < self.vis.nvis
+            assert len(rows) < self.vis.nvis
         assert total_rows == self.vis.nvis, "Total rows iterated %d, Original rows %d" % (total_rows, self.vis.nvis)
 
 
@@ -76,5 +77,61 @@ class TestVisibilityIterators(unittest.TestCase):
             assert numpy.sum(visslice.nvis) < self.vis.nvis
         assert total_rows == self.vis.nvis, "Total rows iterated %d, Original rows %d" % (total_rows, self.vis.nvis)
 
+    def test_vis_slice_index(self):
+        self.actualSetUp()
+        for axis, nchunks in [('time', 3), ('time', len(self.times)), ('w', 11), ('w', 101)]:
+            rows, offsets = vis_slice_index(self.vis, nchunks, axis=axis)
+            assert len(offsets) == nchunks + 1
+            values = self.vis.time if axis == 'time' else self.vis.w
+            boxes = numpy.linspace(numpy.min(values), numpy.max(values), nchunks) if axis == 'time' else \
+                numpy.linspace(-numpy.max(numpy.abs(values)), numpy.max(numpy.abs(values)), nchunks)
+            for chunk in range(nchunks):
+                if axis == 'time':
+                    mask = numpy.abs(values - boxes[chunk]) <= 0.5 * (boxes[1] - boxes[0])
+                else:
+                    mask = numpy.abs(values - boxes[chunk]) < 0.5 * (boxes[1] - boxes[0])
+                assert numpy.array_equal(rows[offsets[chunk]:offsets[chunk + 1]], numpy.nonzero(mask)[0])
+
+    def test_vis_slice_index_degenerate(self):
+        # Compare with the per-slice boolean masks, for data with a single time or a single w
+        def mask_rows(values, boxes, halfwidth, axis):
+            if axis == 'time':
+                return [numpy.nonzero(numpy.abs(values - box) <= halfwidth)[0] for box in boxes]
+            else:
+                return [numpy.nonzero(numpy.abs(values - box) < halfwidth)[0] for box in boxes]
+        
+        for constant in ['time', 'w', 'w0']:
+            self.actualSetUp()
+            if constant == 'time':
+                self.vis.data['time'][...] = self.times[2]
+            else:
+                self.vis.data['uvw'][:, 2] = 0.0 if constant == 'w0' else 5.0
+            for axis in ['time', 'w']:
+                values = self.vis.time if axis == 'time' else self.vis.w
+                for nchunks in [1, 2, 5]:
+                    if axis == 'time':
+                        boxes = numpy.linspace(numpy.min(values), numpy.max(values), nchunks)
+                        halfwidth = 0.5 * (numpy.max(values) - numpy.min(values))
+                    else:
+                        wmaxabs = numpy.max(numpy.abs(values))
+                        boxes = numpy.linspace(-wmaxabs, wmaxabs, nchunks)
+                        halfwidth = wmaxabs
+                    if nchunks > 1:
+                        halfwidth = 0.5 * (boxes[1] - boxes[0])
+                    rows, offsets = vis_slice_index(self.vis, nchunks, axis=axis)
+                    for chunk, expected in enumerate(mask_rows(values, boxes, halfwidth, axis)):
+                        assert numpy.array_equal(rows[offsets[chunk]:offsets[chunk + 1]], expected), \
+                            "%s %s %d %d" % (constant, axis, nchunks, chunk)
+
+    def test_vis_slice_views(self):
+        self.actualSetUp()
+        svis, views = vis_slice_views(self.vis, 11, axis='w')
+        assert sum([view.nvis for view in views if view is not None]) == self.vis.nvis
+        for view in views:
+            if view is not None:
+                assert numpy.max(view.w) - numpy.min(view.w) < 2.0 * numpy.max(numpy.abs(self.vis.w)) / 10.0
+                view.data['vis'][...] = 0.0
+        assert numpy.max(numpy.abs(svis.vis)) == 0.0
+
 if __name__ == '__main__':
     unittest.main()
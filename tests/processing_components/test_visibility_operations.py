@@ -12,16 +12,17 @@ from numpy.testing import assert_allclose
 from astropy.coordinates import SkyCoord
 import astropy.units as u
 
-from data_models.memory_data_models import Skycomponent
+from data_models.memory_data_models import Skycomponent, VisibilityColumns
 from data_models.polarisation import PolarisationFrame
 
 from processing_components.simulation.testing_support import create_named_configuration
 from processing_components.imaging.base import predict_skycomponent_visibility
 from processing_components.visibility.coalesce import convert_blockvisibility_to_visibility
 from processing_components.visibility.operations import append_visibility, qa_visibility, \
-    sum_visibility, subtract_visibility
+    sum_visibility, subtract_visibility, sort_visibility
 from processing_components.visibility.base import copy_visibility, create_visibility, create_blockvisibility, create_visibility_from_rows,\
-    phaserotate_visibility
+    create_visibility_view_from_rows, phaserotate_visibility, convert_visibility_layout, \
+    convert_blockvisibility_to_compact, convert_compact_to_blockvisibility
 
 
 class TestVisibilityOperations(unittest.TestCase):
@@ -90,6 +91,34 @@ class TestVisibilityOperations(unittest.TestCase):
         assert vis.nvis == len(vis.time)
         assert numpy.unique(vis.time).size == self.vis.time.size  # pylint: disable=no-member
 
+    def test_compact_blockvisibility(self):
+        self.vis = create_blockvisibility(self.lowcore, self.times, self.frequency, phasecentre=self.phasecentre,
+                                          weight=1.0, channel_bandwidth=self.channel_bandwidth,
+                                          polarisation_frame=PolarisationFrame('linear'))
+        self.vis = predict_skycomponent_visibility(self.vis, self.comp)
+        compactvis = create_blockvisibility(self.lowcore, self.times, self.frequency, phasecentre=self.phasecentre,
+                                            weight=1.0, channel_bandwidth=self.channel_bandwidth,
+                                            polarisation_frame=PolarisationFrame('linear'), compact=True)
+        compactvis = predict_skycomponent_visibility(compactvis, self.comp)
+        nants = self.vis.nants
+        assert compactvis.compact and not self.vis.compact
+        assert compactvis.nants == nants
+        assert compactvis.nbaselines == self.vis.nbaselines == nants * (nants - 1) // 2
+        assert compactvis.nchan == self.vis.nchan and compactvis.npol == self.vis.npol
+        assert compactvis.size() < 0.5 * self.vis.size()
+        a1, a2 = numpy.triu_indices(nants, 1)
+        assert_allclose(compactvis.uvw, self.vis.uvw[:, a2, a1], atol=1e-9)
+        assert_allclose(compactvis.vis, self.vis.vis[:, a2, a1], atol=1e-9)
+        
+        convertedvis = convert_blockvisibility_to_compact(self.vis)
+        assert convertedvis.compact
+        assert numpy.array_equal(convertedvis.vis, self.vis.vis[:, a2, a1])
+        densevis = convert_compact_to_blockvisibility(convertedvis)
+        assert densevis.vis.shape == self.vis.vis.shape
+        assert numpy.array_equal(densevis.uvw, self.vis.uvw)
+        assert numpy.array_equal(densevis.vis[:, a2, a1], self.vis.vis[:, a2, a1])
+        assert numpy.max(numpy.abs(densevis.vis[:, a1, a2])) == 0.0
+
     def test_create_visibility_from_rows_makecopy(self):
         self.vis = create_visibility(self.lowcore, self.times, self.frequency, phasecentre=self.phasecentre,
                                           weight=1.0, channel_bandwidth=self.channel_bandwidth)
@@ -98,6 +127,73 @@ class TestVisibilityOperations(unittest.TestCase):
             selected_vis = create_visibility_from_rows(self.vis, rows, makecopy=makecopy)
             assert selected_vis.nvis == numpy.sum(numpy.array(rows))
 
+    def test_create_visibility_from_rows_sequence(self):
+        self.vis = create_visibility(self.lowcore, self.times, self.frequency, phasecentre=self.phasecentre,
+                                     weight=1.0, channel_bandwidth=self.channel_bandwidth)
+        for rows in [[0, 3, 7], (0, 3, 7)]:
+            selected_vis = create_visibility_from_rows(self.vis, rows)
+            assert selected_vis.nvis == 3
+            assert numpy.array_equal(selected_vis.time, self.vis.time[[0, 3, 7]])
+        assert create_visibility_from_rows(self.vis, []) is None
+        view = create_visibility_view_from_rows(self.vis, [2, 3, 4])
+        assert view.nvis == 3
+        assert numpy.shares_memory(view.data, self.vis.data)
+
+    def test_create_visibility_view_from_rows(self):
+        self.vis = create_blockvisibility(self.lowcore, self.times, self.frequency, phasecentre=self.phasecentre,
+                                          weight=1.0, channel_bandwidth=self.channel_bandwidth)
+        rows = self.vis.time > 150.0
+        view = create_visibility_view_from_rows(self.vis, rows)
+        assert view.nvis == numpy.sum(rows)
+        assert numpy.shares_memory(view.data, self.vis.data)
+        assert view.configuration is self.vis.configuration
+        with self.assertRaises(ValueError):
+            view.data['vis'][...] = 1.0
+        view = create_visibility_view_from_rows(self.vis, rows, writeable=True)
+        view.data['vis'][...] = 1.0
+        assert numpy.all(self.vis.vis[rows] == 1.0)
+        assert numpy.all(self.vis.vis[~rows] == 0.0)
+        # Rows that are not contiguous are copied
+        rows = numpy.array([0, 2])
+        view = create_visibility_view_from_rows(self.vis, rows)
+        assert view.nvis == 2
+        assert not numpy.shares_memory(view.data, self.vis.data)
+        assert create_visibility_view_from_rows(self.vis, self.vis.time > 1e10) is None
+
+    def test_visibility_columnar(self):
+        self.vis = create_visibility(self.lowcore, self.times, self.frequency,
+                                     channel_bandwidth=self.channel_bandwidth,
+                                     phasecentre=self.phasecentre,
+                                     polarisation_frame=PolarisationFrame("linear"),
+                                     weight=1.0)
+        self.vis = predict_skycomponent_visibility(self.vis, self.comp)
+        cvis = convert_visibility_layout(self.vis, columnar=True)
+        assert isinstance(cvis.data, VisibilityColumns)
+        assert cvis.uvw.flags['C_CONTIGUOUS'] and cvis.vis.flags['C_CONTIGUOUS']
+        assert cvis.data.dtype == self.vis.data.dtype
+        assert cvis.nvis == self.vis.nvis
+        assert cvis.size() == self.vis.size()
+        for column in self.vis.data.dtype.names:
+            assert numpy.array_equal(cvis.data[column], self.vis.data[column]), column
+        assert numpy.array_equal(convert_visibility_layout(cvis, columnar=False).data, self.vis.data)
+        
+        rows = self.vis.time > 150.0
+        selected = create_visibility_from_rows(cvis, rows)
+        assert isinstance(selected.data, VisibilityColumns)
+        assert numpy.array_equal(selected.vis, self.vis.vis[rows])
+        
+        newvis = copy_visibility(cvis, zero=True)
+        assert numpy.max(numpy.abs(newvis.vis)) == 0.0
+        assert numpy.max(numpy.abs(cvis.vis)) > 0.0
+        newvis.data[rows] = cvis.data[rows]
+        assert numpy.array_equal(newvis.vis[rows], self.vis.vis[rows])
+        
+        cvis = append_visibility(cvis, convert_visibility_layout(self.vis, columnar=True))
+        assert isinstance(cvis.data, VisibilityColumns)
+        assert cvis.nvis == 2 * self.vis.nvis
+        cvis = sort_visibility(cvis)
+        assert numpy.array_equal(cvis.index, numpy.repeat(self.vis.index, 2))
+
     def test_append_visibility(self):
             self.vis = create_visibility(self.lowcore, self.times, self.frequency,
                                          channel_bandwidth=self.channel_bandwidth,